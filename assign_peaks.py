@@ -0,0 +1,183 @@
+#! /usr/bin/python3
+import numpy as np
+import pandas as pd
+
+import model
+
+'''
+Automatic peak-to-atom candidate assignment from the shift list.
+
+The assigned shifts of the final .prot (atom number, shift, cyana atom
+name, residue) are indexed per nucleus in sorted arrays. For every peak
+dimension the atoms within the ppm tolerance are found with two binary
+searches (searchsorted) for the whole peak list at once, so 10^5 peaks
+against 10^4 shifts stay well under a second. A proton dimension bound to a
+heavy atom dimension (HC/C, HN/N) is searched on an index of the bonded
+H/heavy pairs of every residue, a 2D box query: binary search on the heavy
+shift then filter on the proton shift.
+
+The candidates of every peak are ranked by their normalised distance
+sum((delta / tolerance)^2) and written in the assignment columns of the
+xeasy file, the alternatives on continuation lines.
+'''
+
+default_tolerances = {'H': 0.03, 'C': 0.4, 'N': 0.4}
+max_candidates = 10
+
+
+def nucleus(atom_name):
+    """H, C or N from a cyana atom name (Q pseudo atoms are protons)."""
+    first = str(atom_name)[:1].upper()
+    return 'H' if first in ('H', 'Q') else first
+
+
+def bonded_heavy_names(proton):
+    """Names of the heavy atom a proton (or pseudo atom) can be bound to, most likely first."""
+    proton = str(proton)
+    if proton == 'H':
+        return ['N']
+    name = proton.lstrip('Q') if proton.startswith('Q') else proton[1:]
+    if not name:
+        return []
+    greek = name[0]
+    if len(name) == 1:
+        options = [greek]
+    elif proton.startswith('Q') or len(name) >= 3:
+        # QD1, HG12: the digit is the branch
+        options = [greek + name[1], greek]
+    else:
+        # HB2 is on CB, but HD2 of His is on CD2
+        options = [greek, greek + name[1]]
+    return [heavy + option for heavy in ('C', 'N') for option in options]
+
+
+def read_prot(prot_file):
+    """Shift list of a cyana .prot written by file_to_prot (model.ShiftTable, parsed once per process)."""
+    return model.load_shifts(prot_file)
+
+
+def ranges_within(sorted_values, positions, tolerance):
+    """Pairs (peak, position in sorted_values) with |value - position| <= tolerance."""
+    low = np.searchsorted(sorted_values, positions - tolerance, side='left')
+    high = np.searchsorted(sorted_values, positions + tolerance, side='right')
+    counts = high - low
+    peaks = np.repeat(np.arange(len(positions)), counts)
+    starts = np.repeat(low - (np.cumsum(counts) - counts), counts)
+    return peaks, starts + np.arange(counts.sum())
+
+
+class ShiftIndex:
+    """Sorted shift arrays per nucleus and per bonded proton/heavy pair."""
+
+    def __init__(self, shifts):
+        if isinstance(shifts, pd.DataFrame):
+            shifts = model.ShiftTable.from_frame(shifts)
+        value = shifts.column('value')
+        rows = np.flatnonzero(~np.isnan(value))
+        self.number = shifts.column('index')[rows]
+        self.shift = value[rows]
+        atom_codes = shifts.column('atom')[rows]
+        self.atom = np.array(shifts.atom_names, dtype=object)[atom_codes]
+        self.residue = np.array(shifts.residue_names, dtype=object)[shifts.column('residue')[rows]]
+        # nucleus of every distinct atom name, then of every shift
+        nuclei = np.array([nucleus(atom) for atom in shifts.atom_names] or [''])[atom_codes]
+
+        # one sorted array per nucleus
+        self.nuclei = {}
+        for nuc in np.unique(nuclei):
+            rows = np.flatnonzero(nuclei == nuc)
+            rows = rows[np.argsort(self.shift[rows], kind='stable')]
+            self.nuclei[nuc] = (self.shift[rows], rows)
+
+        # bonded pairs, sorted on the heavy atom shift
+        position = {(res, atom): i for i, (res, atom) in enumerate(zip(self.residue, self.atom))}
+        pairs = {}
+        for i in np.flatnonzero(nuclei == 'H'):
+            for heavy in bonded_heavy_names(self.atom[i]):
+                j = position.get((self.residue[i], heavy))
+                if j is not None:
+                    pairs.setdefault(heavy[0], []).append((i, j))
+                    break
+        self.pairs = {}
+        for heavy_nuc, found in pairs.items():
+            found = np.array(found, dtype=np.int64)
+            found = found[np.argsort(self.shift[found[:, 1]], kind='stable')]
+            self.pairs[heavy_nuc] = (self.shift[found[:, 1]], found[:, 0], found[:, 1])
+
+    def within(self, nuc, positions, tolerance):
+        """(peak, shift row) of the atoms of one nucleus around every position."""
+        if nuc not in self.nuclei:
+            return np.empty(0, np.int64), np.empty(0, np.int64)
+        values, rows = self.nuclei[nuc]
+        peaks, found = ranges_within(values, positions, tolerance)
+        return peaks, rows[found]
+
+    def pairs_within(self, heavy_nuc, proton_positions, heavy_positions, tol_proton, tol_heavy):
+        """(peak, proton row, heavy row) of the bonded pairs inside the 2D box."""
+        if heavy_nuc not in self.pairs:
+            empty = np.empty(0, np.int64)
+            return empty, empty, empty
+        heavy_values, protons, heavies = self.pairs[heavy_nuc]
+        peaks, found = ranges_within(heavy_values, heavy_positions, tol_heavy)
+        keep = np.abs(self.shift[protons[found]] - proton_positions[peaks]) <= tol_proton
+        return peaks[keep], protons[found[keep]], heavies[found[keep]]
+
+
+def find_candidates(index, positions, dims, bonded=(), tolerances=None, limit=max_candidates):
+    """Candidate assignments of a peak list.
+
+    positions: one array per dimension, in the xeasy column order
+    dims: nucleus of every dimension ('H', 'C', 'N')
+    bonded: (proton dimension, heavy dimension) pairs of bound atoms
+    Returns a DataFrame (peak, a1 .. an atom numbers, score), best first.
+    """
+    tolerances = {**default_tolerances, **(tolerances or {})}
+    positions = [np.asarray(p, dtype=np.float64) for p in positions]
+    n_peaks = len(positions[0]) if positions else 0
+    columns = [f'a{d + 1}' for d in range(len(dims))]
+    candidates = None
+
+    def score(peaks, rows, d):
+        return ((index.shift[rows] - positions[d][peaks]) / tolerances[dims[d]]) ** 2
+
+    paired = {d for pair in bonded for d in pair}
+    for proton_dim, heavy_dim in bonded:
+        peaks, protons, heavies = index.pairs_within(
+            dims[heavy_dim], positions[proton_dim], positions[heavy_dim],
+            tolerances[dims[proton_dim]], tolerances[dims[heavy_dim]])
+        part = pd.DataFrame({'peak': peaks, f'r{proton_dim}': protons, f'r{heavy_dim}': heavies,
+                             'score': score(peaks, protons, proton_dim) + score(peaks, heavies, heavy_dim)})
+        candidates = part if candidates is None else merge_candidates(candidates, part)
+    for d in range(len(dims)):
+        if d in paired:
+            continue
+        # only the peaks still having candidates need to be searched
+        active = np.arange(n_peaks) if candidates is None else np.unique(candidates['peak'].to_numpy())
+        peaks, rows = index.within(dims[d], positions[d][active], tolerances[dims[d]])
+        peaks = active[peaks]
+        part = pd.DataFrame({'peak': peaks, f'r{d}': rows, 'score': score(peaks, rows, d)})
+        candidates = part if candidates is None else merge_candidates(candidates, part)
+
+    if candidates is None or candidates.empty or n_peaks == 0:
+        return pd.DataFrame(columns=['peak'] + columns + ['score'])
+
+    # best first for every peak, at most limit candidates
+    peak = candidates['peak'].to_numpy()
+    order = np.lexsort((candidates['score'].to_numpy(), peak))
+    peak = peak[order]
+    starts = np.flatnonzero(np.r_[True, peak[1:] != peak[:-1]])
+    rank = np.arange(len(peak)) - np.repeat(starts, np.diff(np.r_[starts, len(peak)]))
+    order = order[rank < limit]
+
+    result = pd.DataFrame({'peak': candidates['peak'].to_numpy()[order]})
+    for d, column in enumerate(columns):
+        result[column] = index.number[candidates[f'r{d}'].to_numpy()[order]]
+    result['score'] = candidates['score'].to_numpy()[order]
+    return result
+
+
+def merge_candidates(left, right):
+    """Combine the candidates of two groups of dimensions of the same peaks."""
+    merged = left.merge(right, on='peak', suffixes=('', '_right'))
+    merged['score'] = merged['score'] + merged.pop('score_right')
+    return merged
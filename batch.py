@@ -0,0 +1,125 @@
+#! /usr/bin/python3
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import engine
+import metrics
+import to_xeasy
+
+'''
+Headless batch conversion of many working directories.
+
+The manifest is a CSV (or a JSON list of objects) with one project per line:
+
+path,start,sequence,version,compress
+constructs/SilB41,43,APEKKVLFWYDPMKPDTKFDKPGKSPFMDMDLVPKYADESG,3,
+mutants/SilB41_K52A,43,APEKKVLFWYDPMAPDTKFDKPGKSPFMDMDLVPKYADESG,3,.gz
+
+Every path must hold 13C.csv, 15N.csv and attrib.csv. Relative paths are read
+from the manifest directory. version is optional (--version is used instead),
+so is compress ('.gz' or '.zst': compressed .peaks and .prot, --compress
+otherwise).
+
+python batch.py manifest.csv --workers 8 --summary summary.csv [--compress .gz]
+'''
+
+
+def read_manifest(manifest, default_version=2, default_compress=None):
+    """Read the list of projects to convert."""
+    base = os.path.dirname(os.path.abspath(manifest))
+    if manifest.endswith('.json'):
+        with open(manifest, 'r') as f:
+            rows = json.load(f)
+    else:
+        with open(manifest, 'r', newline='') as f:
+            rows = [row for row in csv.DictReader(f) if any((v or '').strip() for v in row.values())]
+
+    projects = []
+    for row in rows:
+        path = str(row['path']).strip()
+        projects.append({
+            'path': os.path.join(base, path) if not os.path.isabs(path) else path,
+            'start': str(row['start']).strip(),
+            'sequence': str(row['sequence']).strip(),
+            'version': str(row.get('version') or default_version).strip(),
+            'compress': str(row.get('compress') or default_compress or '').strip() or None,
+        })
+    return projects
+
+
+def convert_project(project):
+    """Worker: convert one project and return its summary line."""
+    start = time.perf_counter()
+    try:
+        # the projects already fill the CPUs, one process per project
+        result = engine.run_conversion(project['path'], project['start'],
+                                       project['sequence'], project['version'], workers=1,
+                                       compress=project.get('compress'))
+    except Exception as e:
+        result = {'ok': False, 'error': f"{type(e).__name__}: {e}", 'stages': []}
+    return {
+        'path': project['path'],
+        'status': 'ok' if result['ok'] else 'error',
+        'error': result['error'] or '',
+        'stages': ' '.join(f"{s['name']}={'ok' if s['ok'] else 'error'}" for s in result['stages']),
+        'time': round(time.perf_counter() - start, 3),
+    }
+
+
+def run_batch(projects, workers=None):
+    """Convert the projects over a pool of worker processes, in manifest order."""
+    summary = [None] * len(projects)
+    # spawned, not forked, as the spectrum pools (see to_xeasy.start_method)
+    with ProcessPoolExecutor(max_workers=workers, initializer=metrics.setup_logging,
+                             mp_context=to_xeasy.pool_context()) as pool:
+        futures = {pool.submit(convert_project, project): i for i, project in enumerate(projects)}
+        for future in as_completed(futures):
+            i = futures[future]
+            try:
+                summary[i] = future.result()
+            except Exception as e:
+                # worker process died (memory, killed ...)
+                summary[i] = {'path': projects[i]['path'], 'status': 'error',
+                              'error': f"{type(e).__name__}: {e}", 'stages': '', 'time': 0.0}
+            print(f"[{summary[i]['status']}] {summary[i]['path']}", flush=True)
+    return summary
+
+
+def write_summary(summary, output_file):
+    """Write the per-project status as CSV or JSON (from the extension)."""
+    if output_file.endswith('.json'):
+        with open(output_file, 'w') as f:
+            json.dump(summary, f, indent=2)
+        return
+    with open(output_file, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=['path', 'status', 'error', 'stages', 'time'])
+        writer.writeheader()
+        writer.writerows(summary)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert many CCPNMR V3 projects for cyana.")
+    parser.add_argument('manifest', help="CSV or JSON list of projects (path, start, sequence, version)")
+    parser.add_argument('--workers', type=int, default=None, help="number of worker processes (default: all CPUs)")
+    parser.add_argument('--version', default='2', choices=['2', '3'], help="cyana version when the manifest has none")
+    parser.add_argument('--summary', default='batch_summary.csv', help="status summary file (.csv or .json)")
+    parser.add_argument('--compress', choices=['.gz', '.zst'],
+                        help="write the .peaks and the .prot compressed when the manifest has no compress")
+    args = parser.parse_args()
+
+    projects = read_manifest(args.manifest, args.version, args.compress)
+    summary = run_batch(projects, args.workers)
+    write_summary(summary, args.summary)
+
+    failed = sum(1 for line in summary if line['status'] != 'ok')
+    print(f"{len(summary) - failed}/{len(summary)} projects converted, summary in {args.summary}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
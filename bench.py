@@ -0,0 +1,274 @@
+#! /usr/bin/python3
+import argparse
+import gc
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+import fasta_to_seq
+import to_xeasy
+import file_to_prot
+import peak_cache
+
+'''
+Benchmarks of the converters on synthetic CCPN V3 exports.
+
+The synthetic 13C.csv, 15N.csv and attrib.csv follow the files of demo/
+(_object "<PK:...: @(...)>" strings, quoted multi-line headers, 43-1
+sequence codes, None residue types, empty peak counts). Every stage is
+timed and its peak memory measured separately (the first run is reported
+too: to_xeasy builds the peak cache there), the report is JSON so two
+releases can be compared:
+
+python bench.py --sizes 1000 100000 1000000 --report bench.json
+python bench.py --sizes 1000 100000 --compare bench.json
+'''
+
+one_letters = sorted(fasta_to_seq.one_to_three)
+
+# atoms exported by CCPN for every residue of the synthetic tables, with a typical shift
+residue_atoms = {'C': 176.0, 'CA': 56.0, 'CB': 35.0, 'H': 8.2, 'HA': 4.3, 'HB2': 2.0, 'HB3': 1.9,
+                 'HG2': 1.8, 'HG3': 1.7, 'CG': 30.0, 'N': 120.0, 'HB%': 1.3, 'HD%': 0.9}
+previous_atoms = ['C', 'CA', 'CB']  # atoms of the i-1 residue, exported as 43-1
+
+
+def ccpn_position(value):
+    """Position as printed in the CCPN _object string (4.388, 65.03, 126.03)."""
+    return repr(round(float(value), 3 if abs(value) < 10 else 2))
+
+
+def peak_rows(rng, n, heavy_range, carbon=True):
+    """n synthetic peaks with diagonal and near-duplicate peaks, like the demo lists."""
+    if carbon:
+        f1 = rng.uniform(0.0, 5.0, n)       # H bound to C
+        f2 = rng.uniform(*heavy_range, n)   # C
+        f3 = rng.uniform(-1.0, 9.0, n)      # H
+        diagonal = rng.random(n) < 0.1
+        f3[diagonal] = f1[diagonal] + rng.normal(0, 0.002, diagonal.sum())
+    else:
+        f1 = rng.uniform(6.5, 10.5, n)      # HN
+        f2 = rng.uniform(-1.0, 10.5, n)     # H
+        f3 = rng.uniform(*heavy_range, n)   # N
+        diagonal = rng.random(n) < 0.1
+        f2[diagonal] = f1[diagonal] + rng.normal(0, 0.002, diagonal.sum())
+    # peaks picked twice a few thousandths of ppm apart
+    duplicate = np.flatnonzero(rng.random(n) < 0.05)
+    source = np.maximum(duplicate - 1, 0)
+    f1[duplicate] = f1[source] + rng.normal(0, 0.002, len(duplicate))
+    f2[duplicate] = f2[source] + rng.normal(0, 0.02, len(duplicate))
+    f3[duplicate] = f3[source] + rng.normal(0, 0.002, len(duplicate))
+    volume = rng.lognormal(25, 2, n)
+    return f1, f2, f3, volume
+
+
+def write_peak_csv(path, n, seed=0, carbon=True, chunk=500000):
+    """Write a CCPN V3 peak export of n peaks, chunk by chunk."""
+    rng = np.random.default_rng(seed)
+    spectrum = 'noesy_HSQC_SilB41_1ag_ref' if carbon else 'noesy_HSQC_SilB41_1ag'
+    heavy_range = (10.0, 140.0) if carbon else (100.0, 135.0)
+    with open(path, 'w') as f:
+        f.write('_object,Pos F1,Pos F2,Pos F3,Volume\n')
+        serial = 1
+        for start in range(0, n, chunk):
+            size = min(chunk, n - start)
+            f1, f2, f3, volume = peak_rows(rng, size, heavy_range, carbon)
+            f.write(''.join(
+                f'"<PK:{spectrum}.1.{serial + i}: @({ccpn_position(a)}, {ccpn_position(b)}, {ccpn_position(c)})>",'
+                f'{a!r},{b!r},{c!r},{v!r}\n'
+                for i, (a, b, c, v) in enumerate(zip(f1.tolist(), f2.tolist(), f3.tolist(), volume.tolist()))))
+            serial += size
+
+
+def write_attrib_csv(path, n, start_number=43, seed=0):
+    """Write a CCPN V3 chemical shift export of about n rows, return the sequence."""
+    rng = np.random.default_rng(seed)
+    per_residue = len(residue_atoms) + len(previous_atoms)
+    n_residues = max(2, n // per_residue)
+    sequence = ''.join(rng.choice(one_letters, n_residues))
+    unique_id = 1
+    with open(path, 'w') as f:
+        f.write('uniqueId,"Value\n(ppm)","Value Error\n(ppm)",SequenceCode,ResidueType,AtomName,"Total\nPeak Count"\n')
+        lines = []
+        for i, aa in enumerate(sequence):
+            number = start_number + i
+            name = fasta_to_seq.one_to_three[aa].upper()
+            for atom in previous_atoms:
+                lines.append(f'{unique_id},{residue_atoms[atom] + rng.normal(0, 2)!r},0,{number}-1,None,{atom},\n')
+                unique_id += 1
+            for atom, shift in residue_atoms.items():
+                count = rng.integers(0, 25)
+                error = 'None' if rng.random() < 0.05 else repr(rng.uniform(0, 0.3))
+                shift += rng.normal(0, 0.05 * shift ** 0.5)
+                lines.append(f'{unique_id},{shift!r},{error},{number},{name},{atom},'
+                             f'{count if count else ""}\n')
+                unique_id += 1
+            if len(lines) > 100000:
+                f.write(''.join(lines))
+                lines = []
+        f.write(''.join(lines))
+    return sequence
+
+
+def measure(func, repeat=3, reset=None):
+    """Wall time of the first run, best wall time over repeat runs, then peak
+    traced memory of one more run.
+
+    reset is called before the first run only (to_xeasy: remove the peak
+    cache, the first run builds it and the next ones read it).
+    """
+    if reset is not None:
+        reset()
+    times = []
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    gc.collect()
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return times[0], min(times), peak
+
+
+def bench_size(n_peaks, work_dir, repeat=3, start_number=43):
+    """Time every stage on synthetic exports of n_peaks peaks per spectrum."""
+    file_13 = os.path.join(work_dir, '13C.csv')
+    file_15 = os.path.join(work_dir, '15N.csv')
+    attrib = os.path.join(work_dir, 'attrib.csv')
+    seq_file = os.path.join(work_dir, 'prot.seq')
+    write_peak_csv(file_13, n_peaks, seed=1, carbon=True)
+    write_peak_csv(file_15, n_peaks, seed=2, carbon=False)
+    n_shifts = max(100, n_peaks // 10)
+    sequence = write_attrib_csv(attrib, n_shifts, start_number)
+
+    residue_map = {}
+    processed = {'attrib': pd.read_csv(attrib)}
+
+    def run_fasta():
+        fasta_to_seq.write_to_file(fasta_to_seq.convert_sequence(sequence), seq_file, start_number)
+
+    def run_xeasy():
+        to_xeasy.process_files(file_13, file_15, 3, work_dir)
+
+    def run_process():
+        # parsing is part of to_xeasy but not of this one: the target is about the cleanup
+        processed['df'] = file_to_prot.process_protein_data(processed['attrib'], seq_file, residue_map=residue_map)
+        return processed['df']
+
+    def run_additional():
+        processed['final'] = file_to_prot.additional_processing(processed['df'])
+        return processed['final']
+
+    def remove_caches():
+        for file in (file_13, file_15):
+            if os.path.exists(peak_cache.cache_file(file)):
+                os.remove(peak_cache.cache_file(file))
+
+    def run_nomenclature():
+        return file_to_prot.translate_prot(processed['final'], residue_map)
+
+    stages = [
+        ('fasta_to_seq', run_fasta, len(sequence), None),
+        ('to_xeasy.process_files', run_xeasy, 2 * n_peaks, remove_caches),
+        ('file_to_prot.process_protein_data', run_process, len(processed['attrib']), None),
+        ('file_to_prot.additional_processing', run_additional, None, None),
+        # monentlature.translate_atoms and the table around it
+        ('file_to_prot.translate_prot', run_nomenclature, None, None),
+    ]
+
+    results = []
+    for name, func, rows, reset in stages:
+        if name == 'file_to_prot.process_protein_data':
+            residue_map.update(file_to_prot.read_prot_seq(seq_file))
+        if rows is None:
+            rows = len(processed['df'] if name.endswith('additional_processing') else processed['final'])
+        first, elapsed, peak = measure(func, repeat, reset)
+        results.append({
+            'stage': name,
+            'peaks': n_peaks,
+            'rows': rows,
+            'time_s': round(elapsed, 6),
+            'first_time_s': round(first, 6),
+            'rows_per_s': round(rows / elapsed) if elapsed else None,
+            'peak_memory_bytes': peak,
+        })
+        print(f"{n_peaks:>10} peaks  {name:<36} {elapsed:9.4f} s  (first {first:9.4f} s)  {peak / 2**20:9.1f} MiB", flush=True)
+    return results
+
+
+def environment():
+    return {
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+    }
+
+
+def compare(results, previous_file):
+    """Print the time ratio new/old for the stages and sizes found in both reports."""
+    with open(previous_file, 'r') as f:
+        previous = {(r['stage'], r['peaks']): r for r in json.load(f)['results']}
+    for result in results:
+        old = previous.get((result['stage'], result['peaks']))
+        if old and old['time_s']:
+            ratio = result['time_s'] / old['time_s']
+            print(f"{result['peaks']:>10} peaks  {result['stage']:<36} x{ratio:6.2f} time  "
+                  f"x{result['peak_memory_bytes'] / max(old['peak_memory_bytes'], 1):6.2f} memory")
+
+
+def positive_int(text):
+    value = int(text)
+    if value < 1:
+        raise argparse.ArgumentTypeError(f"{text} is not a positive number")
+    return value
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the converters on synthetic CCPN exports.")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000],
+                        help="number of peaks per spectrum (shift list is a tenth of it)")
+    parser.add_argument('--repeat', type=positive_int, default=3,
+                        help="timed runs per stage, the best one and the first one are kept")
+    parser.add_argument('--report', default='bench_report.json', help="JSON report")
+    parser.add_argument('--compare', help="previous JSON report to compare with")
+    parser.add_argument('--workdir', help="keep the synthetic files in this directory")
+    args = parser.parse_args()
+
+    results = []
+    for size in args.sizes:
+        if args.workdir:
+            work_dir = os.path.join(args.workdir, str(size))
+            os.makedirs(work_dir, exist_ok=True)
+            results += bench_size(size, work_dir, args.repeat)
+        else:
+            with tempfile.TemporaryDirectory() as work_dir:
+                results += bench_size(size, work_dir, args.repeat)
+
+    # throughput target of the vectorized assignment cleanup, small tables only measure the overhead
+    for result in results:
+        if result['stage'] == 'file_to_prot.process_protein_data' and result['rows'] >= 100000:
+            result['target_rows_per_s'] = file_to_prot.throughput_target
+            result['meets_target'] = (result['rows_per_s'] or 0) >= file_to_prot.throughput_target
+
+    with open(args.report, 'w') as f:
+        json.dump({'environment': environment(), 'results': results}, f, indent=2)
+    print(f"Report written in {args.report}")
+
+    if args.compare:
+        compare(results, args.compare)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
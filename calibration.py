@@ -0,0 +1,189 @@
+#! /usr/bin/python3
+import argparse
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+import assign_peaks
+import metrics
+import model
+import peak_cleanup
+import peak_index
+import spectra
+import to_xeasy
+from fileutils import replace_file
+
+'''
+NOE volume calibration to cyana upper distance limits (.upl).
+
+The volume of a NOE falls with the sixth power of the distance, so every
+peak of a spectrum gets the upper limit
+
+    d = (C / |Volume|) ** (1/6)
+
+bounded to [2.4, 6.0] A. The constant C of a spectrum comes from reference
+peaks of known distance, C = median(|Volume| * d ** 6), or, without
+references, from the median volume of the spectrum set to 4.0 A. The limits
+of the whole peak list are computed at once with array maths.
+
+The peaks are read from the written .peaks files, after the cleanup, and
+every restraint carries the number of its peak in the .peaks. They are
+assigned from the final .prot (see assign_peaks). Only the peaks with a
+single candidate atom pair are written, the ambiguous ones are left to
+cyana (noeassign). One .upl per NOESY, next to its .peaks file:
+
+python calibration.py WORKDIR [--distance 4.0] [--reference VOLUME:DISTANCE ...]
+'''
+
+default_distance = 4.0
+distance_limits = (2.4, 6.0)
+chunksize = to_xeasy.chunksize
+
+
+def calibration_constant(volumes, distance=default_distance, references=None):
+    """C of d = (C / |V|)^(1/6).
+
+    references: (volume, distance) pairs of peaks of known distance;
+    without them the median |volume| of the spectrum is set to distance.
+    """
+    if references:
+        pairs = np.asarray(references, dtype=np.float64).reshape(-1, 2)
+        return float(np.median(np.abs(pairs[:, 0]) * pairs[:, 1] ** 6))
+    volumes = np.abs(np.asarray(volumes, dtype=np.float64))
+    volumes = volumes[np.isfinite(volumes) & (volumes > 0)]
+    if not len(volumes):
+        raise ValueError("No peak with a volume to calibrate on")
+    return float(np.median(volumes)) * distance ** 6
+
+
+def upper_limits(volumes, constant, limits=distance_limits):
+    """Upper distance limit of every peak, NaN without a volume."""
+    volumes = np.abs(np.asarray(volumes, dtype=np.float64))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        distances = (constant / volumes) ** (1 / 6)
+    distances[~(np.isfinite(volumes) & (volumes > 0))] = np.nan
+    return np.clip(distances, *limits)
+
+
+def restraints(candidates, index, proton_dims, distances, stats=None):
+    """Atom rows and limit of the peaks with one candidate proton pair.
+
+    candidates: DataFrame of assign_peaks.find_candidates
+    proton_dims: the two proton dimensions of the NOESY
+    Returns a DataFrame (peak, row1, row2, upl) in the peak order.
+    """
+    first, second = (f'a{d + 1}' for d in proton_dims)
+    rows = pd.Index(index.number)
+    pairs = pd.DataFrame({'peak': candidates['peak'].to_numpy(np.int64),
+                          'row1': rows.get_indexer(candidates[first].to_numpy(np.int64)),
+                          'row2': rows.get_indexer(candidates[second].to_numpy(np.int64))})
+    # the same proton on both dimensions is the diagonal, not a NOE
+    pairs = pairs[pairs['row1'] != pairs['row2']].drop_duplicates(['peak', 'row1', 'row2'])
+    counts = pairs['peak'].value_counts()
+    single = pairs[pairs['peak'].map(counts) == 1]
+    metrics.add_filtered(stats, 'ambiguous peaks', int((counts > 1).sum()))
+    single = single.assign(upl=distances[single['peak'].to_numpy()])
+    return single.sort_values('peak', kind='stable').reset_index(drop=True)
+
+
+def upl_lines(table, index, residue_map, numbers):
+    """cyana .upl lines of the restraints (residue, residue name, atom twice, limit).
+
+    numbers: xeasy number of every peak, given after the limit.
+    """
+    lines = []
+    for peak, row1, row2, upl in table[['peak', 'row1', 'row2', 'upl']].itertuples(index=False):
+        atoms = []
+        for row in (row1, row2):
+            residue = index.residue[row]
+            atoms.append(f"{residue:>5} {residue_map.get(residue, 'UNK'):<4} {index.atom[row]:<5}")
+        lines.append(f"{atoms[0]} {atoms[1]} {upl:6.2f}  #peak {numbers[peak]}\n")
+    return lines
+
+
+def calibrate_spectrum(spectrum, index, residue_map, distance=default_distance, references=None,
+                       limits=distance_limits, tolerances=None, stats=None):
+    """Write the .upl of one NOESY from its .peaks, return its calibration constant."""
+    # the peaks cyana gets: cleaned, numbered as in the .peaks
+    records = peak_index.read_records(spectrum.peaks, spectrum.n_dims, volume=True)
+    positions = [records['positions'][d] for d in range(spectrum.n_dims)]
+    volumes = records['volume']
+    numbers = records['number']
+    if stats is not None:
+        stats['rows_read'] += len(numbers)
+
+    constant = calibration_constant(volumes, distance, references)
+    distances = upper_limits(volumes, constant, limits)
+    # no restraint from the diagonal or from a peak without a volume
+    diagonal = peak_cleanup.diagonal_peaks(positions, spectrum.diagonal)
+    no_volume = np.isnan(distances) & ~diagonal
+    metrics.add_filtered(stats, 'diagonal peaks', int(diagonal.sum()))
+    metrics.add_filtered(stats, 'no volume', int(no_volume.sum()))
+    kept = np.flatnonzero(~(diagonal | no_volume))
+
+    n_restraints = 0
+    with replace_file(spectrum.upl) as f:
+        # candidates by chunks, as in to_xeasy: memory stays flat on big peak lists
+        for start in range(0, len(kept), chunksize):
+            chunk = kept[start:start + chunksize]
+            candidates = assign_peaks.find_candidates(index, [p[chunk] for p in positions], spectrum.nuclei,
+                                                      spectrum.bonded, tolerances)
+            candidates['peak'] = chunk[candidates['peak'].to_numpy(np.int64)]
+            metrics.add_filtered(stats, 'unassigned peaks', len(chunk) - candidates['peak'].nunique())
+            table = restraints(candidates, index, spectrum.diagonal, distances, stats)
+            f.writelines(upl_lines(table, index, residue_map, numbers))
+            n_restraints += len(table)
+    if stats is not None:
+        stats['rows_written'] += n_restraints
+    return constant
+
+
+def calibrate_spectra(spectrum_list, prot_file, seq_file, distance=default_distance, references=None,
+                      limits=distance_limits, tolerances=None, stats=None, progress=None):
+    """Write the .upl of every NOESY of spectrum_list, return {spectrum name: constant}.
+
+    progress: metrics.Progress, gets the spectra calibrated.
+    """
+    index = assign_peaks.ShiftIndex(model.load_shifts(prot_file))
+    residue_map = model.load_sequence(seq_file)
+    noesys = spectra.noesy_spectra(spectrum_list)
+    constants = {}
+    for done, spectrum in enumerate(noesys):
+        metrics.report(progress, 'calibrate', done, len(noesys))
+        constants[spectrum.name] = calibrate_spectrum(spectrum, index, residue_map, distance, references,
+                                                      limits, tolerances, stats)
+    metrics.report(progress, 'calibrate', len(noesys), len(noesys))
+    return constants
+
+
+def reference_pair(text):
+    volume, distance = text.split(':')
+    return float(volume), float(distance)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Calibrate the NOESY volumes of a working directory to .upl files")
+    parser.add_argument('save_path')
+    parser.add_argument('--distance', type=float, default=default_distance,
+                        help="upper limit of the median volume (A)")
+    parser.add_argument('--reference', type=reference_pair, action='append',
+                        help="VOLUME:DISTANCE of a peak of known distance, replaces --distance")
+    parser.add_argument('--limits', type=float, nargs=2, default=distance_limits, metavar=('MIN', 'MAX'))
+    args = parser.parse_args()
+
+    stats = metrics.new_stats()
+    start = time.perf_counter()
+    spectrum_list = spectra.project_spectra(args.save_path)
+    constants = calibrate_spectra(spectrum_list, os.path.join(args.save_path, 'attib_cyana.prot'),
+                                  os.path.join(args.save_path, 'prot.seq'), args.distance, args.reference,
+                                  tuple(args.limits), stats=stats)
+    for name, constant in constants.items():
+        print(f"{name}: C = {constant:.4g}")
+    print(metrics.format_stages([{'name': 'calibrate', 'ok': True, 'time': time.perf_counter() - start,
+                                  'metrics': stats}]))
+
+
+if __name__ == "__main__":
+    main()
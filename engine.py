@@ -0,0 +1,222 @@
+#! /usr/bin/python3
+import os
+
+import fasta_to_seq
+import to_xeasy
+import file_to_prot
+import monentlature
+import metrics
+import spectra
+import shift_screen
+from fileutils import compression_suffixes, existing
+from scheduler import Stage, run_stages
+
+'''
+In-process conversion engine: runs fasta_to_seq, to_xeasy and file_to_prot
+in the current interpreter (no subprocess, pandas imported once, and only
+when a stage needs it) and returns a structured result instead of scraped
+stdout/stderr.
+
+result = run_conversion('/path/to/work', 43, 'APEKKVLF...', version=3)
+result['ok'] -> True/False
+result['stages'] -> [{'name', 'ok', 'outputs', 'error', 'traceback', 'time',
+                      'metrics', 'process_peak_rss'}, ...]
+
+The stages are run by scheduler.run_stages: to_xeasy runs next to
+fasta_to_seq, file_to_prot waits for prot.seq.
+
+With compress='.gz' (or '.zst'), the .peaks and the .prot are written
+compressed: 13C.peaks.gz, attib_cyana.prot.gz.
+'''
+
+valid_aas = set("ARNDCQEGHILKMFPSTWYV")
+
+
+def check_inputs(save_path, start_number, fasta_sequence, version=2, compress=None):
+    """Return an error message for invalid inputs, None if everything is fine."""
+    if not all([str(start_number).strip(), fasta_sequence, save_path]):
+        return "All fields are required!"
+    try:
+        start_num = int(start_number)
+        if start_num < 1:
+            raise ValueError("Start number must be a positive integer")
+    except ValueError:
+        return "Invalid start number! Must be a positive integer."
+    if not all(aa in valid_aas for aa in fasta_sequence.upper()):
+        return "Invalid protein sequence! Use standard one-letter amino acid codes."
+    if not os.path.isdir(save_path):
+        return "Invalid save directory!"
+    if str(version) not in ('2', '3'):
+        return "Invalid Cyana version! Must be 2 or 3."
+    if compress and compress not in compression_suffixes:
+        return "Invalid compression! Must be .gz or .zst."
+    return None
+
+
+def project_paths(save_path, compress=None):
+    """Input and output file names used in a working directory (the CCPN exports can be compressed).
+
+    compress: '.gz' or '.zst' added to the .peaks and the .prot.
+    """
+    compress = compress or ''
+    return {
+        'file_13C': existing(os.path.join(save_path, "13C.csv")),
+        'file_15N': existing(os.path.join(save_path, "15N.csv")),
+        'attrib': existing(os.path.join(save_path, "attrib.csv")),
+        'seq': os.path.join(save_path, "prot.seq"),
+        'peaks_13C': os.path.join(save_path, "13C.peaks" + compress),
+        'peaks_15N': os.path.join(save_path, "15N.peaks" + compress),
+        'prot': os.path.join(save_path, "attib_cyana.prot" + compress),
+        'cleanup_13C': os.path.join(save_path, "13C_cleanup.csv"),
+        'cleanup_15N': os.path.join(save_path, "15N_cleanup.csv"),
+        'upl_13C': os.path.join(save_path, "13C.upl"),
+        'upl_15N': os.path.join(save_path, "15N.upl"),
+        'outliers': os.path.join(save_path, shift_screen.report_name),
+        'spectra': os.path.join(save_path, spectra.spectra_file),
+    }
+
+
+def run_conversion(save_path, start_number, fasta_sequence, version=2, assign=False, clean=False,
+                   workers=None, progress=None, calibrate=False, incremental=False, symmetry=False,
+                   compress=None):
+    """Convert one working directory (13C.csv, 15N.csv or the spectra of spectra.json, attrib.csv) for cyana.
+
+    With assign, the peaks get candidate assignments from the final .prot.
+    With clean, the diagonal and near-duplicate peaks are left out and
+    listed in 13C_cleanup.csv and 15N_cleanup.csv.
+    With calibrate, the NOESY volumes are calibrated to upper distance
+    limits in 13C.upl and 15N.upl (see calibration).
+    With incremental, the .peaks files are updated in place from their last
+    conversion, only the changed peaks are rewritten (see peak_index).
+    With symmetry, the NOESY peaks with a symmetry partner in the other
+    NOESY get the colour code 2 (confirmed), the others 1 (see symmetry).
+    With compress ('.gz' or '.zst'), the .peaks and the .prot are written
+    compressed (a compressed .peaks is never updated incrementally).
+    workers: processes converting the spectra (see to_xeasy.convert_spectra).
+    progress: metrics.Progress getting the rows processed by every stage,
+    progress.cancel() stops the conversion (result['cancelled']), the outputs
+    of the previous conversion are left as they were.
+    """
+    message = check_inputs(save_path, start_number, fasta_sequence, version, compress)
+    if message:
+        return {'ok': False, 'error': message, 'stages': []}
+
+    stages = conversion_stages(save_path, int(start_number), fasta_sequence, int(version), assign, clean,
+                               workers, progress, calibrate, incremental, symmetry, compress)
+    results = run_stages(stages, progress=progress)
+
+    errors = [f"{s['name']}: {s['error']}" for s in results if not s['ok']]
+    return {'ok': not errors, 'error': "\n".join(errors) or None, 'stages': results,
+            'cancelled': progress is not None and progress.cancelled}
+
+
+def conversion_stages(save_path, start_num, fasta_sequence, version, assign=False, clean=False,
+                      workers=None, progress=None, calibrate=False, incremental=False, symmetry=False,
+                      compress=None):
+    """Stages converting one working directory."""
+    paths = project_paths(save_path, compress)
+
+    stats = {name: metrics.new_stats() for name in ('fasta_to_seq', 'to_xeasy', 'file_to_prot', 'calibrate')}
+
+    def seq_stage():
+        metrics.report(progress, 'fasta_to_seq', 0, len(fasta_sequence))
+        converted_seq = fasta_to_seq.convert_sequence(fasta_sequence)
+        fasta_to_seq.write_to_file(converted_seq, paths['seq'], start_num, stats=stats['fasta_to_seq'])
+        metrics.report(progress, 'fasta_to_seq', len(fasta_sequence), len(fasta_sequence))
+
+    # 13C and 15N NOESY, or the spectra listed in spectra.json
+    spectrum_list = spectra.project_spectra(save_path, compress)
+
+    def xeasy_stage():
+        to_xeasy.convert_spectra(spectrum_list, version, stats=stats['to_xeasy'],
+                                 shifts=paths['prot'] if assign else None, clean=clean,
+                                 workers=workers, progress=progress, incremental=incremental)
+        if symmetry:
+            # the colour codes are set in the .peaks just written
+            import symmetry as symmetry_check
+            symmetry_check.check_spectra(spectrum_list, stats=stats['to_xeasy'], progress=progress)
+
+    def prot_stage():
+        file_to_prot.lunch_all(paths['attrib'], paths['seq'], save_path, paths['prot'],
+                               stats=stats['file_to_prot'], progress=progress)
+
+    xeasy_inputs = [spectrum.csv for spectrum in spectrum_list]
+    if os.path.exists(paths['spectra']):
+        xeasy_inputs.append(paths['spectra'])
+    if assign:
+        # the assignment needs the shifts, to_xeasy then waits for file_to_prot
+        xeasy_inputs.append(paths['prot'])
+    xeasy_outputs = [spectrum.peaks for spectrum in spectrum_list]
+    if clean:
+        xeasy_outputs += [spectrum.cleanup_report for spectrum in spectrum_list]
+    if symmetry:
+        xeasy_outputs += [spectrum.symmetry_report for spectrum in spectrum_list if spectrum.proton_pair]
+
+    # declare what every stage reads and writes
+    stages = [
+        Stage('fasta_to_seq', seq_stage, outputs=[paths['seq']], stats=stats['fasta_to_seq']),
+        Stage('to_xeasy', xeasy_stage,
+              inputs=xeasy_inputs,
+              outputs=xeasy_outputs,
+              stats=stats['to_xeasy']),
+        Stage('file_to_prot', prot_stage,
+              inputs=[paths['attrib'], paths['seq'], monentlature.lib],
+              outputs=[paths['prot'], paths['outliers']],
+              stats=stats['file_to_prot']),
+    ]
+    if calibrate:
+        def calibrate_stage():
+            import calibration
+            calibration.calibrate_spectra(spectrum_list, paths['prot'], paths['seq'],
+                                          stats=stats['calibrate'], progress=progress)
+
+        noesys = spectra.noesy_spectra(spectrum_list)
+        stages.append(Stage('calibrate', calibrate_stage,
+                            # the written peaks: cleaned, with the numbers of the .peaks
+                            inputs=[spectrum.peaks for spectrum in noesys] + [paths['prot'], paths['seq']],
+                            outputs=[spectrum.upl for spectrum in noesys],
+                            stats=stats['calibrate']))
+    return stages
+
+
+def run_nef_conversion(nef_file, save_path, version=2, clean=False):
+    """Convert a NEF project file (sequence, shifts and peak lists) for cyana."""
+    if not os.path.isfile(nef_file):
+        return {'ok': False, 'error': "Invalid NEF file!", 'stages': []}
+    if not os.path.isdir(save_path):
+        return {'ok': False, 'error': "Invalid save directory!", 'stages': []}
+    if str(version) not in ('2', '3'):
+        return {'ok': False, 'error': "Invalid Cyana version! Must be 2 or 3.", 'stages': []}
+
+    results = run_stages(nef_stages(nef_file, save_path, int(version), clean))
+    errors = [f"{s['name']}: {s['error']}" for s in results if not s['ok']]
+    return {'ok': not errors, 'error': "\n".join(errors) or None, 'stages': results}
+
+
+def nef_stages(nef_file, save_path, version, clean=False):
+    """Stages converting a NEF file: one pass writing prot.seq and the peaks, then the .prot."""
+    import nef_reader
+    paths = project_paths(save_path)
+    stats = {name: metrics.new_stats() for name in ('read_nef', 'file_to_prot')}
+    # shift table handed from the reading pass to file_to_prot
+    shifts = {}
+
+    def nef_stage():
+        shifts['table'], _ = nef_reader.convert_nef(nef_file, save_path, version, clean=clean,
+                                                    stats=stats['read_nef'])
+
+    def prot_stage():
+        file_to_prot.lunch_all(shifts['table'], paths['seq'], save_path, paths['prot'],
+                               stats=stats['file_to_prot'])
+
+    # the .peaks (and cleanup reports) named after the spectra of the file
+    nef_outputs = nef_reader.output_files(nef_file, save_path, clean) if os.path.isfile(nef_file) else []
+
+    return [
+        Stage('read_nef', nef_stage, inputs=[nef_file], outputs=[paths['seq']] + nef_outputs,
+              stats=stats['read_nef']),
+        Stage('file_to_prot', prot_stage,
+              inputs=[paths['seq'], monentlature.lib],
+              outputs=[paths['prot'], paths['outliers']],
+              stats=stats['file_to_prot']),
+    ]
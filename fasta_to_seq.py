@@ -1,5 +1,28 @@
-import sys
+import argparse
+import csv
 import os
+import re
+import sys
+
+from fileutils import compression_of, open_file, replace_file, tmp_suffix
+
+'''
+One-letter protein sequences to cyana .seq files (three-letter code and
+residue number, one residue per line).
+
+python fasta_to_seq.py 43 APEKKVLF... prot.seq
+python fasta_to_seq.py constructs.fasta OUTDIR [--start 1] [--starts starts.csv] [--chains offset|split]
+
+A FASTA file is read in a single pass, line by line: every record is written
+to OUTDIR/<name>.seq while it is read, so files with thousands of records
+(mutants, truncations) never sit in memory. The start number of a record is
+taken from starts.csv (name,start), else from a start=N in its header line
+(">L45A start=43"), else from --start.
+
+Chains are separated by '/' or ':' in the sequence. With --chains offset
+they stay in one .seq, chain k numbered from start + k * 1000; with
+--chains split every chain gets its own <name>_A.seq, <name>_B.seq ...
+'''
 
 # Dico aa conversion 1 letter to 3 letters
 one_to_three = {
@@ -9,25 +32,188 @@ one_to_three = {
     'S': 'Ser', 'T': 'Thr', 'W': 'Trp', 'Y': 'Tyr', 'V': 'Val'
 }
 
+chain_separators = '/:'
+# residue numbers of chain k start at start + k * chain_offset
+chain_offset = 1000
+chain_modes = ('offset', 'split')
+
 def convert_sequence(seq):
     """Converts the one-letter sequence to three-letter amino acid codes."""
     converted_seq = [one_to_three[aa.upper()] for aa in seq]
     return converted_seq
 
-def write_to_file(seq_list, output_file, start_number):
+def write_to_file(seq_list, output_file, start_number, stats=None):
     """Writes the converted sequence to a file with the sequence and its corresponding index."""
-    with open(output_file, 'w') as file:
-        for i, aa in enumerate(seq_list):
-            file.write(f"{aa}\t{start_number + i}\n")
+    write_residues([(aa, start_number + i) for i, aa in enumerate(seq_list)], output_file, stats)
+
+def write_residues(residues, output_file, stats=None):
+    """Writes (three-letter code, residue number) pairs, one residue per line."""
+    with replace_file(output_file) as file:
+        for aa, number in residues:
+            file.write(f"{aa}\t{number}\n")
+    if stats is not None:
+        stats['rows_read'] += len(residues)
+        stats['rows_written'] += len(residues)
+
+def record_name(header):
+    """File name of a record: first word of its header line, safe for the file system."""
+    words = header[1:].split()
+    return re.sub(r'[^A-Za-z0-9._-]', '_', words[0]) if words else 'record'
+
+def header_start(header):
+    """start=N of a header line, None without it."""
+    found = re.search(r'\bstart=(-?\d+)', header)
+    return int(found.group(1)) if found else None
+
+def read_starts(csv_file):
+    """{record name: start number} of a name,start CSV (a header line is allowed)."""
+    starts = {}
+    with open_file(csv_file, 'r', newline='') as f:
+        for row in csv.reader(f):
+            if len(row) >= 2 and row[1].strip().lstrip('-').isdigit():
+                starts[row[0].strip()] = int(row[1])
+    return starts
+
+class SeqWriter:
+    """Writes the residues of the record being read, one chain after the other."""
+
+    def __init__(self, output_dir, name, start, chains, stats=None):
+        self.output_dir = output_dir
+        self.name = name
+        self.start = start
+        self.chains = chains
+        self.stats = stats
+        self.paths = []
+        self.chain = -1
+        self.file = None
+        self.next_chain()
+
+    def next_chain(self):
+        self.chain += 1
+        if self.chains == 'split' or self.file is None:
+            self.close()
+            suffix = f"_{chr(ord('A') + self.chain)}" if self.chains == 'split' else ''
+            self.paths.append(os.path.join(self.output_dir, f"{self.name}{suffix}.seq"))
+            # written next to its place, renamed once the chain is complete
+            self.file = open_file(self.paths[-1] + tmp_suffix, 'w', compression=compression_of(self.paths[-1], 'w'))
+        offset = chain_offset * self.chain if self.chains == 'offset' else 0
+        self.number = self.start + offset
+
+    def write(self, letters, line_number):
+        lines = []
+        for aa in letters:
+            try:
+                lines.append(f"{one_to_three[aa.upper()]}\t{self.number}\n")
+            except KeyError:
+                raise ValueError(f"{self.name}, line {line_number}: unknown amino acid {aa!r}") from None
+            self.number += 1
+        self.file.write(''.join(lines))
+        if self.stats is not None:
+            self.stats['rows_read'] += len(lines)
+            self.stats['rows_written'] += len(lines)
+
+    def close(self, complete=True):
+        """Close the file being written: renamed to its place when complete, removed otherwise."""
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+            if complete:
+                os.replace(self.paths[-1] + tmp_suffix, self.paths[-1])
+            else:
+                os.remove(self.paths[-1] + tmp_suffix)
+
+    def finish(self):
+        """Close the record, a record with a single chain keeps the plain <name>.seq."""
+        self.close()
+        if self.chains == 'split' and len(self.paths) == 1:
+            plain = os.path.join(self.output_dir, f"{self.name}.seq")
+            os.replace(self.paths[0], plain)
+            self.paths = [plain]
+        return self.paths
+
+def convert_fasta(fasta_file, output_dir, start_number=1, starts=None, chains='offset', stats=None):
+    """Write the .seq files of every record of a FASTA file, return their paths.
+
+    starts: {record name: start number}, before the start=N of the header
+    and start_number.
+    """
+    if chains not in chain_modes:
+        raise ValueError(f"Unknown chain mode {chains}, must be one of {', '.join(chain_modes)}")
+    starts = starts or {}
+    os.makedirs(output_dir, exist_ok=True)
+    paths = []
+    used = set()
+    writer = None
+    try:
+        with open_file(fasta_file, 'r') as f:
+            for line_number, line in enumerate(f, 1):
+                line = line.strip()
+                if not line or line.startswith(';'):
+                    continue
+                if line.startswith('>'):
+                    if writer is not None:
+                        paths += writer.finish()
+                    name = record_name(line)
+                    if name in used:
+                        # same name twice, keep both records
+                        name = next(f"{name}_{i}" for i in range(2, len(used) + 3) if f"{name}_{i}" not in used)
+                    used.add(name)
+                    start = starts.get(name, header_start(line))
+                    writer = SeqWriter(output_dir, name, start_number if start is None else start, chains, stats)
+                    continue
+                if writer is None:
+                    raise ValueError(f"{fasta_file}, line {line_number}: sequence before the first '>' header")
+                segments = re.split(f"[{re.escape(chain_separators)}]", line.replace(' ', '').rstrip('*'))
+                for i, segment in enumerate(segments):
+                    if i:
+                        writer.next_chain()
+                    writer.write(segment, line_number)
+        if writer is not None:
+            paths += writer.finish()
+    finally:
+        if writer is not None:
+            writer.close(complete=False)
+    return paths
+
+def first_record(fasta_file):
+    """One-letter sequence of the first record of a FASTA file (the chains joined).
+
+    A record with a header only is passed over.
+    """
+    letters = []
+    with open_file(fasta_file, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith('>'):
+                if letters:
+                    break
+                continue
+            if line and not line.startswith(';'):
+                letters.append(re.sub(f"[\\s*{re.escape(chain_separators)}]", '', line))
+    return ''.join(letters)
 
 def main():
-    start_number = sys.argv[1]
-    fasta_sequence = sys.argv[2]
-    output_file = sys.argv[3]
-    
-    start_num = int(start_number)
-    converted_seq = convert_sequence(fasta_sequence)
-    write_to_file(converted_seq, output_file, start_num)
+    if len(sys.argv) == 4 and sys.argv[1].lstrip('-').isdigit():
+        # one sequence: START SEQUENCE OUTPUT
+        start_number = sys.argv[1]
+        fasta_sequence = sys.argv[2]
+        output_file = sys.argv[3]
+
+        start_num = int(start_number)
+        converted_seq = convert_sequence(fasta_sequence)
+        write_to_file(converted_seq, output_file, start_num)
+        return
+
+    parser = argparse.ArgumentParser(description="Write one cyana .seq per record of a FASTA file")
+    parser.add_argument('fasta_file')
+    parser.add_argument('output_dir')
+    parser.add_argument('--start', type=int, default=1, help="start number of the records without one")
+    parser.add_argument('--starts', help="CSV of name,start per record")
+    parser.add_argument('--chains', choices=chain_modes, default='offset')
+    args = parser.parse_args()
+    starts = read_starts(args.starts) if args.starts else None
+    paths = convert_fasta(args.fasta_file, args.output_dir, args.start, starts, args.chains)
+    print(f"{len(paths)} .seq files written in {args.output_dir}")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -1,25 +1,21 @@
 #!/usr/bin/python3
-import pandas as pd
+import csv
 import os
+import re
 import sys
 import monentlature
+import metrics
+import model
+import shift_screen
+from fileutils import na_values, parse_float, format_float, compression_of, open_file, replace_file
+# numpy and pandas are imported by the functions using them, the csv fast
+# path (light_prot) does without them
 
 
 def read_prot_seq(filepath):
-    """Read prot.seq file and create a residue mapping dictionary."""
-    residue_map = {}
+    """Residue mapping {SequenceCode: residue type} of a prot.seq (a model.SequenceTable)."""
     try:
-        with open(filepath, 'r') as file:
-            content = file.read()
-        
-        for line in content.strip().split('\n'):
-            if line.strip():
-                parts = line.split()
-                if len(parts) >= 2:
-                    residue, seq_code = parts[0].upper(), parts[1]
-                    residue_map[seq_code] = residue
-        return residue_map
-    
+        return model.load_sequence(filepath)
     except FileNotFoundError:
         print(f"Warning: {filepath} not found. Proceeding without residue mapping.")
         return {}
@@ -27,6 +23,10 @@ def read_prot_seq(filepath):
         print(f"Error reading {filepath}: {e}")
         return {}
 
+# Throughput target of the vectorized cleanup, in assignment rows per second.
+# The python functions run once per distinct value, not once per row.
+throughput_target = 1000000
+
 def transform_sequence_code(code):
     """Transform SequenceCode by decrementing if it contains '-1'."""
     code_str = str(code)
@@ -38,22 +38,66 @@ def transform_sequence_code(code):
             return code_str
     return code_str
 
+def apply_on_uniques(values, func):
+    """Apply func once per distinct value of a column and broadcast the result."""
+    import numpy as np
+    import pandas as pd
+    codes, uniques = pd.factorize(values)
+    results = np.empty(len(uniques), dtype=object)
+    results[:] = [func(value) for value in uniques]
+    output = np.empty(len(values), dtype=object)
+    found = codes >= 0
+    output[found] = results[codes[found]]
+    # missing values (None, NaN) are few, keep them one by one as they differ
+    output[~found] = [func(value) for value in values.to_numpy()[~found]]
+    return pd.Series(output, index=values.index, dtype=object)
+
+def transform_sequence_codes(codes):
+    """Vectorized transform_sequence_code over a whole SequenceCode column."""
+    return apply_on_uniques(codes, transform_sequence_code)
+
 def update_residue_type(row, residue_map):
     """Update ResidueType with uppercase three-letter code from residue_map if None."""
+    import pandas as pd
     if pd.isna(row['ResidueType']) or str(row['ResidueType']).lower() in ['none', 'nan']:
         seq_code = str(row['SequenceCode'])
         return residue_map.get(seq_code, row['ResidueType'])
     return str(row['ResidueType']).upper()
 
-def process_protein_data(input_csv, prot_seq_filepath, output_csv):
-    """Process protein NMR data with deduplication and residue mapping."""
+def update_residue_types(df, residue_map):
+    """Vectorized update_residue_type over the whole table."""
+    import pandas as pd
+    residue_type = df['ResidueType']
+    missing = apply_on_uniques(residue_type, lambda value: pd.isna(value) or str(value).lower() in ['none', 'nan']).astype(bool)
+    result = apply_on_uniques(residue_type, lambda value: str(value).upper())
+    if missing.any():
+        mapped = apply_on_uniques(df['SequenceCode'][missing], lambda code: residue_map.get(str(code)))
+        # keep the original value when the residue is not in prot.seq
+        result[missing] = mapped.where(mapped.notna(), residue_type[missing])
+    return result
+
+def process_protein_data(input_csv, prot_seq_filepath, output_csv=None, residue_map=None, stats=None,
+                         outliers=None):
+    """Process protein NMR data with deduplication and residue mapping.
+
+    The cleaned table is only saved when output_csv is given. The flagged
+    shifts (see shift_screen) are added to the list outliers.
+    """
+    import pandas as pd
 
     
     # Read the prot.seq file
-    residue_map = read_prot_seq(prot_seq_filepath)
+    if residue_map is None:
+        residue_map = read_prot_seq(prot_seq_filepath)
     
-    # Read the CSV file
-    df = pd.read_csv(input_csv)
+    # Read the CSV file (or take a copy of an already loaded table)
+    if isinstance(input_csv, pd.DataFrame):
+        df = input_csv.copy()
+    else:
+        df = pd.read_csv(input_csv, float_precision='round_trip', compression=compression_of(input_csv))
+    
+    if stats is not None:
+        stats['rows_read'] += len(df)
     
     # Clean column names (remove newlines and extra spaces)
     df.columns = df.columns.str.replace('\n', ' ').str.strip()
@@ -63,12 +107,13 @@ def process_protein_data(input_csv, prot_seq_filepath, output_csv):
         initial_rows = len(df)
         df = df[(df['Total Peak Count'] != 0) & (pd.notna(df['Total Peak Count']))]
         filtered_rows = len(df)
+        metrics.add_filtered(stats, 'Total Peak Count', initial_rows - filtered_rows)
     
     # Transform SequenceCode
-    df['SequenceCode'] = df['SequenceCode'].apply(transform_sequence_code)
+    df['SequenceCode'] = transform_sequence_codes(df['SequenceCode'])
     
     # Update ResidueType with uppercase three-letter codes
-    df['ResidueType'] = df.apply(lambda row: update_residue_type(row, residue_map), axis=1)
+    df['ResidueType'] = update_residue_types(df, residue_map)
     
     # Convert columns to numeric
     numeric_columns = ['Value (ppm)', 'Value Error (ppm)', 'Total Peak Count', 'uniqueId']
@@ -76,7 +121,6 @@ def process_protein_data(input_csv, prot_seq_filepath, output_csv):
     for col in numeric_columns:
         if col in df.columns:
             df[col] = pd.to_numeric(df[col], errors='coerce')
-            nan_count = df[col].isnull().sum()
     
     
     # Group by SequenceCode and AtomName
@@ -87,7 +131,18 @@ def process_protein_data(input_csv, prot_seq_filepath, output_csv):
         'uniqueId': 'min',
         'Total Peak Count': 'sum'
     }).reset_index()
-    
+
+    if outliers is not None:
+        # spread of the merged values; the -1 codes do not go into the .prot
+        merged = df.groupby(['SequenceCode', 'AtomName'])['Value (ppm)']
+        spreads = (merged.max() - merged.min()).fillna(0.0).to_numpy()
+        kept = ~df_grouped['SequenceCode'].astype(str).str.contains('-1', regex=False).to_numpy()
+        # integer codes of the residues and atoms, scored with NumPy
+        residue, residue_names = pd.factorize(df_grouped['SequenceCode'][kept])
+        atom, atom_names = pd.factorize(df_grouped['AtomName'][kept])
+        outliers += shift_screen.screen_table(
+            residue, residue_names.tolist(), atom, atom_names.tolist(),
+            df_grouped['Value (ppm)'][kept].to_numpy(), spreads[kept], residue_map, stats=stats)
     
     # Ensure output column names match the desired structure
     column_order = ['uniqueId', 'Value (ppm)', 'Value Error (ppm)', 
@@ -101,25 +156,31 @@ def process_protein_data(input_csv, prot_seq_filepath, output_csv):
     
     df_final = df_grouped[column_order]
     
-    # Create output directory if it doesn't exist
-    output_dir = os.path.dirname(output_csv)
-    if output_dir and not os.path.exists(output_dir):
-        os.makedirs(output_dir)
-    
-    # Save the modified file
-    df_final.to_csv(output_csv, index=False)
+    if output_csv:
+        # Create output directory if it doesn't exist
+        output_dir = os.path.dirname(output_csv)
+        if output_dir and not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+        
+        # Save the modified file
+        df_final.to_csv(output_csv, index=False)
     
     # Summary statistics
     original_rows = len(df)
     final_rows = len(df_final)
     duplicates_removed = original_rows - final_rows
+    metrics.add_filtered(stats, 'merged duplicates', duplicates_removed)
     
 
     
     return df_final
 
-def additional_processing(df, output_file):
-    """Additional processing step to prepare final output files."""
+def additional_processing(df, output_file=None, stats=None):
+    """Additional processing step to prepare final output files.
+
+    attib_cyana.prot (untranslated atom names) is only saved in output_file
+    when a directory is given.
+    """
     
     # Create a copy for processing
     data_zero = df.copy()
@@ -133,8 +194,9 @@ def additional_processing(df, output_file):
 
     # Remove all attributions with -1 (duplicates)
     initial_rows = len(data_columns)
-    data_columns = data_columns[~data_columns['SequenceCode'].astype(str).str.contains('-1')]
+    data_columns = data_columns[~data_columns['SequenceCode'].astype(str).str.contains('-1', regex=False)]
     filtered_rows = len(data_columns)
+    metrics.add_filtered(stats, '-1 codes', initial_rows - filtered_rows)
     
     # Create a new column with incremental numbers, beginning by 1
     data_columns.insert(0, 'Index', range(1, len(data_columns) + 1))
@@ -163,34 +225,214 @@ def additional_processing(df, output_file):
     data_columns = data_columns.replace("None", 0)
     data_columns = data_columns.replace("none", 0)
     
-    # Create output directory if it doesn't exist
-    if not os.path.exists(output_file):
-        os.makedirs(output_file)
-    
-    # Save the file as .prot format with tab separation
-    prot_file_path = os.path.join(output_file, 'attib_cyana.prot')
-    data_columns.to_csv(prot_file_path, sep='\t', index=False)
+    if output_file:
+        # Create output directory if it doesn't exist
+        if not os.path.exists(output_file):
+            os.makedirs(output_file)
+        
+        # Save the file as .prot format with tab separation
+        prot_file_path = os.path.join(output_file, 'attib_cyana.prot')
+        data_columns.to_csv(prot_file_path, sep='\t', index=False)
     
     return data_columns
 
 
-def lunch_all (input_csv, prot_seq_file,output_directory, output_csv='attib_cyana.prot'):
+def translate_prot(data_columns, residue_map, lib=monentlature.lib):
+    """Replace the CCPN atom names by the cyana ones, in memory."""
+    residues = [residue_map.get(code) for code in data_columns['SequenceCode'].astype(str)]
+    table = monentlature.load_table(lib)
+    translated = data_columns.copy()
+    translated['AtomName'] = monentlature.translate_atoms(residues, data_columns['AtomName'], table)
+    # an empty field would shift the columns read by cyana
+    if 'Value Error\n(ppm)' in translated.columns:
+        translated['Value Error\n(ppm)'] = translated['Value Error\n(ppm)'].fillna(0.0)
+    return translated
+
+def write_prot(data_columns, output_csv):
+    """Single buffered write of the final cyana .prot file."""
+    output_dir = os.path.dirname(output_csv)
+    if output_dir and not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    with replace_file(output_csv, buffering=1 << 20) as f:
+        data_columns.to_csv(f, sep='\t', index=False)
+
+# header of the .prot as pandas writes it (the column names hold a newline)
+prot_header = 'Index\t"Value\n(ppm)"\t"Value Error\n(ppm)"\tAtomName\tSequenceCode\n'
+
+def code_texts(values):
+    """SequenceCode column as pandas reads then prints it (int column, or text with 'nan')."""
+    missing = [value in na_values for value in values]
+    if not any(missing) and all(re.fullmatch(r'\s*[-+]?\d+\s*', value) for value in values):
+        return [str(int(value)) for value in values]
+    texts = []
+    numeric = True
+    for value, absent in zip(values, missing):
+        texts.append('nan' if absent else value)
+        if numeric and not absent:
+            try:
+                float(value)
+            except ValueError:
+                numeric = False
+    if numeric:
+        raise ValueError("float SequenceCode column")
+    return texts
+
+def kahan_add(total, value):
+    """Add value to [sum, compensation, count], the summation of pandas groupby mean."""
+    if value != value:
+        return
+    total[2] += 1
+    y = value - total[1]
+    t = total[0] + y
+    total[1] = t - total[0] - y
+    if total[1] != total[1]:
+        total[1] = 0.0
+    total[0] = t
+
+def kahan_mean(total):
+    return total[0] / total[2] if total[2] else float('nan')
+
+def light_prot(input_csv, residue_map, lib=monentlature.lib, stats=None, outliers=None):
+    """attrib.csv -> rows of the final .prot, with the csv module only.
+
+    Same steps as process_protein_data, additional_processing and
+    translate_prot, without loading numpy and pandas. Raises ValueError on
+    exports needing pandas' type inference (text counts, float codes ...).
+    The flagged shifts (see shift_screen) are added to the list outliers.
+    """
+    with open_file(input_csv, 'r', newline='') as f:
+        reader = csv.reader(f)
+        header = [name.replace('\n', ' ').strip() for name in next(reader)]
+        rows = [row for row in reader if row]
+    position = {name: i for i, name in enumerate(header)}
+    for name in ('Value (ppm)', 'Value Error (ppm)', 'SequenceCode', 'AtomName', 'Total Peak Count'):
+        if name not in position:
+            raise ValueError(f"no {name} column")
+
+    def column(name):
+        i = position[name]
+        return [row[i] if i < len(row) else '' for row in rows]
+
+    if stats is not None:
+        stats['rows_read'] += len(rows)
+    counts = [parse_float(value) for value in column('Total Peak Count')]
+    keep = [i for i, count in enumerate(counts) if count == count and count != 0]
+    metrics.add_filtered(stats, 'Total Peak Count', len(rows) - len(keep))
+
+    codes = code_texts(column('SequenceCode'))
+    transformed = {code: transform_sequence_code(code) for code in set(codes[i] for i in keep)}
+    values = column('Value (ppm)')
+    errors = column('Value Error (ppm)')
+    atoms = column('AtomName')
+
+    def number(text):
+        try:
+            return parse_float(text)
+        except ValueError:
+            return float('nan')
+
+    # group by SequenceCode and AtomName, mean of the values
+    groups = {}
+    for i in keep:
+        if atoms[i] in na_values:
+            continue
+        totals = groups.setdefault((transformed[codes[i]], atoms[i]), ([0.0, 0.0, 0], [0.0, 0.0, 0], []))
+        value = number(values[i])
+        kahan_add(totals[0], value)
+        kahan_add(totals[1], number(errors[i]))
+        if value == value:
+            totals[2].append(value)
+    metrics.add_filtered(stats, 'merged duplicates', len(keep) - len(groups))
+
+    # remove all attributions with -1 (duplicates)
+    keys = [key for key in sorted(groups) if '-1' not in key[0]]
+    metrics.add_filtered(stats, '-1 codes', len(groups) - len(keys))
+
+    if outliers is not None:
+        outliers += shift_screen.screen_shifts(
+            [code for code, _ in keys], [atom for _, atom in keys], [kahan_mean(groups[key][0]) for key in keys],
+            [max(groups[key][2]) - min(groups[key][2]) if groups[key][2] else 0.0 for key in keys],
+            residue_map, stats=stats)
+
+    table = monentlature.load_table(lib)
+    names = monentlature.translate_atoms([residue_map.get(code) for code, _ in keys],
+                                         [atom for _, atom in keys], table)
+    result = []
+    for index, ((code, _), name) in enumerate(zip(keys, names), 1):
+        if any(c in text for text in (code, name) for c in '\t"\r\n'):
+            raise ValueError("field to quote")
+        error = kahan_mean(groups[(code, _)][1])
+        # an empty field would shift the columns read by cyana
+        result.append((index, kahan_mean(groups[(code, _)][0]), 0.0 if error != error else error, name, code))
+    return result
+
+def write_prot_rows(rows, output_csv):
+    """Single buffered write of .prot rows (Index, value, error, atom, SequenceCode)."""
+    output_dir = os.path.dirname(output_csv)
+    if output_dir and not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    with replace_file(output_csv, buffering=1 << 20) as f:
+        f.write(prot_header)
+        f.write(''.join(f"{index}\t{format_float(value)}\t{format_float(error)}\t{name}\t{code}\n"
+                        for index, value, error, name, code in rows))
+
+def lunch_all (input_csv, prot_seq_file,output_directory, output_csv='attib_cyana.prot', stats=None, light=True,
+               progress=None, screen=True):
+    """attrib.csv -> cleaned table -> cyana names -> .prot, written once.
+
+    A CSV file goes through the csv fast path (light_prot) and the rows are
+    returned; a DataFrame, or an export the fast path cannot read, through
+    pandas and the final DataFrame is returned.
+    progress: metrics.Progress, gets the shifts ready to write.
+    With screen, the shifts far from the reference statistics of their atom
+    are listed in shift_outliers.csv of output_directory (see shift_screen).
+    """
+    metrics.report(progress, 'file_to_prot', 0)
+    residue_map = read_prot_seq(prot_seq_file)
+    if not os.path.isabs(output_csv) and not os.path.dirname(output_csv):
+        # a bare file name goes into the output directory
+        output_csv = os.path.join(output_directory, output_csv)
+
+    outliers = [] if screen else None
+    if light and isinstance(input_csv, str):
+        light_stats = metrics.new_stats()
+        try:
+            rows = light_prot(input_csv, residue_map, stats=light_stats, outliers=outliers)
+        except ValueError:
+            rows = None
+            outliers = [] if screen else None
+        if rows is not None:
+            metrics.report(progress, 'file_to_prot', len(rows), len(rows))
+            write_prot_rows(rows, output_csv)
+            # the next stages (assignment, calibration) take the shifts from memory
+            model.share('shifts', output_csv, model.ShiftTable.from_rows(rows))
+            if screen:
+                shift_screen.write_report(outliers, os.path.join(output_directory, shift_screen.report_name))
+            if stats is not None:
+                metrics.add_stats(stats, light_stats)
+                stats['rows_written'] += len(rows)
+            return rows
+
     # Process the data
-    result = process_protein_data(input_csv, prot_seq_file, output_csv)
+    result = process_protein_data(input_csv, prot_seq_file, residue_map=residue_map, stats=stats,
+                                  outliers=outliers)
 
     if result is not None:
 
         # Additional processing
-        final_result = additional_processing(result, output_directory)
+        final_result = additional_processing(result, stats=stats)
 
         if final_result is not None:
 
-            seq_file = prot_seq_file
-            name_prot_file = os.path.join(output_directory, 'attib_cyana.prot')
-            output_cya_file = output_csv
-
-            trad = monentlature.nomenclature(seq=seq_file, prot=name_prot_file, output_file=output_directory)
-            monentlature.file_transforme(trad, prot=name_prot_file, output_file=output_cya_file)
+            final_result = translate_prot(final_result, residue_map)
+            metrics.report(progress, 'file_to_prot', len(final_result), len(final_result))
+            write_prot(final_result, output_csv)
+            model.share('shifts', output_csv, model.ShiftTable.from_frame(final_result))
+            if screen:
+                shift_screen.write_report(outliers, os.path.join(output_directory, shift_screen.report_name))
+            if stats is not None:
+                stats['rows_written'] += len(final_result)
+            return final_result
 
 
 def main():
@@ -1,33 +1,47 @@
 import sys
-import os
-import subprocess
 from PyQt6.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout, 
                              QLabel, QLineEdit, QPushButton, QRadioButton, QFileDialog, 
-                             QProgressBar, QMessageBox)
+                             QProgressBar, QMessageBox, QCheckBox)
 from PyQt6.QtCore import Qt, QThread, pyqtSignal
 
-class ScriptThread(QThread):
-    """Thread to run the external Python script."""
-    finished = pyqtSignal(str)  # Signal to send completion message
-    error = pyqtSignal(str)     # Signal to send error message
+import engine
+import fasta_to_seq
+import metrics
 
-    def __init__(self, script_path, args):
+class ConversionThread(QThread):
+    """Thread to run the in-process conversion engine."""
+    finished = pyqtSignal(object)  # Signal to send the conversion result
+    error = pyqtSignal(str)        # Signal to send error message
+    progress = pyqtSignal(str, object, object)  # stage, rows done, rows in total (None if unknown)
+
+    def __init__(self, save_path, start_number, fasta_sequence, version, assign=False, clean=False,
+                 calibrate=False, incremental=False, symmetry=False, compress=None):
         super().__init__()
-        self.script_path = script_path
-        self.args = args
+        self.save_path = save_path
+        self.start_number = start_number
+        self.fasta_sequence = fasta_sequence
+        self.version = version
+        self.assign = assign
+        self.clean = clean
+        self.calibrate = calibrate
+        self.incremental = incremental
+        self.symmetry = symmetry
+        self.compress = compress
+        # reports of the stages, emitted from the stage threads
+        self.tracker = metrics.Progress(self.progress.emit)
+
+    def cancel(self):
+        """Stop the conversion at the next progress report of every stage."""
+        self.tracker.cancel()
 
     def run(self):
         try:
-            # Run the external script with arguments
-            result = subprocess.run(
-                [sys.executable, self.script_path] + self.args,
-                capture_output=True,
-                text=True,
-                check=True
-            )
-            self.finished.emit("Processing complete! Output: " + result.stdout)
-        except subprocess.CalledProcessError as e:
-            self.error.emit(f"Script error: {e.stderr}")
+            result = engine.run_conversion(self.save_path, self.start_number,
+                                           self.fasta_sequence, self.version, self.assign,
+                                           self.clean, progress=self.tracker,
+                                           calibrate=self.calibrate, incremental=self.incremental,
+                                           symmetry=self.symmetry, compress=self.compress)
+            self.finished.emit(result)
         except Exception as e:
             self.error.emit(f"Error: {str(e)}")
 
@@ -35,7 +49,7 @@ class CycyApp(QMainWindow):
     def __init__(self):
         super().__init__()
         self.setWindowTitle("CCPNMR to Cyana")
-        self.setFixedSize(450, 550)
+        self.setFixedSize(450, 730)
 
         # Main widget and layout
         self.central_widget = QWidget()
@@ -92,6 +106,13 @@ class CycyApp(QMainWindow):
         self.main_layout.addWidget(self.progress)
         self.progress.hide()
 
+        # Per-stage breakdown of the last conversion
+        self.metrics_label = QLabel("")
+        self.metrics_label.setStyleSheet("font: 9pt 'Consolas', 'Courier New', monospace; color: #A78BFA;")
+        self.metrics_label.setWordWrap(True)
+        self.main_layout.addWidget(self.metrics_label)
+        self.metrics_label.hide()
+
         # Input section
         self.number_input = QLineEdit()
         self.number_input.setPlaceholderText("1")
@@ -101,7 +122,13 @@ class CycyApp(QMainWindow):
         self.fasta_input = QLineEdit()
         self.fasta_input.setPlaceholderText("APEKKVLFWYDPMKPDTKFDKPGKSPFMDMDLVPKYADESG")
         self.main_layout.addWidget(QLabel("Enter protein sequence:"))
-        self.main_layout.addWidget(self.fasta_input)
+        sequence_layout = QHBoxLayout()
+        sequence_layout.addWidget(self.fasta_input)
+        # long sequences: first record of a FASTA file
+        fasta_btn = QPushButton("Load FASTA")
+        fasta_btn.clicked.connect(self.load_fasta)
+        sequence_layout.addWidget(fasta_btn)
+        self.main_layout.addLayout(sequence_layout)
 
         self.save_input = QLineEdit()
         self.save_input.setPlaceholderText("Select working directory")
@@ -121,10 +148,46 @@ class CycyApp(QMainWindow):
         version_layout.addWidget(self.version_3)
         self.main_layout.addLayout(version_layout)
 
-        # Launch button
-        launch_btn = QPushButton("Launch")
-        launch_btn.clicked.connect(self.launch_script)
-        self.main_layout.addWidget(launch_btn)
+        # Candidate assignments of the peaks from the final shift list
+        self.assign_check = QCheckBox("Assign peaks from the shift list")
+        self.assign_check.setStyleSheet("color: #E0E0E0;")
+        self.main_layout.addWidget(self.assign_check)
+
+        # Leave out the diagonal and near-duplicate peaks (listed in *_cleanup.csv)
+        self.clean_check = QCheckBox("Remove diagonal and duplicate peaks")
+        self.clean_check.setStyleSheet("color: #E0E0E0;")
+        self.main_layout.addWidget(self.clean_check)
+
+        # r^-6 calibration of the NOESY volumes to cyana upper limits (13C.upl, 15N.upl)
+        self.calibrate_check = QCheckBox("Calibrate volumes to distance limits (.upl)")
+        self.calibrate_check.setStyleSheet("color: #E0E0E0;")
+        self.main_layout.addWidget(self.calibrate_check)
+
+        # Update the .peaks files with the changed peaks only (13C.peaks.peakindex, ...)
+        self.incremental_check = QCheckBox("Update the peak lists incrementally")
+        self.incremental_check.setStyleSheet("color: #E0E0E0;")
+        self.main_layout.addWidget(self.incremental_check)
+
+        # Colour code 2 on the NOESY peaks with a symmetry partner in the other NOESY (13C_symmetry.csv ...)
+        self.symmetry_check = QCheckBox("Mark peaks confirmed by 13C/15N symmetry")
+        self.symmetry_check.setStyleSheet("color: #E0E0E0;")
+        self.main_layout.addWidget(self.symmetry_check)
+
+        # gzip the .peaks and the .prot (13C.peaks.gz, attib_cyana.prot.gz)
+        self.compress_check = QCheckBox("Compress the peak lists and the shift list (.gz)")
+        self.compress_check.setStyleSheet("color: #E0E0E0;")
+        self.main_layout.addWidget(self.compress_check)
+
+        # Launch button, Cancel while a conversion runs
+        button_layout = QHBoxLayout()
+        self.launch_btn = QPushButton("Launch")
+        self.launch_btn.clicked.connect(self.launch_script)
+        button_layout.addWidget(self.launch_btn)
+        self.cancel_btn = QPushButton("Cancel")
+        self.cancel_btn.clicked.connect(self.cancel_script)
+        button_layout.addWidget(self.cancel_btn)
+        self.cancel_btn.hide()
+        self.main_layout.addLayout(button_layout)
 
         # Add stretch to center content
         self.main_layout.addStretch()
@@ -134,84 +197,93 @@ class CycyApp(QMainWindow):
         if folder:
             self.save_input.setText(folder)
 
+    def load_fasta(self):
+        path, _ = QFileDialog.getOpenFileName(self, "Select FASTA file", "",
+                                              "FASTA (*.fasta *.fa *.faa);;All files (*)")
+        if path:
+            try:
+                self.fasta_input.setText(fasta_to_seq.first_record(path))
+            except (OSError, UnicodeDecodeError) as e:
+                QMessageBox.critical(self, "Error", f"Cannot read {path}: {e}")
+
     def launch_script(self):
         # Validate inputs
         start_number = self.number_input.text().strip()
         fasta_sequence = self.fasta_input.text().strip()
         save_path = self.save_input.text().strip()
         version = "2" if self.version_2.isChecked() else "3"
-        file_13C = os.path.join(save_path, "13C.csv")
-        file_15N = os.path.join(save_path, "15N.csv")
-        cyana_attrib_input = os.path.join(save_path, "attrib.csv")
 
         # Input validation
-        if not all([start_number, fasta_sequence, save_path]):
-            QMessageBox.critical(self, "Error", "All fields are required!")
-            return
-
-        try:
-            start_num = int(start_number)
-            if start_num < 1:
-                raise ValueError("Start number must be a positive integer")
-        except ValueError:
-            QMessageBox.critical(self, "Error", "Invalid start number! Must be a positive integer.")
+        message = engine.check_inputs(save_path, start_number, fasta_sequence, version)
+        if message:
+            QMessageBox.critical(self, "Error", message)
             return
 
-        valid_aas = set("ARNDCQEGHILKMFPSTWYV")
-        if not all(aa in valid_aas for aa in fasta_sequence.upper()):
-            QMessageBox.critical(self, "Error", "Invalid protein sequence! Use standard one-letter amino acid codes.")
-            return
-
-        if not os.path.isdir(save_path):
-            QMessageBox.critical(self, "Error", "Invalid save directory!")
-            return
-
-        # Define output file path
-        output_file = os.path.join(save_path, "prot.seq")
-        output_csv = os.path.join(save_path, "attib_cyana.prot")
-
-        # Path to the external Python script
-        fasta_to_seq = "fasta_to_seq.py"  # Adjust if the script is in a different directory
-        to_xeasy = "to_xeasy.py"
-        file_toprot = "file_to_prot.py"
-        # Prepare arguments for the script
-        args_fasta_to_seq = [start_number, fasta_sequence, output_file]
-        args_to_xeasy = [file_13C, file_15N, version, save_path]
-
-        # Start the script in a separate thread
+        # Run the three stages in a separate thread
         self.status_label.setText("Processing...")
+        self.metrics_label.hide()
         self.progress.show()
-        self.progress.setRange(0, 0)  # Indeterminate mode
-        self.script_thread_fasta_to_seq = ScriptThread(fasta_to_seq, args_fasta_to_seq)
-        self.script_thread_fasta_to_seq.finished.connect(self.on_script_finished)
-        self.script_thread_fasta_to_seq.error.connect(self.on_script_error)
-        self.script_thread_fasta_to_seq.start()
+        self.progress.setRange(0, 0)  # Indeterminate mode until the first report
+        self.stage_progress = {}
+        self.launch_btn.setEnabled(False)
+        self.cancel_btn.setEnabled(True)
+        self.cancel_btn.show()
+        self.conversion_thread = ConversionThread(save_path, start_number, fasta_sequence, version,
+                                                  self.assign_check.isChecked(), self.clean_check.isChecked(),
+                                                  self.calibrate_check.isChecked(),
+                                                  self.incremental_check.isChecked(),
+                                                  self.symmetry_check.isChecked(),
+                                                  '.gz' if self.compress_check.isChecked() else None)
+        self.conversion_thread.finished.connect(self.on_script_finished)
+        self.conversion_thread.error.connect(self.on_script_error)
+        self.conversion_thread.progress.connect(self.on_progress)
+        self.conversion_thread.start()
 
-        seq_file = os.path.join(save_path, "prot.seq")
-        args_file_to_prot= [cyana_attrib_input, seq_file,save_path, output_csv]
+    def cancel_script(self):
+        self.status_label.setText("Cancelling...")
+        self.cancel_btn.setEnabled(False)
+        self.conversion_thread.cancel()
 
+    def on_progress(self, stage, done, total):
+        if not self.cancel_btn.isEnabled():
+            return  # keep "Cancelling..."
+        self.stage_progress[stage] = (done, total)
+        text = f"{stage}: {done:,} / {total:,} rows" if total else f"{stage}: {done:,} rows"
+        self.status_label.setText(text)
+        # one bar for all the stages, on the rows of the stages with a known total
+        known = [(d, t) for d, t in self.stage_progress.values() if t]
+        if known:
+            self.progress.setRange(0, 1000)
+            self.progress.setValue(int(1000 * sum(d for d, _ in known) / sum(t for _, t in known)))
 
-        self.script_thread_xeasy=ScriptThread(to_xeasy,args_to_xeasy)
-        self.script_thread_xeasy.finished.connect(self.on_script_finished)
-        self.script_thread_xeasy.error.connect(self.on_script_error)
-        self.script_thread_xeasy.start()
-
-        self.script_thread_to_prot=ScriptThread(file_toprot,args_file_to_prot)
-        self.script_thread_to_prot.finished.connect(self.on_script_finished)
-        self.script_thread_to_prot.error.connect(self.on_script_error)
-        self.script_thread_to_prot.start()
+    def conversion_done(self):
+        self.progress.hide()
+        self.cancel_btn.hide()
+        self.launch_btn.setEnabled(True)
 
-    def on_script_finished(self, message):
+    def on_script_finished(self, result):
+        if result['stages']:
+            self.metrics_label.setText(metrics.format_stages(result['stages']))
+            self.metrics_label.show()
+        if result.get('cancelled'):
+            # the files the cancelled stages had started are removed by the engine
+            self.status_label.setText("Cancelled")
+            self.conversion_done()
+            return
+        if not result['ok']:
+            self.on_script_error(result['error'])
+            return
         self.status_label.setText("Processing complete!")
-        self.progress.hide()
+        self.conversion_done()
         #QMessageBox.information(self, "Success", message)
 
     def on_script_error(self, message):
         self.status_label.setText("Error occurred")
-        self.progress.hide()
+        self.conversion_done()
         QMessageBox.critical(self, "Error", message)
 
 if __name__ == "__main__":
+    metrics.setup_logging()
     app = QApplication(sys.argv)
     window = CycyApp()
     window.show()
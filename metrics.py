@@ -0,0 +1,164 @@
+#! /usr/bin/python3
+import json
+import logging
+import sys
+import threading
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+'''
+Per-stage metrics of a conversion: wall time, rows read, rows written,
+rows filtered (with the reason), rows flagged for a check (outlier shifts
+...) and the peak RSS of the process when the stage ended. The peak RSS
+is a high-water mark of the whole process: it never goes down and the
+stages running at the same time share it, it is not the memory of one
+stage.
+
+The stages fill a stats dict while they run:
+    stats = new_stats()
+    to_xeasy.process_files(..., stats=stats)
+and the scheduler logs one JSON line per stage on the 'cycy' logger.
+'''
+
+logger = logging.getLogger('cycy')
+logger.addHandler(logging.NullHandler())
+
+
+def new_stats():
+    """Counters filled by a stage: totals plus the rows dropped by each filter."""
+    return {'rows_read': 0, 'rows_written': 0, 'rows_filtered': 0, 'filtered': {}, 'warnings': {}}
+
+
+def add_filtered(stats, reason, count):
+    """Count rows dropped by one filter (Total Peak Count, -1 codes ...)."""
+    if stats is None or not count:
+        return
+    stats['filtered'][reason] = stats['filtered'].get(reason, 0) + int(count)
+    stats['rows_filtered'] += int(count)
+
+
+def add_warnings(stats, reason, count):
+    """Count rows kept but flagged for a check (shift outliers ...)."""
+    if stats is None or not count:
+        return
+    warnings = stats.setdefault('warnings', {})
+    warnings[reason] = warnings.get(reason, 0) + int(count)
+
+
+def add_stats(total, stats):
+    """Add the counters of stats to total (stages split over worker processes)."""
+    for key in ('rows_read', 'rows_written'):
+        total[key] += stats[key]
+    for reason, count in stats['filtered'].items():
+        add_filtered(total, reason, count)
+    for reason, count in stats.get('warnings', {}).items():
+        add_warnings(total, reason, count)
+
+
+class Cancelled(Exception):
+    """The user cancelled the conversion."""
+
+
+class Progress:
+    """Progress reports and cancel flag shared by the stages of one conversion.
+
+    The stages call report(stage, done, total) every few thousand rows
+    (total None when unknown); callback(stage, done, total) gets them, from
+    the stage threads. After cancel(), the next report of every stage raises
+    Cancelled so the work stops at a chunk boundary.
+    """
+
+    def __init__(self, callback=None, event=None):
+        self.callback = callback
+        # threading.Event, or a multiprocessing one shared with worker processes
+        self.event = event if event is not None else threading.Event()
+
+    def cancel(self):
+        self.event.set()
+
+    @property
+    def cancelled(self):
+        return self.event.is_set()
+
+    def report(self, stage, done, total=None):
+        if self.event.is_set():
+            raise Cancelled(f"{stage} cancelled")
+        if self.callback is not None:
+            self.callback(stage, done, total)
+
+
+def report(progress, stage, done, total=None):
+    """progress.report when there is a progress to report to."""
+    if progress is not None:
+        progress.report(stage, done, total)
+
+
+def process_peak_rss():
+    """Peak resident memory of the whole process so far, in bytes (None when unknown)."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def stage_record(result):
+    """Flat JSON-ready record of one stage result."""
+    stats = result.get('metrics') or {}
+    return {
+        'event': 'stage',
+        'stage': result['name'],
+        'ok': result['ok'],
+        'time_s': round(result.get('time', 0.0), 6),
+        'rows_read': stats.get('rows_read'),
+        'rows_written': stats.get('rows_written'),
+        'rows_filtered': stats.get('rows_filtered'),
+        'filtered': stats.get('filtered', {}),
+        'warnings': stats.get('warnings', {}),
+        'process_peak_rss_bytes': result.get('process_peak_rss'),
+        'error': result.get('error'),
+    }
+
+
+def log_stage(result):
+    logger.info(json.dumps(stage_record(result)))
+
+
+def format_stages(results):
+    """Per-stage breakdown as text, for the GUI and the command line tools."""
+    lines = []
+    for result in results:
+        record = stage_record(result)
+        line = f"{record['stage']:<13} {record['time_s']:7.2f} s"
+        if record['rows_read']:
+            line += f"  read {record['rows_read']}"
+        if record['rows_written']:
+            line += f"  written {record['rows_written']}"
+        if record['rows_filtered']:
+            reasons = ', '.join(f"{reason} {count}" for reason, count in record['filtered'].items())
+            line += f"  filtered {record['rows_filtered']} ({reasons})"
+        if record['warnings']:
+            line += "  check " + ', '.join(f"{reason} {count}" for reason, count in record['warnings'].items())
+        if not record['ok']:
+            line += "  FAILED"
+        lines.append(line)
+    rss = [result.get('process_peak_rss') for result in results if result.get('process_peak_rss')]
+    if rss:
+        lines.append(f"peak RSS of the process {max(rss) / 2**20:.0f} MiB")
+    return '\n'.join(lines)
+
+
+def setup_logging(log_file=None, level=logging.INFO):
+    """Send the JSON stage records to stderr (and to log_file if given)."""
+    if any(not isinstance(handler, logging.NullHandler) for handler in logger.handlers):
+        return  # already set up in this process
+    handlers = [logging.StreamHandler()]
+    if log_file:
+        handlers.append(logging.FileHandler(log_file))
+    for handler in handlers:
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        logger.addHandler(handler)
+    logger.setLevel(level)
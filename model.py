@@ -0,0 +1,289 @@
+#! /usr/bin/python3
+import csv
+import os
+import threading
+from array import array
+from collections.abc import Mapping
+
+from fileutils import compression_of, open_file, parse_float
+
+'''
+Compact tables of a project, shared by the conversion stages.
+
+    SequenceTable  prot.seq: residue type codes in an array indexed by
+                   residue number
+    ShiftTable     .prot: one row per atom, values in float arrays, the
+                   residue (SequenceCode) and atom names integer-coded
+    PeakTable      CCPN peak export: one contiguous float64 array per
+                   dimension (xeasy order) and the volumes
+
+Every file is parsed once per process: load_sequence, load_shifts and
+load_peaks keep the tables they built, keyed on the path, and give the same
+object back while the file is unchanged (size and mtime). A stage writing a
+file registers the table it already has in memory (share), so the next
+stage does not read it back. The tables are read-only, the NumPy columns
+are views of their arrays (or of the peak cache memory map), not copies.
+NumPy is only imported by the peak table and by column().
+'''
+
+# tables kept per process, the oldest ones are dropped first
+cache_size = 16
+# largest residue number range of a sequence table
+max_span = 1 << 20
+
+# {(kind, path): (mtime_ns, size, table)}
+loaded = {}
+# the stages of a conversion run in threads
+loaded_lock = threading.Lock()
+
+
+def encode(values):
+    """Integer codes of a column and its distinct values, in order of appearance."""
+    names = {}
+    codes = array('i', [names.setdefault(value, len(names)) for value in values])
+    return codes, list(names)
+
+
+def frozen_view(values, dtype):
+    """Read-only NumPy view of an array.array."""
+    import numpy as np
+    view = np.frombuffer(values, dtype=dtype) if len(values) else np.empty(0, dtype=dtype)
+    view.flags.writeable = False
+    return view
+
+
+class SequenceTable(Mapping):
+    """Residue types of a sequence, in an array indexed by residue number.
+
+    It is also the read-only {SequenceCode: residue type} mapping the stages
+    look residues up with ('43' -> 'LYS').
+    """
+
+    def __init__(self, numbers, residues):
+        numbers = [int(number) for number in numbers]
+        self.first = min(numbers) if numbers else 0
+        span = max(numbers) - self.first + 1 if numbers else 0
+        if span > max_span:
+            raise ValueError(f"residue numbers from {self.first} to {max(numbers)}, too far apart")
+        codes, self.types = encode(residue.upper() for residue in residues)
+        self.residue_codes = array('i', [-1]) * span
+        for number, code in zip(numbers, codes):
+            self.residue_codes[number - self.first] = code
+        self.by_code = None
+
+    def __repr__(self):
+        return f"SequenceTable({len(self)} residues from {self.first})"
+
+    def residue(self, number):
+        """Residue type of a residue number (KeyError when not in the sequence)."""
+        position = number - self.first
+        code = self.residue_codes[position] if 0 <= position < len(self.residue_codes) else -1
+        if code < 0:
+            raise KeyError(number)
+        return self.types[code]
+
+    def numbers(self):
+        return [self.first + i for i, code in enumerate(self.residue_codes) if code >= 0]
+
+    def text_map(self):
+        """{SequenceCode text: residue type}, built once."""
+        if self.by_code is None:
+            self.by_code = {str(self.first + i): self.types[code]
+                            for i, code in enumerate(self.residue_codes) if code >= 0}
+        return self.by_code
+
+    def __getitem__(self, code):
+        return self.text_map()[code]
+
+    def get(self, code, default=None):
+        return self.text_map().get(code, default)
+
+    def __iter__(self):
+        return iter(self.text_map())
+
+    def __len__(self):
+        return len(self.text_map())
+
+
+class ShiftTable:
+    """Shift list of a .prot, one row per atom.
+
+    index, value, error: .prot columns; residue, atom: codes of the
+    SequenceCode and AtomName texts in residue_names and atom_names.
+    """
+
+    def __init__(self, index, values, errors, codes, atoms):
+        self.index = array('q', index)
+        self.value = array('d', values)
+        self.error = array('d', errors)
+        self.residue, self.residue_names = encode(codes)
+        self.atom, self.atom_names = encode(atoms)
+
+    def __repr__(self):
+        return f"ShiftTable({len(self)} shifts)"
+
+    def __len__(self):
+        return len(self.value)
+
+    def residues(self):
+        """SequenceCode of every row."""
+        names = self.residue_names
+        return [names[code] for code in self.residue]
+
+    def atoms(self):
+        """AtomName of every row."""
+        names = self.atom_names
+        return [names[code] for code in self.atom]
+
+    def column(self, name):
+        """Read-only NumPy view of a column (index, value, error, residue or atom)."""
+        dtypes = {'index': 'i8', 'value': 'f8', 'error': 'f8', 'residue': 'i4', 'atom': 'i4'}
+        return frozen_view(getattr(self, name), dtypes[name])
+
+    @classmethod
+    def from_rows(cls, rows):
+        """Table of the (Index, value, error, atom, SequenceCode) rows of file_to_prot.light_prot."""
+        rows = list(rows)
+        if not rows:
+            return cls((), (), (), (), ())
+        index, values, errors, atoms, codes = zip(*rows)
+        return cls(index, values, errors, codes, atoms)
+
+    @classmethod
+    def from_frame(cls, frame):
+        """Table of a .prot DataFrame (the column names with or without their newline)."""
+        columns = {name.replace('\n', ' ').strip(): name for name in frame.columns}
+        errors = (frame[columns['Value Error (ppm)']].astype(float) if 'Value Error (ppm)' in columns
+                  else [float('nan')] * len(frame))
+        return cls(frame[columns['Index']].astype(int), frame[columns['Value (ppm)']].astype(float), errors,
+                   frame[columns['SequenceCode']].astype(str), frame[columns['AtomName']].astype(str))
+
+
+class PeakTable:
+    """Peak list of one spectrum.
+
+    positions: one contiguous float64 array per dimension, in xeasy order;
+    volume: float64 array; serial, peak_list: CCPN peak serial and peak
+    list number (-1 when unknown), None when the export has no _object column.
+    """
+
+    def __init__(self, positions, volume, serial=None, peak_list=None):
+        self.positions = list(positions)
+        self.volume = volume
+        self.serial = serial
+        self.peak_list = peak_list
+
+    def __repr__(self):
+        return f"PeakTable({len(self)} peaks, {self.n_dims} dimensions)"
+
+    def __len__(self):
+        return len(self.volume)
+
+    @property
+    def n_dims(self):
+        return len(self.positions)
+
+
+def read_sequence(seq_file):
+    """SequenceTable of a prot.seq (three-letter code and residue number per line)."""
+    numbers, residues = [], []
+    with open_file(seq_file, 'r') as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) >= 2:
+                residues.append(parts[0])
+                numbers.append(int(parts[1]))
+    return SequenceTable(numbers, residues)
+
+
+def read_shifts(prot_file):
+    """ShiftTable of a cyana .prot written by file_to_prot."""
+    with open_file(prot_file, 'r', newline='') as f:
+        reader = csv.reader(f, delimiter='\t')
+        # the header of pandas holds quoted newlines ("Value\n(ppm)")
+        header = [name.replace('\n', ' ').strip() for name in next(reader, [])]
+        rows = [row for row in reader if row]
+    position = {name: i for i, name in enumerate(header)}
+    for name in ('Index', 'Value (ppm)', 'AtomName', 'SequenceCode'):
+        if name not in position:
+            raise ValueError(f"{prot_file}: no {name} column")
+
+    def column(name):
+        i = position.get(name)
+        return [row[i] if i is not None and i < len(row) else '' for row in rows]
+
+    return ShiftTable([int(value) for value in column('Index')],
+                      [parse_float(value) for value in column('Value (ppm)')],
+                      [parse_float(value) for value in column('Value Error (ppm)')],
+                      column('SequenceCode'), column('AtomName'))
+
+
+def read_peaks(spectrum, cache=True):
+    """PeakTable of a spectrum (spectra.Spectrum), from the peak cache when possible."""
+    import numpy as np
+    columns = None
+    if cache:
+        try:
+            import peak_cache
+            columns, _ = peak_cache.load_peaks(spectrum.csv)
+        except OSError:
+            # read-only directory, parse the text
+            columns = None
+    if columns is None:
+        import pandas as pd
+        wanted = set(spectrum.columns) | {'_object'}
+        frame = pd.read_csv(spectrum.csv, usecols=lambda name: name in wanted, float_precision='round_trip',
+                            compression=compression_of(spectrum.csv))
+        columns = {name: pd.to_numeric(frame[name], errors='coerce').to_numpy(np.float64)
+                   for name in spectrum.columns}
+        if '_object' in frame.columns:
+            import peak_cache
+            _, columns['peak_list'], columns['serial'] = peak_cache.split_objects(frame['_object'], [])
+
+    def floats(name):
+        return np.ascontiguousarray(columns[name], dtype=np.float64)
+
+    return PeakTable([floats(name) for name in spectrum.positions], floats('Volume'), columns.get('serial'),
+                     columns.get('peak_list'))
+
+
+def cached(kind, path, build):
+    """Table kept for path while the file is unchanged, built with build(path) otherwise.
+
+    The table is built outside the lock: two threads missing the same file
+    both build it, the last one is kept.
+    """
+    stat = os.stat(path)
+    key = (kind, os.path.abspath(path))
+    with loaded_lock:
+        known = loaded.get(key)
+    if known and known[:2] == (stat.st_mtime_ns, stat.st_size):
+        return known[2]
+    table = build(path)
+    remember(key, stat, table)
+    return table
+
+
+def remember(key, stat, table):
+    with loaded_lock:
+        loaded.pop(key, None)
+        while len(loaded) >= cache_size:
+            loaded.pop(next(iter(loaded)))
+        loaded[key] = (stat.st_mtime_ns, stat.st_size, table)
+
+
+def share(kind, path, table):
+    """Keep the table of a file just written, for the next stages of the process."""
+    remember((kind, os.path.abspath(path)), os.stat(path), table)
+
+
+def load_sequence(seq_file):
+    return cached('sequence', seq_file, read_sequence)
+
+
+def load_shifts(prot_file):
+    return cached('shifts', prot_file, read_shifts)
+
+
+def load_peaks(spectrum, cache=True):
+    return cached(('peaks', tuple(spectrum.columns)), spectrum.csv, lambda path: read_peaks(spectrum, cache))
@@ -1,69 +1,101 @@
 #! /usr/bin/python3
+import hashlib
 import json
+import os
+import pickle
 from itertools import islice
 
-lib = 'lib-ccpnmrV3_to_cyana.lib'
+import model
+from fileutils import open_file
+
+# the library sits next to this file, whatever the current directory is
+lib = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'lib-ccpnmrV3_to_cyana.lib')
 '''
 seq = 'SilB41.seq'
 prot = 'name.prot'
 '''
+# compiled tables already loaded in this process {lib path: (mtime, size, table)}
+compiled_tables = {}
+
+def compile_library(lib_dic):
+    """Flatten the library into {(residue, atom): cyana name}.
+
+    The GENERAL fallback is resolved ahead of time for every residue of the
+    library, atoms of other residues are stored under (None, atom).
+    """
+    general = lib_dic.get("GENERAL", {})
+    table = {(None, atom): name for atom, name in general.items()}
+    for residue, atoms in lib_dic.items():
+        if residue == "GENERAL":
+            continue
+        for atom in set(general) | set(atoms):
+            table[(residue, atom)] = atoms.get(atom, general.get(atom))
+    return table
+
+def load_table(lib=lib):
+    """Compiled translation table, cached on disk next to the library.
+
+    The cache (<lib>.cache) is rebuilt only when the content of the .lib changes.
+    """
+    stat = os.stat(lib)
+    known = compiled_tables.get(lib)
+    if known and known[:2] == (stat.st_mtime_ns, stat.st_size):
+        return known[2]
+
+    with open(lib, 'rb') as file:
+        content = file.read()
+    digest = hashlib.sha1(content).hexdigest()
+    cache_file = lib + '.cache'
+
+    table = None
+    try:
+        with open(cache_file, 'rb') as cache:
+            cached = pickle.load(cache)
+        if cached.get('digest') == digest:
+            table = cached['table']
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError, KeyError):
+        pass
+
+    if table is None:
+        table = compile_library(json.loads(content))
+        try:
+            tmp_file = cache_file + '.tmp'
+            with open(tmp_file, 'wb') as cache:
+                pickle.dump({'digest': digest, 'table': table}, cache)
+            os.replace(tmp_file, cache_file)
+        except OSError:
+            # read-only installation, keep the table in memory only
+            pass
+
+    compiled_tables[lib] = (stat.st_mtime_ns, stat.st_size, table)
+    return table
+
+def translate_atoms(residues, atoms, table):
+    """Batched lookup of the cyana names of whole residue / atom columns."""
+    get = table.get
+    # if unsuccessful, use atom name as default value
+    return [get((aa, atom)) or get((None, atom), atom) for aa, atom in zip(residues, atoms)]
+
 def nomenclature(lib=lib, prot=None,seq=None, output_file= None):
     
-    # creat a dictionaire with link amino acid and number in the sequence
-    seq_dic = {} # empty dict
-    
-    with open(seq, 'r') as f:
-        for line in f:
-            if line.strip():
-                amino_acid, res_num = line.strip().split() #splite number and aa
-                seq_dic[int(res_num)] = amino_acid.upper() #Put the aa in upper letter
-    
-    #creat a dictionary with the file lib writ in json with {} --> go to dict
-    with open (lib, 'r') as file:
-        lib_dic = json.load(file) # read only str
-        
-   # Initialiser la liste pour accumuler les traductions
-    atom_translet = []
+    # amino acid of every residue number of the sequence, and the shift list,
+    # shared with the other stages (see model)
+    sequence = model.load_sequence(seq)
+    shifts = model.load_shifts(prot)
+    # take the aa from its number
+    residues = [sequence.residue(int(code)) for code in shifts.residues()]
     
-    #open and read the .prot file
-    with open (prot, 'r') as ff:
-        items = list(islice(ff, 3))# Skip header line *3 == next (ff) *3
-        for line in ff:
-            if line.strip():
-                parts = line.strip().split()
-                atom_name = parts[-2] # take the atmos name
-                seq_code = int(parts[-1]) # take the number of aa
-                aa=[]
-                aa = seq_dic[seq_code]
-                if aa in ['ALA', 'ARG', 'GLY', 'HIS', 'TRP', 'VAL', 'ILE', 'LEU']:
-                    try:
-                        # Trying to access amino acid-specific translation
-                        atom_translet.append(lib_dic[aa][atom_name])
-                    except KeyError:
-                        try:
-                            # If unsuccessful, try general translation
-                            atom_translet.append(lib_dic["GENERAL"][atom_name])
-                        except KeyError:
-                            # If unsuccessful, use atom name as default value
-                            atom_translet.append(atom_name)
-                else :
-                    try:
-                        #try the translation in general
-                        atom_translet.append(lib_dic["GENERAL"][atom_name])
-                    except KeyError:
-                        # If unsuccessful, use atom name as default value
-                        atom_translet.append(atom_name)
-    return atom_translet
+    return translate_atoms(residues, shifts.atoms(), load_table(lib))
             
 def file_transforme(atom_translet, prot=None, output_file= None):
-    with open(prot, 'r') as f:
+    with open_file(prot, 'r') as f:
         # Conserver l'en-tête
         header = list(islice(f, 3))
         # Lire les lignes restantes
         lines = list(f)
     
     # Écrire dans le fichier de sortie
-    with open(output_file, 'w') as f_out:
+    with open_file(output_file, 'w') as f_out:
         # Écrire l'en-tête
         for line in header:
             f_out.write(line)
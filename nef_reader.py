@@ -0,0 +1,371 @@
+#! /usr/bin/python3
+import argparse
+import os
+import re
+import sys
+from operator import itemgetter
+
+import numpy as np
+import pandas as pd
+
+import fasta_to_seq
+import file_to_prot
+import metrics
+import spectra
+import to_xeasy
+from fileutils import open_file
+
+'''
+NEF project file as input, instead of the 13C.csv, 15N.csv and attrib.csv
+exported by hand from CCPN V3.
+
+The file is read once, line by line, and never held in memory: the STAR
+tokens are streamed and every loop is handed over row by row.
+
+- nef_sequence -> prot.seq (same as fasta_to_seq)
+- nef_chemical_shift (first shift list) -> attib_cyana.prot (file_to_prot)
+- nef_peak of every nef_nmr_spectrum -> <spectrum>.peaks (to_xeasy), by
+  chunks while the rows are read
+
+python nef_reader.py project.nef WORKDIR --version 3 [--clean]
+
+Only the NEF dictionary is mapped; NMR-STAR files share the syntax (the
+tokenizer reads them) but not the category names.
+'''
+
+null_values = ('.', '?')
+
+# quoted values, comments, plain tokens of a STAR line
+token_pattern = re.compile(r"""'(.*?)'(?=\s|$)|"(.*?)"(?=\s|$)|(#.*)|(\S+)""")
+
+# NEF axis codes: 1H, 13C, 15N ...
+axis_nuclei = {'1H': 'H', '2H': 'H', '13C': 'C', '15N': 'N'}
+
+
+def tokenize(lines):
+    """STAR tokens of every line (a list per line), quoted values without their quotes."""
+    text = None
+    for line in lines:
+        if text is not None:
+            # inside a ;-delimited text field
+            if not line.startswith(';'):
+                text.append(line.rstrip('\n'))
+                continue
+            tokens = ['\n'.join(text)]
+            text = None
+            line = line[1:]
+        elif line.startswith(';'):
+            text = [line[1:].rstrip('\n')]
+            continue
+        else:
+            tokens = []
+        if '"' in line or "'" in line or '#' in line:
+            for match in token_pattern.finditer(line):
+                single, double, comment, plain = match.groups()
+                if comment is not None:
+                    break
+                tokens.append(single if single is not None else double if double is not None else plain)
+        else:
+            tokens += line.split()
+        if tokens:
+            yield tokens
+
+
+class TokenStream:
+    """Tokens of a STAR file, read one line at a time."""
+
+    def __init__(self, lines):
+        self.lines = tokenize(lines)
+        self.line = []
+        self.position = 0
+
+    def next(self):
+        """Next token, None at the end of the file."""
+        while self.position >= len(self.line):
+            self.line = next(self.lines, None)
+            self.position = 0
+            if self.line is None:
+                self.line = []
+                return None
+        self.position += 1
+        return self.line[self.position - 1]
+
+    def push_back(self):
+        self.position -= 1
+
+    def row(self, width):
+        """Next row of a loop, None after stop_ (or at a keyword ending the loop)."""
+        row = []
+        while len(row) < width:
+            token = self.next()
+            if token is None or token == 'stop_':
+                return None
+            if token == 'loop_' or token.startswith('save_'):
+                self.push_back()
+                return None
+            row.append(token)
+        return row
+
+
+def iter_loops(nef_file):
+    """(saveframe name, saveframe tags, loop category, loop tags, rows) of every loop, in file order.
+
+    rows is an iterator of lists of values, valid until the next loop is
+    asked for; rows not read are skipped.
+    """
+    with open_file(nef_file, 'r', buffering=1 << 20) as f:
+        stream = TokenStream(f)
+        saveframe, items = None, {}
+        while True:
+            token = stream.next()
+            if token is None:
+                return
+            if token.startswith('save_'):
+                saveframe, items = (token[5:], {}) if token != 'save_' else (None, {})
+            elif token == 'loop_':
+                tags = []
+                token = stream.next()
+                while token is not None and token.startswith('_'):
+                    tags.append(token)
+                    token = stream.next()
+                if token is not None:
+                    stream.push_back()
+                if not tags:
+                    continue
+                rows = loop_rows(stream, len(tags))
+                yield saveframe, items, tags[0].split('.')[0].lstrip('_'), tags, rows
+                for _ in rows:
+                    pass
+            elif token.startswith('_'):
+                value = stream.next()
+                items[token] = value
+
+
+def loop_rows(stream, width):
+    """Rows of a loop, up to its stop_."""
+    lines = stream.lines
+    while True:
+        if stream.position >= len(stream.line):
+            # usual layout, one row per line
+            line = next(lines, None)
+            if line is not None and len(line) == width and 'stop_' not in line and not line[0].startswith('save_'):
+                yield line
+                continue
+            stream.line, stream.position = line or [], 0
+        row = stream.row(width)
+        if row is None:
+            return
+        yield row
+
+
+def values(rows, tags, wanted):
+    """Columns of a loop as lists of strings, None for the null values."""
+    positions = {tag.split('.')[-1]: i for i, tag in enumerate(tags)}
+    columns = {name: [] for name in wanted}
+    for row in rows:
+        for name in wanted:
+            value = row[positions[name]] if name in positions else None
+            columns[name].append(None if value in null_values else value)
+    return columns
+
+
+def read_sequence(rows, tags, chain_code=None):
+    """(Three-letter code, residue number) of one chain of a nef_sequence loop."""
+    columns = values(rows, tags, ['chain_code', 'sequence_code', 'residue_name'])
+    chain_code = chain_code or next(iter(columns['chain_code']), None)
+    residues = []
+    for code, number, name in zip(columns['chain_code'], columns['sequence_code'], columns['residue_name']):
+        if code == chain_code and number is not None and number.lstrip('-').isdigit() and name:
+            residues.append((name.capitalize(), int(number)))
+    return residues, chain_code
+
+
+def read_shifts(rows, tags, chain_code=None):
+    """Shifts of a nef_chemical_shift loop as the attrib.csv table of CCPN."""
+    columns = values(rows, tags, ['chain_code', 'sequence_code', 'residue_name', 'atom_name',
+                                  'value', 'value_uncertainty'])
+    table = pd.DataFrame({
+        'uniqueId': range(1, len(columns['value']) + 1),
+        'Value\n(ppm)': pd.to_numeric(pd.Series(columns['value'], dtype=object), errors='coerce'),
+        'Value Error\n(ppm)': pd.to_numeric(pd.Series(columns['value_uncertainty'], dtype=object), errors='coerce'),
+        'SequenceCode': columns['sequence_code'],
+        'ResidueType': columns['residue_name'],
+        'AtomName': columns['atom_name'],
+        # every listed shift is an assigned one
+        'Total\nPeak Count': 1,
+    })
+    if chain_code is not None:
+        table = table[[code in (chain_code, None) for code in columns['chain_code']]]
+    return table.reset_index(drop=True)
+
+
+def nef_spectrum(name, dimensions, transfers, save_path, source=None):
+    """Spectrum description of a nef_nmr_spectrum saveframe.
+
+    dimensions: {dimension id: axis code}, transfers: onebond (dimension, dimension) pairs.
+    A 3D HHC or HHN spectrum with one H-heavy bond is written as the 13C or
+    15N NOESY (HC H C / HN H N), others keep the NEF dimension order.
+    """
+    ids = sorted(dimensions)
+    nuclei = [axis_nuclei.get(dimensions[i], dimensions[i].lstrip('0123456789')) for i in ids]
+    bonded = []
+    for first, second in transfers:
+        a, b = ids.index(first), ids.index(second)
+        if nuclei[b] == 'H':
+            a, b = b, a
+        if nuclei[a] == 'H' and nuclei[b] != 'H':
+            bonded.append((a, b))
+
+    order = list(range(len(ids)))
+    noesy = None
+    if len(ids) == 3 and len(bonded) == 1 and sorted(nuclei) in (['C', 'H', 'H'], ['H', 'H', 'N']):
+        proton, heavy = bonded[0]
+        free = next(d for d in order if d not in (proton, heavy))
+        order = [proton, free, heavy]
+        noesy = spectra.carbon_noesy if nuclei[heavy] == 'C' else spectra.nitrogen_noesy
+    new = {old: i for i, old in enumerate(order)}
+    bonded = [(new[a], new[b]) for a, b in bonded]
+    nuclei = [nuclei[d] for d in order]
+
+    if noesy is not None:
+        inames, spectrum_type, cyana_format = noesy.inames, noesy.spectrum_type, noesy.cyana_format
+    else:
+        heavy_of = dict(bonded)
+        inames = [nuc + nuclei[heavy_of[d]] if d in heavy_of else nuc for d, nuc in enumerate(nuclei)]
+        spectrum_type = name
+        cyana_format = ''.join('h' if nuc == 'H' and d not in heavy_of else nuc for d, nuc in enumerate(nuclei))
+    protons = [d for d, nuc in enumerate(nuclei) if nuc == 'H']
+    return spectra.Spectrum(name, source or '', peaks_file(name, save_path), inames, nuclei,
+                            [f'Pos F{ids[d]}' for d in order], spectrum_type, cyana_format,
+                            bonded=bonded, diagonal=protons[:2] if len(protons) == 2 else None)
+
+
+def peaks_file(name, save_path):
+    """.peaks written for the spectrum name (a file system safe name)."""
+    return os.path.join(save_path, re.sub(r'[^\w.+-]', '_', name) + '.peaks')
+
+
+def spectrum_names(nef_file):
+    """Names of the nef_nmr_spectrum saveframes, from a scan of the lines (the loops are not parsed)."""
+    names = []
+    text = False
+    with open_file(nef_file, 'r', buffering=1 << 20) as f:
+        for line in f:
+            if line.startswith(';'):
+                # multi-line text value, a save_ in it is not a saveframe
+                text = not text
+            elif not text and line.lstrip().startswith('save_nef_nmr_spectrum_'):
+                names.append(line.split()[0][len('save_nef_nmr_spectrum_'):])
+    return names
+
+
+def output_files(nef_file, save_path, clean=False):
+    """Files convert_nef writes besides prot.seq: the .peaks of every spectrum, and their cleanup reports with clean."""
+    files = [peaks_file(name, save_path) for name in spectrum_names(nef_file)]
+    if clean:
+        files += [os.path.splitext(path)[0] + '_cleanup.csv' for path in files]
+    return files
+
+
+def peak_chunks(rows, tags, spectrum, chunksize=to_xeasy.chunksize):
+    """DataFrames of the spectrum columns, chunksize peaks at a time.
+
+    NEF lists one row per assignment of a peak, only the first row of every
+    peak_id is kept.
+    """
+    positions = {tag.split('.')[-1]: i for i, tag in enumerate(tags)}
+    wanted = [positions['position_' + column[len('Pos F'):]] for column in spectrum.positions]
+    intensity = positions.get('volume', positions.get('height'))
+    if intensity is not None:
+        wanted.append(intensity)
+    pick = itemgetter(*wanted)
+    peak_id = positions.get('peak_id')
+    last = None
+    block = []
+    n_peaks = 0
+    for row in rows:
+        if peak_id is not None:
+            if row[peak_id] == last:
+                continue
+            last = row[peak_id]
+        block.append(pick(row))
+        if len(block) == chunksize:
+            yield chunk_frame(block, spectrum.columns)
+            n_peaks += len(block)
+            block = []
+    if block or not n_peaks:
+        yield chunk_frame(block, spectrum.columns)
+
+
+def chunk_frame(block, columns):
+    """Numeric DataFrame of the text values, NaN for the null values."""
+    try:
+        data = np.array(block, dtype=np.float64).reshape(len(block), -1)
+    except ValueError:
+        # '.' or '?' somewhere
+        data = pd.DataFrame(block, dtype=object).apply(pd.to_numeric, errors='coerce').to_numpy(np.float64)
+        data = data.reshape(len(block), -1)
+    if data.shape[1] < len(columns):
+        # no volume nor height
+        data = np.hstack([data, np.full((len(block), 1), np.nan)])
+    return pd.DataFrame(data, columns=columns)
+
+
+def convert_nef(nef_file, save_path, version, chunksize=to_xeasy.chunksize, clean=False,
+                chain_code=None, stats=None):
+    """Write prot.seq and the .peaks files of a NEF file, in one pass.
+
+    Returns the shift table (attrib.csv layout) for file_to_prot and the
+    spectra written; stats collects the counters of the peak lists.
+    """
+    seq_file = os.path.join(save_path, 'prot.seq')
+    shifts = None
+    written = []
+    saveframe_spectrum = None
+    dimensions, transfers = {}, []
+    for saveframe, items, category, tags, rows in iter_loops(nef_file):
+        if category == 'nef_sequence':
+            residues, chain_code = read_sequence(rows, tags, chain_code)
+            fasta_to_seq.write_residues(residues, seq_file)
+        elif category == 'nef_chemical_shift' and shifts is None:
+            shifts = read_shifts(rows, tags, chain_code)
+        elif category == 'nef_spectrum_dimension':
+            columns = values(rows, tags, ['dimension_id', 'axis_code'])
+            dimensions = {int(i): code for i, code in zip(columns['dimension_id'], columns['axis_code'])}
+            saveframe_spectrum, transfers = saveframe, []
+        elif category == 'nef_spectrum_dimension_transfer':
+            columns = values(rows, tags, ['dimension_1', 'dimension_2', 'transfer_type'])
+            transfers = [(int(a), int(b)) for a, b, kind in
+                         zip(columns['dimension_1'], columns['dimension_2'], columns['transfer_type'])
+                         if kind == 'onebond']
+        elif category == 'nef_peak':
+            if saveframe != saveframe_spectrum:
+                raise ValueError(f"{saveframe}: peak list without nef_spectrum_dimension loop")
+            name = saveframe[len('nef_nmr_spectrum_'):] if saveframe.startswith('nef_nmr_spectrum_') else saveframe
+            spectrum = nef_spectrum(name, dimensions, transfers, save_path, nef_file)
+            result = to_xeasy.convert_chunks(spectrum, peak_chunks(rows, tags, spectrum, chunksize),
+                                             version, chunksize, clean=clean)
+            if stats is not None:
+                metrics.add_stats(stats, result)
+            written.append(spectrum)
+    if shifts is None:
+        raise ValueError(f"{nef_file} has no nef_chemical_shift loop")
+    return shifts, written
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert a NEF project file for cyana.")
+    parser.add_argument('nef_file')
+    parser.add_argument('save_path', help="directory of prot.seq, attib_cyana.prot and the .peaks files")
+    parser.add_argument('--version', type=int, default=2, choices=[2, 3], help="cyana version")
+    parser.add_argument('--clean', action='store_true', help="leave out the diagonal and duplicate peaks")
+    args = parser.parse_args()
+
+    shifts, written = convert_nef(args.nef_file, args.save_path, args.version, clean=args.clean)
+    file_to_prot.lunch_all(shifts, os.path.join(args.save_path, 'prot.seq'), args.save_path)
+    for spectrum in written:
+        print(f"{spectrum.name}: {spectrum.peaks}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
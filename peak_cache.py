@@ -0,0 +1,237 @@
+#! /usr/bin/python3
+import json
+import os
+import re
+import shutil
+import struct
+import tempfile
+
+import numpy as np
+
+from fileutils import file_hash, compression_of
+# pandas is only needed to parse the CSV, a valid cache is read without it
+
+'''
+Binary columnar cache of parsed CCPN peak exports.
+
+13C.csv is parsed once into 13C.csv.peakcache, next to it:
+
+    magic (8 bytes) | header length (uint64) | JSON header | columns
+
+Every column is a contiguous little-endian array aligned on 64 bytes:
+float64 for the positions (Pos F1, Pos F2 ...) and the Volume/Height, and
+the _object string split into integer columns (spectrum code, peak list,
+peak serial). The spectrum names are kept once in the header.
+
+Later runs memory-map the columns instead of parsing the text again. The
+cache is rebuilt when the SHA-1 of the CSV changes.
+'''
+
+magic = b'CYCYPK01'
+align = 64
+suffix = '.peakcache'
+parse_chunksize = 200000
+
+# <PK:noesy_HSQC_SilB41_1ag_ref.1.937: @(4.388, 65.03, 4.386)>
+object_pattern = r'^<PK:(?P<spectrum>.*)\.(?P<peak_list>\d+)\.(?P<serial>\d+):'
+
+
+def cache_file(csv_file):
+    return csv_file + suffix
+
+
+def aligned(offset):
+    return -(-offset // align) * align
+
+
+def read_header(path, expected=magic):
+    with open(path, 'rb') as f:
+        if f.read(8) != expected:
+            raise ValueError(f"{path} is not a peak cache")
+        (length,) = struct.unpack('<Q', f.read(8))
+        header = json.loads(f.read(length).decode('utf-8').rstrip(' '))
+    header['header_size'] = 16 + length
+    return header
+
+
+def write_header(f, header, size, expected=magic):
+    text = json.dumps(header).encode('utf-8')
+    if len(text) > size - 16:
+        raise ValueError("header does not fit")
+    f.seek(0)
+    f.write(expected + struct.pack('<Q', size - 16) + text + b' ' * (size - 16 - len(text)))
+
+
+def serials_after(matrix, prefix):
+    """Rows of the byte matrix starting with prefix and the serial number after it."""
+    n = len(prefix)
+    width = matrix.shape[1]
+    if width <= n:
+        return np.zeros(len(matrix), dtype=bool), np.zeros(len(matrix), dtype=np.int64)
+    match = (matrix[:, :n] == np.frombuffer(prefix, dtype=np.uint8)).all(axis=1)
+    tail = matrix[:, n:n + 19].astype(np.int64) - ord('0')
+    digits = (tail >= 0) & (tail <= 9)
+    # number of digits = position of the first non digit
+    n_digits = np.where(digits.all(axis=1), tail.shape[1], digits.argmin(axis=1))
+    position = np.arange(tail.shape[1])
+    power = n_digits[:, None] - 1 - position
+    serial = np.where(position < n_digits[:, None], tail * 10 ** np.maximum(power, 0), 0).sum(axis=1)
+    after = matrix[np.arange(len(matrix)), np.minimum(n + n_digits, width - 1)]
+    match &= (n_digits > 0) & (n + n_digits < width) & (after == ord(':'))
+    return match, serial
+
+
+def split_objects(objects, spectra):
+    """Spectrum code, peak list and serial of every _object string.
+
+    The strings of one peak list share their '<PK:spectrum.list.' prefix, so
+    the serials are read with array operations on the raw bytes, one prefix
+    at a time. Strings that do not follow the pattern get -1.
+    """
+    values = objects.fillna('').astype(str).to_numpy()
+    codes = np.full(len(values), -1, dtype=np.int32)
+    peak_list = np.full(len(values), -1, dtype=np.int32)
+    serial = np.full(len(values), -1, dtype=np.int64)
+    try:
+        raw = values.astype('S')
+    except UnicodeEncodeError:
+        raw = np.char.encode(values.astype('U'), 'utf-8')
+    matrix = raw.view(np.uint8).reshape(len(raw), raw.dtype.itemsize) if len(raw) else raw
+
+    todo = np.ones(len(values), dtype=bool)
+    while todo.any():
+        first = np.flatnonzero(todo)[0]
+        found = re.match(object_pattern, values[first])
+        if not found:
+            todo[first] = False
+            continue
+        name, number = found.group('spectrum'), int(found.group('peak_list'))
+        if name not in spectra:
+            spectra.append(name)
+        prefix = f"<PK:{name}.{found.group('peak_list')}.".encode('utf-8')
+        match, serials = serials_after(matrix, prefix)
+        match &= todo
+        match[first] = True
+        codes[match] = spectra.index(name)
+        peak_list[match] = number
+        serial[match] = serials[match]
+        serial[first] = int(found.group('serial'))
+        todo &= ~match
+    return codes, peak_list, serial
+
+
+def build_cache(csv_file, digest=None):
+    """Parse csv_file by chunks and write its columnar cache."""
+    import pandas as pd
+    stat = os.stat(csv_file)
+    digest = digest or file_hash(csv_file)
+    spectra = []
+    dtypes = {}
+    rows = 0
+    path = cache_file(csv_file)
+    work_dir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(csv_file)))
+    try:
+        column_files = {}
+        for chunk in pd.read_csv(csv_file, chunksize=parse_chunksize, float_precision='round_trip',
+                                 compression=compression_of(csv_file)):
+            columns = {}
+            if '_object' in chunk.columns:
+                columns['spectrum'], columns['peak_list'], columns['serial'] = split_objects(chunk['_object'], spectra)
+            for name in chunk.columns:
+                if name != '_object':
+                    columns[name] = pd.to_numeric(chunk[name], errors='coerce').to_numpy(np.float64)
+            for name, values in columns.items():
+                if name not in column_files:
+                    dtypes[name] = values.dtype.newbyteorder('<').str
+                    column_files[name] = open(os.path.join(work_dir, f'{len(column_files)}.bin'), 'wb')
+                values.astype(dtypes[name], copy=False).tofile(column_files[name])
+            rows += len(chunk)
+        for f in column_files.values():
+            f.close()
+
+        # header first, then the columns one after the other
+        header = {'digest': digest, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+                  'rows': rows, 'spectra': spectra, 'columns': []}
+        header_size = aligned(len(json.dumps(header)) + 200 * (len(dtypes) + 1) + 1024)
+        offset = header_size
+        for name, dtype in dtypes.items():
+            header['columns'].append({'name': name, 'dtype': dtype, 'offset': offset})
+            offset = aligned(offset + rows * np.dtype(dtype).itemsize)
+
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as out:
+            write_header(out, header, header_size)
+            for column, f in zip(header['columns'], column_files.values()):
+                out.seek(column['offset'])
+                with open(f.name, 'rb') as data:
+                    shutil.copyfileobj(data, out, 1 << 20)
+            out.truncate(offset)
+        os.replace(tmp_path, path)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return path
+
+
+def is_valid(csv_file, header):
+    """Same file (size and mtime), or same content after a touch."""
+    stat = os.stat(csv_file)
+    if (header['size'], header['mtime_ns']) == (stat.st_size, stat.st_mtime_ns):
+        return True
+    if header['size'] != stat.st_size or header['digest'] != file_hash(csv_file):
+        return False
+    # content unchanged, remember the new mtime so the file is not hashed again
+    header['mtime_ns'] = stat.st_mtime_ns
+    try:
+        with open(cache_file(csv_file), 'r+b') as f:
+            size = header.pop('header_size')
+            write_header(f, header, size)
+            header['header_size'] = size
+    except (OSError, ValueError):
+        pass
+    return True
+
+
+def load_peaks(csv_file):
+    """Memory-mapped columns of the peak list, the cache is (re)built if needed.
+
+    Returns ({column name: array}, spectrum names).
+    """
+    path = cache_file(csv_file)
+    header = None
+    try:
+        header = read_header(path)
+        if not is_valid(csv_file, header):
+            header = None
+    except (OSError, ValueError, KeyError):
+        header = None
+    if header is None:
+        build_cache(csv_file)
+        header = read_header(path)
+
+    columns = {}
+    for column in header['columns']:
+        if header['rows']:
+            columns[column['name']] = np.memmap(path, dtype=column['dtype'], mode='r',
+                                                offset=column['offset'], shape=(header['rows'],))
+        else:
+            columns[column['name']] = np.empty(0, dtype=column['dtype'])
+    return columns, header['spectra']
+
+
+def iter_chunks(csv_file, columns, chunksize=None):
+    """DataFrames of the requested columns, chunksize rows at a time."""
+    table, _ = load_peaks(csv_file)
+    yield from table_chunks(table, columns, chunksize)
+
+
+def table_chunks(table, columns, chunksize=None):
+    """DataFrames of the requested columns of loaded columns (see load_peaks), chunksize rows at a time."""
+    import pandas as pd
+    if not table:
+        # header only, no peak at all
+        yield pd.DataFrame(columns=columns)
+        return
+    rows = len(next(iter(table.values())))
+    step = chunksize or max(rows, 1)
+    for start in range(0, max(rows, 1), step):
+        yield pd.DataFrame({name: np.asarray(table[name][start:start + step]) for name in columns})
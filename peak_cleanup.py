@@ -0,0 +1,161 @@
+#! /usr/bin/python3
+import numpy as np
+import pandas as pd
+
+import metrics
+from fileutils import replace_file
+
+'''
+Diagonal and near-duplicate peak cleanup of a peak list before cyana.
+
+Diagonal peaks have the same proton shift on both proton dimensions
+(Pos F1 ~ Pos F3 in the 13C NOESY). Near-duplicates are the same peak
+picked several times within a few thousandths of a ppm; the one with the
+strongest |Volume| is kept.
+
+The duplicates are found with a hashed grid: every peak falls in a cell of
+one tolerance per dimension, so its duplicates can only be in the same or
+a neighbouring cell. Cells are matched with a sort and binary searches,
+the whole run stays about linear in the number of peaks (no pairwise
+comparison).
+
+kept, report = clean_peaks(peaks, dims=['H', 'H', 'C'], diagonal=(0, 1))
+'''
+
+default_tolerances = {'H': 0.005, 'C': 0.05, 'N': 0.05}
+diagonal_tolerance = 0.02
+
+report_columns = ['Row', 'Reason', 'Kept Row']
+
+
+def diagonal_peaks(positions, pair, tolerance=diagonal_tolerance):
+    """Mask of the peaks with the same shift (within tolerance) on the two dimensions of pair."""
+    first, second = pair
+    return np.abs(positions[first] - positions[second]) <= tolerance
+
+
+def grid_keys(cells):
+    """One int64 key per grid cell (cells: integer array, one column per dimension)."""
+    low = cells.min(axis=0) - 1
+    sizes = cells.max(axis=0) - low + 2
+    if np.prod(sizes.astype(float)) >= 2**62:
+        raise ValueError("Tolerances too small for the shift range, grid does not fit")
+    shifted = cells - low
+    keys = np.zeros(len(cells), dtype=np.int64)
+    for d in range(cells.shape[1]):
+        keys = keys * sizes[d] + shifted[:, d]
+    return keys, sizes
+
+
+def close_pairs(positions, tolerances):
+    """(i, j) pairs closer than the tolerance on every dimension, every pair once."""
+    points = np.column_stack(positions)
+    n, n_dims = points.shape
+    if n < 2:
+        empty = np.empty(0, np.int64)
+        return empty, empty
+    cells = np.floor(points / tolerances).astype(np.int64)
+    keys, sizes = grid_keys(cells)
+    # work in key order: the neighbour keys stay sorted, the binary searches are cheap
+    order = np.argsort(keys, kind='stable')
+    keys = keys[order]
+    points = points[order]
+
+    # stride of every dimension in the key
+    strides = np.ones(n_dims, dtype=np.int64)
+    for d in range(n_dims - 2, -1, -1):
+        strides[d] = strides[d + 1] * sizes[d + 1]
+
+    firsts, seconds = [], []
+    # the same cell and the neighbouring cells (-1, 0, +1 on every dimension)
+    for offset in np.array(np.meshgrid(*[[-1, 0, 1]] * n_dims, indexing='ij')).reshape(n_dims, -1).T:
+        delta = offset @ strides
+        if delta < 0:
+            continue  # found from the other cell
+        neighbour = keys + delta
+        low = np.searchsorted(keys, neighbour, side='left')
+        high = np.searchsorted(keys, neighbour, side='right')
+        if delta == 0:
+            # same cell: only the peaks after this one, every pair once
+            low = np.arange(1, n + 1)
+        counts = high - low
+        first = np.repeat(np.arange(n), counts)
+        second = np.repeat(low - (np.cumsum(counts) - counts), counts) + np.arange(counts.sum())
+        close = (np.abs(points[first] - points[second]) <= tolerances).all(axis=1)
+        firsts.append(order[first[close]])
+        seconds.append(order[second[close]])
+    return np.concatenate(firsts), np.concatenate(seconds)
+
+
+def cluster_labels(n, first, second):
+    """Connected groups of the pairs, labelled by their smallest member."""
+    labels = np.arange(n)
+    while True:
+        low = np.minimum(labels[first], labels[second])
+        new = labels.copy()
+        np.minimum.at(new, first, low)
+        np.minimum.at(new, second, low)
+        new = new[new]  # pointer jumping
+        if np.array_equal(new, labels):
+            return labels
+        labels = new
+
+
+def strongest(labels, volumes):
+    """Row kept for every peak: the strongest |Volume| of its group (first row on ties)."""
+    n = len(labels)
+    order = np.lexsort((np.arange(n), -np.abs(np.nan_to_num(volumes)), labels))
+    sorted_labels = labels[order]
+    heads = np.r_[True, sorted_labels[1:] != sorted_labels[:-1]]
+    best = order[heads]
+    kept = np.empty(n, dtype=np.int64)
+    kept[order] = np.repeat(best, np.diff(np.r_[np.flatnonzero(heads), n]))
+    return kept
+
+
+def clean_peaks(peaks, dims, diagonal=None, tolerances=None, diagonal_tol=diagonal_tolerance,
+                volume='Volume', stats=None):
+    """Remove the diagonal peaks and merge the near-duplicates of a peak list.
+
+    peaks: DataFrame with the positions in its first len(dims) columns
+    dims: nucleus of every dimension ('H', 'C', 'N')
+    diagonal: (proton dimension, proton dimension) of the diagonal, None to keep it
+    Returns the kept peaks (in their order) and the report of the removed
+    ones (1-based row in peaks, reason, row of the peak kept instead).
+    """
+    tolerances = {**default_tolerances, **(tolerances or {})}
+    positions = [pd.to_numeric(peaks.iloc[:, d], errors='coerce').to_numpy(np.float64) for d in range(len(dims))]
+    n = len(peaks)
+    reason = np.full(n, '', dtype=object)
+    kept_row = np.zeros(n, dtype=np.int64)
+
+    if diagonal is not None:
+        reason[diagonal_peaks(positions, diagonal, diagonal_tol)] = 'diagonal'
+    # peaks without a position are never merged
+    rest = np.flatnonzero((reason == '') & np.isfinite(np.column_stack(positions)).all(axis=1))
+
+    first, second = close_pairs([p[rest] for p in positions], np.array([tolerances[d] for d in dims]))
+    labels = cluster_labels(len(rest), first, second)
+    best = rest[strongest(labels, peaks[volume].to_numpy(np.float64)[rest])]
+    merged = best != rest
+    reason[rest[merged]] = 'duplicate'
+    kept_row[rest[merged]] = best[merged] + 1
+
+    removed = np.flatnonzero(reason != '')
+    report = pd.DataFrame({'Row': removed + 1, 'Reason': reason[removed],
+                           'Kept Row': pd.array(kept_row[removed], dtype='Int64')}, columns=report_columns)
+    report.loc[report['Reason'] == 'diagonal', 'Kept Row'] = pd.NA
+    for d, column in enumerate(peaks.columns[:len(dims)]):
+        report[column] = positions[d][removed]
+    report[volume] = peaks[volume].to_numpy()[removed]
+
+    if stats is not None:
+        for name in ('diagonal', 'duplicate'):
+            metrics.add_filtered(stats, f'{name} peaks', int((report['Reason'] == name).sum()))
+    return peaks.iloc[np.flatnonzero(reason == '')].reset_index(drop=True), report
+
+
+def write_report(report, output_file):
+    """Removed peaks as CSV, with the reason and the row kept instead."""
+    with replace_file(output_file, newline='') as f:
+        report.to_csv(f, index=False)
@@ -0,0 +1,468 @@
+#! /usr/bin/python3
+import argparse
+import json
+import mmap
+import os
+
+import numpy as np
+
+import metrics
+import model
+import peak_cache
+import spectra
+import to_xeasy
+from fileutils import compression_of, file_hash, read_bytes
+
+'''
+Incremental update of the xeasy peak files, the peak numbers are kept
+across exports.
+
+Every peak of a CCPN export is named by its _object
+(<PK:spectrum.peak_list.serial: ...>). Next to 13C.peaks, 13C.peaks.peakindex
+keeps for every peak its key (peak list and serial), its xeasy number, the
+byte range of its record (peak line and continuation lines) in the .peaks
+and its positions and volume. On the next export the new peak list is
+diffed against the index:
+
+    unchanged  the record is copied as it is, with the assignments
+               edited by hand
+    moved      positions or volume changed: written again, same number
+    removed    left out, its number is never given again
+    added      appended, numbered after the largest number ever given
+
+so cyana sees the same peak numbers run after run. Only the moved and added
+peaks are formatted (and assigned); the rest of the file is copied in a few
+large slices, one per change. A new cyana version, other shifts or
+tolerances, or an export without peak serials start again from a full
+conversion. The CSV itself is read through the peak cache (see peak_cache),
+which parses a changed export again.
+
+python peak_index.py WORKDIR [--version 3] [--prot attib_cyana.prot]
+'''
+
+suffix = to_xeasy.peak_index_suffix
+magic = b'CYCYPI01'
+# serial in the low bits of the key, peak list above
+serial_bits = 40
+# longest position field read from a .peaks
+field_width = 32
+
+
+def index_file(peaks_file):
+    return peaks_file + suffix
+
+
+def peak_keys(peaks):
+    """Key of every peak of a model.PeakTable, None when some peaks have no serial or share one."""
+    if peaks.serial is None or peaks.peak_list is None:
+        return None
+    serial = np.asarray(peaks.serial, dtype=np.int64)
+    keys = (np.asarray(peaks.peak_list, dtype=np.int64) << serial_bits) | serial
+    # CCPN exports its peaks by serial: usually sorted already, a stable sort then costs one pass
+    ordered = np.sort(keys, kind='stable')
+    if (serial < 0).any() or (ordered[1:] == ordered[:-1]).any():
+        return None
+    return keys
+
+
+def peak_values(peaks):
+    """Positions then volume of every peak, one row per peak."""
+    return np.column_stack(peaks.positions + [peaks.volume]) if len(peaks) else np.empty((0, peaks.n_dims + 1))
+
+
+def same_values(old, new):
+    """Rows with the same bits (NaN equal to NaN, -0.0 not equal to 0.0: the text written differs)."""
+    old = np.ascontiguousarray(old, dtype=np.float64)
+    new = np.ascontiguousarray(new, dtype=np.float64)
+    return (old.view(np.int64) == new.view(np.int64)).all(axis=1)
+
+
+def signature(spectrum, version, shifts=None, tolerances=None):
+    """What the records depend on besides the peaks; None when it cannot be told (shifts in memory)."""
+    if shifts is not None and not isinstance(shifts, str):
+        return None
+    return {'header': spectrum.header(version),
+            'shifts': file_hash(shifts) if shifts is not None else None,
+            'tolerances': [[nucleus, value] for nucleus, value in sorted((tolerances or {}).items())]}
+
+
+def scan_records(peaks_file):
+    """Offset and length of every record of a .peaks file, and the size of its header.
+
+    Offsets in the decompressed text of a compressed .peaks (see read_records).
+    """
+    if compression_of(peaks_file):
+        data = np.frombuffer(read_bytes(peaks_file), dtype=np.uint8)
+    else:
+        data = np.fromfile(peaks_file, dtype=np.uint8)
+    starts = np.r_[0, np.flatnonzero(data == ord('\n')) + 1]
+    starts = starts[starts < len(data)]
+    first = data[starts]
+    # continuation lines start with a tab, the header lines with '#'
+    records = starts[~np.isin(first, np.frombuffer(b'#\t \r\n', dtype=np.uint8))]
+    lengths = np.diff(np.r_[records, len(data)])
+    header = int(records[0]) if len(records) else len(data)
+    return data, records.astype(np.int64), lengths.astype(np.int64), header
+
+
+def record_numbers(data, records):
+    """xeasy number of every record (first field of its peak line)."""
+    return np.array([int(bytes(data[start:start + 24]).split(None, 1)[0]) for start in records.tolist()],
+                    dtype=np.int64)
+
+
+def field_floats(data, starts, ends, chunk=100000):
+    """Floats of the text fields data[starts:ends] (NaN when empty or missing), parsed by NumPy by chunks."""
+    values = np.empty(len(starts), dtype=np.float64)
+    # no wider than the longest field
+    width = int(min(np.max(ends - starts, initial=3), field_width))
+    for begin in range(0, len(starts), chunk):
+        start, end = starts[begin:begin + chunk], ends[begin:begin + chunk]
+        ok = (end > start) & (end - start <= width)
+        at = start[:, None] + np.arange(width)
+        text = np.where(ok[:, None] & (at < end[:, None]), data[np.minimum(at, len(data) - 1)], 0).astype(np.uint8)
+        text[~ok, :3] = np.frombuffer(b'nan', dtype=np.uint8)
+        try:
+            values[begin:begin + chunk] = np.ascontiguousarray(text).view(f'S{width}').ravel().astype(np.float64)
+        except ValueError:
+            # a field that is not a number, one at a time
+            values[begin:begin + chunk] = [float_or_nan(bytes(row).rstrip(b'\0')) for row in text]
+    return values
+
+
+def float_or_nan(text):
+    try:
+        return float(text)
+    except ValueError:
+        return float('nan')
+
+
+def read_records(peaks_file, n_dims, dims=None, volume=False, colors=b'12'):
+    """Peak numbers, positions ({dimension: array}) and colour code offset of every record of a .peaks.
+
+    dims: dimensions read (all by default).
+    volume: read the volumes as well (NaN when missing).
+    The offset is -1 when the colour code is not one of colors (set by hand, left alone).
+    """
+    data, records, lengths, _ = scan_records(peaks_file)
+    tabs = np.flatnonzero(data == ord('\t'))
+    first = np.searchsorted(tabs, records)
+    ends = records + lengths
+
+    def field(k):
+        # bytes of field k of every record (0: number), start == end when missing
+        before = first + k - 1
+        valid = before + 1 < len(tabs)
+        start = np.where(valid, tabs[np.minimum(before, len(tabs) - 1)] + 1, ends) if k else records
+        end = np.where(valid, tabs[np.minimum(before + 1, len(tabs) - 1)], ends)
+        inside = valid & (end < ends)
+        return np.where(inside, start, ends), np.where(inside, end, ends)
+
+    positions = {d: field_floats(data, *field(d + 1)) for d in (range(n_dims) if dims is None else dims)}
+    start, end = field(n_dims + 1)
+    single = (end - start == 1)
+    codes = data[np.minimum(start, len(data) - 1)]
+    color_at = np.where(single & np.isin(codes, np.frombuffer(colors, dtype=np.uint8)), start, -1)
+    numbers = np.nan_to_num(field_floats(data, *field(0)), nan=-1).astype(np.int64)
+    records = {'number': numbers, 'positions': positions, 'color_at': color_at}
+    if volume:
+        # number, positions, colour code, U, volume
+        records['volume'] = field_floats(data, *field(n_dims + 3))
+    return records
+
+
+def write_index(peaks_file, meta, key, number, offset, length, values):
+    """Write the index, columns after a JSON header as in the peak cache (see peak_cache)."""
+    columns = {'key': key, 'number': number, 'offset': offset, 'length': length, 'values': values}
+    columns = {name: np.ascontiguousarray(array, dtype='<f8' if name == 'values' else '<i8')
+               for name, array in columns.items()}
+    header = {**meta, 'peaks': file_stat(peaks_file), 'rows': len(key), 'columns': []}
+    header_size = peak_cache.aligned(len(json.dumps(header)) + 200 * len(columns) + 1024)
+    position = header_size
+    for name, array in columns.items():
+        header['columns'].append({'name': name, 'dtype': array.dtype.str, 'shape': list(array.shape),
+                                  'offset': position})
+        position = peak_cache.aligned(position + array.nbytes)
+    path = index_file(peaks_file)
+    with open(path + '.tmp', 'wb') as f:
+        peak_cache.write_header(f, header, header_size, magic)
+        for column, array in zip(header['columns'], columns.values()):
+            f.seek(column['offset'])
+            array.tofile(f)
+        f.truncate(position)
+    os.replace(path + '.tmp', path)
+
+
+def read_index(peaks_file, arrays=True, mode='r'):
+    """Index of a peak file: memory-mapped columns plus its header as 'meta' (only 'meta' without arrays).
+
+    None when there is no index.
+    """
+    path = index_file(peaks_file)
+    try:
+        header = peak_cache.read_header(path, magic)
+    except (OSError, ValueError, KeyError):
+        return None
+    index = {'meta': header}
+    if arrays:
+        for column in header['columns']:
+            shape = tuple(column['shape'])
+            index[column['name']] = (np.memmap(path, dtype=column['dtype'], mode=mode, offset=column['offset'],
+                                               shape=shape) if header['rows'] else np.empty(shape, column['dtype']))
+    return index
+
+
+def write_meta(peaks_file, header):
+    """Header of an index updated in place."""
+    header = dict(header)
+    size = header.pop('header_size')
+    header['peaks'] = file_stat(peaks_file)
+    with open(index_file(peaks_file), 'r+b') as f:
+        peak_cache.write_header(f, header, size, magic)
+
+
+def file_stat(path):
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def up_to_date(meta, spectrum):
+    """Same export and same .peaks as when the index was written."""
+    try:
+        return meta.get('csv') == file_stat(spectrum.csv) and meta.get('peaks') == file_stat(spectrum.peaks)
+    except OSError:
+        return False
+
+
+def rescan(index, peaks_file):
+    """Index of a .peaks edited since it was written, records matched on their number.
+
+    Records not in the index (added by hand) get the key -1 and are left
+    alone; the peaks no longer in the file count as removed.
+    """
+    data, records, lengths, _ = scan_records(peaks_file)
+    numbers = record_numbers(data, records)
+    order = np.argsort(index['number'])
+    at = np.minimum(np.searchsorted(index['number'][order], numbers), max(len(order) - 1, 0))
+    found = (index['number'][order][at] == numbers) if len(order) else np.zeros(len(numbers), dtype=bool)
+    # a number twice: only the first record keeps the peak
+    first = np.zeros(len(numbers), dtype=bool)
+    first[np.unique(numbers, return_index=True)[1]] = True
+    found &= first
+    rows = order[at]
+    values = np.full((len(numbers), index['values'].shape[1]), np.nan)
+    values[found] = index['values'][rows[found]]
+    return {'key': np.where(found, index['key'][rows] if len(order) else -1, -1), 'number': numbers,
+            'offset': records, 'length': lengths, 'values': values, 'meta': index['meta']}
+
+
+def record_texts(spectrum, peaks, rows, numbers, assigner=None):
+    """xeasy record of every row of the peak table, as the full conversion writes it."""
+    if assigner is None:
+        table = peaks.positions + [peaks.volume]
+        return [to_xeasy.peak_line(number, [float(column[row]) for column in table], spectrum.n_dims).encode('utf-8')
+                for row, number in zip(rows.tolist(), numbers.tolist())]
+    import pandas as pd
+    frame = pd.DataFrame({name: column[rows]
+                          for name, column in zip(spectrum.columns, peaks.positions + [peaks.volume])})
+    candidates = assigner(frame)
+    lines = to_xeasy.change_format(frame, n_dims=spectrum.n_dims)
+    lines['Index'] = numbers
+    lines = to_xeasy.add_assignments(lines, candidates, spectrum.n_dims)
+    records = []
+    for line in lines.to_csv(index=False, header=False, sep='\t').splitlines(keepends=True):
+        if records and line.startswith('\t'):
+            records[-1] += line
+        else:
+            records.append(line)
+    return [record.encode('utf-8') for record in records]
+
+
+def full_conversion(spectrum, version, keys, values, meta, shifts=None, tolerances=None, progress=None):
+    """Convert the whole peak list, numbered from 1, and index it.
+
+    The .peaks is replaced once complete (see fileutils.replace_file), a
+    cancelled conversion leaves the previous one.
+    """
+    stats = to_xeasy.convert_spectrum(spectrum, version, shifts=shifts, tolerances=tolerances, progress=progress)
+    if keys is None or meta['signature'] is None:
+        return stats
+    _, records, lengths, _ = scan_records(spectrum.peaks)
+    if len(records) != len(keys):
+        return stats
+    write_index(spectrum.peaks, {**meta, 'next_number': len(keys) + 1}, keys,
+                np.arange(1, len(keys) + 1, dtype=np.int64), records, lengths, values)
+    return stats
+
+
+def update_spectrum(spectrum, version, shifts=None, tolerances=None, progress=None):
+    """Bring the .peaks of a spectrum up to date with its export, return its stats (see metrics.new_stats).
+
+    shifts: final .prot file to assign the moved and added peaks.
+    """
+    stats = metrics.new_stats()
+    # a cancel stops here, before anything is written
+    metrics.report(progress, spectrum.name, 0)
+    meta = {'signature': signature(spectrum, version, shifts, tolerances), 'n_dims': spectrum.n_dims,
+            'csv': file_stat(spectrum.csv)}
+    known = read_index(spectrum.peaks, arrays=False) if os.path.exists(spectrum.peaks) else None
+    if known is not None and meta['signature'] is not None and known['meta'].get('signature') == meta['signature']:
+        if up_to_date(known['meta'], spectrum):
+            # nothing changed since the last update
+            return stats
+
+    peaks = model.load_peaks(spectrum)
+    keys = peak_keys(peaks)
+    values = peak_values(peaks)
+    index = read_index(spectrum.peaks) if known is not None and keys is not None else None
+    if (index is None or meta['signature'] is None or index['meta'].get('signature') != meta['signature']
+            or index['values'].shape[1] != values.shape[1]):
+        return full_conversion(spectrum, version, keys, values, meta, shifts, tolerances, progress)
+    rescanned = index['meta'].get('peaks') != file_stat(spectrum.peaks)
+    if rescanned:
+        index = rescan(index, spectrum.peaks)
+
+    stats['rows_read'] += len(keys)
+    old_keys = index['key']
+    if len(old_keys) == len(keys) and (old_keys == keys).all():
+        # same peaks in the same order, the usual re-export
+        old = np.arange(len(keys))
+        found = np.ones(len(keys), dtype=bool)
+        changed = np.flatnonzero(~same_values(index['values'], values))
+    else:
+        order = np.argsort(old_keys, kind='stable')
+        at = np.minimum(np.searchsorted(old_keys[order], keys), max(len(order) - 1, 0))
+        old = order[at]
+        found = (old_keys[old] == keys) if len(order) else np.zeros(len(keys), dtype=bool)
+        changed = np.flatnonzero(found)[~same_values(index['values'][old[found]], values[found])]
+    present = np.zeros(len(old_keys), dtype=bool)
+    present[old[found]] = True
+    removed = ~present & (old_keys >= 0)
+    added = np.flatnonzero(~found)
+    metrics.add_filtered(stats, 'removed peaks', int(removed.sum()))
+    next_number = int(index['meta']['next_number'])
+    meta = {**meta, 'next_number': next_number + len(added)}
+    if not (len(changed) or len(added) or removed.any()):
+        # new export, same peaks: only the index learns the new CSV (and the records edited by hand)
+        if rescanned:
+            write_index(spectrum.peaks, meta, index['key'], index['number'], index['offset'], index['length'],
+                        index['values'])
+        else:
+            write_meta(spectrum.peaks, {**index['meta'], **meta})
+        metrics.report(progress, spectrum.name, len(keys))
+        return stats
+
+    rows = np.r_[changed, added]
+    numbers = np.r_[index['number'][old[changed]], np.arange(next_number, next_number + len(added))]
+    assigner = None
+    if shifts is not None:
+        assigner = to_xeasy.peak_assigner(model.load_shifts(shifts), spectrum.nuclei, spectrum.bonded, tolerances)
+    texts = record_texts(spectrum, peaks, rows, numbers, assigner)
+    stats['rows_written'] += len(texts)
+    moved = dict(zip(old[changed].tolist(), texts[:len(changed)]))
+
+    if (not (rescanned or len(added) or removed.any())
+            and all(len(text) == index['length'][row] for row, text in moved.items())):
+        # a few peaks edited, same line lengths: both files are patched in place
+        patch_file(spectrum.peaks, {int(index['offset'][row]): text for row, text in moved.items()})
+        del index
+        index = read_index(spectrum.peaks, mode='r+')
+        index['values'][old[changed]] = values[changed]
+        index['values'].flush()
+        write_meta(spectrum.peaks, {**index['meta'], **meta})
+    else:
+        rewrite(spectrum.peaks, index, moved, values[changed], removed, texts[len(changed):], keys[added],
+                values[added], meta)
+    metrics.report(progress, spectrum.name, len(keys))
+    return stats
+
+
+def patch_file(path, patches):
+    """Write {offset: bytes} into the file in place; on an error the bytes already replaced are put back."""
+    replaced = []
+    with open(path, 'r+b') as f:
+        try:
+            for offset, data in patches.items():
+                f.seek(offset)
+                replaced.append((offset, f.read(len(data))))
+                f.seek(offset)
+                f.write(data)
+            f.flush()
+        except BaseException:
+            for offset, data in reversed(replaced):
+                f.seek(offset)
+                f.write(data)
+            raise
+
+
+def rewrite(peaks_file, index, moved, moved_values, removed, added_texts, added_keys, added_values, meta):
+    """Write the .peaks again, then its index.
+
+    The unchanged records are copied by slices, moved {index row: record}
+    replaces its records, the removed rows are left out and the added
+    records appended.
+    """
+    offset, length = np.array(index['offset']), np.array(index['length'])
+    moved_rows = np.array(list(moved), dtype=np.int64)
+    # records rewritten (moved) or left out (removed), in file order
+    touched = np.union1d(np.flatnonzero(removed), moved_rows)
+    touched = touched[np.argsort(offset[touched], kind='stable')]
+    tmp_file = peaks_file + '.tmp'
+    with open(peaks_file, 'rb') as f, open(tmp_file, 'wb') as out:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(data)
+        try:
+            cursor = 0
+            for row in touched.tolist():
+                out.write(view[cursor:offset[row]])
+                out.write(moved.get(row, b''))
+                cursor = offset[row] + length[row]
+            out.write(view[cursor:])
+            end = len(data)
+        finally:
+            view.release()
+            data.close()
+        out.writelines(added_texts)
+
+    # the records after a rewritten one move by the change of length before them
+    delta = np.array([len(moved.get(row, b'')) - length[row] for row in touched.tolist()], dtype=np.int64)
+    before = np.searchsorted(offset[touched], offset, side='left')
+    new_offset = offset + np.r_[0, np.cumsum(delta)][before]
+    length[moved_rows] = [len(moved[row]) for row in moved_rows.tolist()]
+    new_values = np.array(index['values'])
+    new_values[moved_rows] = moved_values
+    kept = ~removed
+    added_length = np.array([len(text) for text in added_texts], dtype=np.int64)
+    added_offset = end + int(delta.sum()) + np.cumsum(added_length) - added_length
+    first_number = meta['next_number'] - len(added_texts)
+
+    os.replace(tmp_file, peaks_file)
+    write_index(peaks_file, meta, np.r_[index['key'][kept], added_keys],
+                np.r_[index['number'][kept], np.arange(first_number, meta['next_number'])],
+                np.r_[new_offset[kept], added_offset], np.r_[length[kept], added_length],
+                np.r_[new_values[kept], added_values])
+
+
+def update_spectra(spectrum_list, version, stats=None, shifts=None, tolerances=None):
+    """update_spectrum on every spectrum, return their stats."""
+    results = [update_spectrum(spectrum, version, shifts, tolerances) for spectrum in spectrum_list]
+    if stats is not None:
+        for result in results:
+            metrics.add_stats(stats, result)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Update the xeasy peak files of a working directory, "
+                                                 "keeping the peak numbers")
+    parser.add_argument('save_path')
+    parser.add_argument('--version', type=int, default=2, choices=[2, 3])
+    parser.add_argument('--prot', help="final .prot, to assign the new and moved peaks")
+    args = parser.parse_args()
+    stats = metrics.new_stats()
+    update_spectra(spectra.project_spectra(args.save_path), args.version, stats, args.prot)
+    print(metrics.format_stages([{'name': 'to_xeasy', 'ok': True, 'metrics': stats}]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+#! /usr/bin/python3
+import os
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import metrics
+from fileutils import tmp_suffix
+
+'''
+Small task-graph scheduler for the conversion stages.
+
+Every stage declares the files it reads (inputs) and the files it writes
+(outputs). A stage that reads the output of another stage only starts once
+that stage is done and its outputs exist; independent stages run at the same
+time in a thread pool.
+
+With a metrics.Progress, a cancelled run stops the running stages at their
+next progress report, removes the files they had started to write and
+skips the stages not started yet. The outputs are written to <path>.tmp
+and renamed once complete (see fileutils.replace_file), or patched in
+place with the old bytes put back on an error (peak_index, symmetry): a
+cancel only removes the .tmp left, the outputs of the previous run stay.
+'''
+
+
+class Stage:
+    """One conversion step with its declared input and output files."""
+
+    def __init__(self, name, func, inputs=(), outputs=(), stats=None):
+        self.name = name
+        self.func = func
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        # counters filled by func while it runs (see metrics.new_stats)
+        self.stats = stats if stats is not None else metrics.new_stats()
+
+    def __repr__(self):
+        return f"Stage({self.name!r}, inputs={self.inputs}, outputs={self.outputs})"
+
+
+def stage_dependencies(stages):
+    """Map every stage name to the names of the stages producing its inputs."""
+    producers = {}
+    for stage in stages:
+        for path in stage.outputs:
+            if path in producers:
+                raise ValueError(f"{path} is written by both {producers[path]} and {stage.name}")
+            producers[path] = stage.name
+
+    deps = {}
+    for stage in stages:
+        deps[stage.name] = {producers[path] for path in stage.inputs
+                            if path in producers and producers[path] != stage.name}
+
+    # refuse cycles, they would wait forever
+    done = set()
+    remaining = dict(deps)
+    while remaining:
+        ready = [name for name, d in remaining.items() if d <= done]
+        if not ready:
+            raise ValueError(f"Dependency cycle between stages: {sorted(remaining)}")
+        for name in ready:
+            done.add(name)
+            del remaining[name]
+    return deps
+
+
+def remove_temporary(paths):
+    """Remove the temporary files (<path>.tmp) left by a cancelled or failed stage."""
+    for path in paths:
+        try:
+            os.remove(path + tmp_suffix)
+        except OSError:
+            pass
+
+
+def run_stage(stage):
+    """Run one stage and capture its result or its error."""
+    start = time.perf_counter()
+    result = {'name': stage.name, 'ok': True, 'outputs': stage.outputs,
+              'error': None, 'traceback': None}
+    try:
+        missing = [path for path in stage.inputs if not os.path.exists(path)]
+        if missing:
+            raise FileNotFoundError(f"Missing input file(s): {', '.join(missing)}")
+        stage.func()
+        missing = [path for path in stage.outputs if not os.path.exists(path)]
+        if missing:
+            raise RuntimeError(f"Stage did not write: {', '.join(missing)}")
+    except metrics.Cancelled:
+        result['ok'] = False
+        result['error'] = "Cancelled"
+        remove_temporary(stage.outputs)
+    except Exception as e:
+        result['ok'] = False
+        result['error'] = f"{type(e).__name__}: {e}"
+        result['traceback'] = traceback.format_exc()
+        remove_temporary(stage.outputs)
+    result['time'] = time.perf_counter() - start
+    result['metrics'] = stage.stats
+    # high-water mark of the process, shared with the stages running alongside
+    result['process_peak_rss'] = metrics.process_peak_rss()
+    metrics.log_stage(result)
+    return result
+
+
+def skipped(stage, failed):
+    return {'name': stage.name, 'ok': False, 'outputs': stage.outputs,
+            'error': f"Skipped: {', '.join(sorted(failed))} failed" if failed else "Cancelled",
+            'traceback': None, 'time': 0.0, 'metrics': stage.stats, 'process_peak_rss': None}
+
+
+def run_stages(stages, max_workers=None, progress=None):
+    """Run the stages as soon as their dependencies are done.
+
+    progress: metrics.Progress of the run, the stages not started when it
+    is cancelled are skipped.
+
+    Returns one result dict per stage, in the order the stages were given.
+    """
+    deps = stage_dependencies(stages)
+    by_name = {stage.name: stage for stage in stages}
+    results = {}
+    pending = set(by_name)
+    running = {}
+
+    with ThreadPoolExecutor(max_workers=max_workers or len(stages) or 1) as pool:
+        while pending or running:
+            # start everything whose dependencies are finished
+            for name in sorted(pending):
+                if not deps[name] <= set(results):
+                    continue
+                pending.discard(name)
+                failed = {d for d in deps[name] if not results[d]['ok']}
+                if failed or (progress is not None and progress.cancelled):
+                    results[name] = skipped(by_name[name], failed)
+                else:
+                    running[pool.submit(run_stage, by_name[name])] = name
+
+            if not running:
+                continue
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                results[running.pop(future)] = future.result()
+
+    return [results[stage.name] for stage in stages]
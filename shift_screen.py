@@ -0,0 +1,186 @@
+#! /usr/bin/python3
+import csv
+import math
+import os
+
+import metrics
+import model
+from fileutils import replace_file
+
+'''
+Sanity check of the shift list before it goes into the cyana .prot.
+
+Every shift (mean of its (SequenceCode, AtomName) group) gets the z-score
+(value - mean) / sd against the reference statistics of its residue type
+and atom (shift_stats.csv, BMRB averages, bundled with the tool). A shift
+more than z_limit standard deviations away is an outlier, most often a
+misassigned atom. The groups whose merged values spread over more than
+spread_limits (ppm, per nucleus) are reported too: the same atom was
+assigned to peaks that do not agree.
+
+Nothing is removed, the flagged shifts are listed in shift_outliers.csv.
+The residue type comes from prot.seq (file_to_prot.read_prot_seq). Big
+shift lists are scored with NumPy in one pass (screen_table): the residues
+and atoms become integer codes (as in model.ShiftTable), the reference of
+every distinct (residue type, atom) pair is looked up once and gathered
+into the rows by index. Small lists (the usual case, where importing
+NumPy would cost more than the check) are scored with plain floats.
+'''
+
+stats_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'shift_stats.csv')
+report_name = 'shift_outliers.csv'
+report_columns = ['SequenceCode', 'ResidueType', 'AtomName', 'Value (ppm)', 'Mean (ppm)', 'SD (ppm)',
+                  'Z', 'Spread (ppm)', 'Reason']
+
+z_limit = 4.0
+spread_limits = {'H': 0.1, 'C': 0.5, 'N': 0.5}
+# from this number of shifts on, the scores are computed with NumPy (screen_table)
+numpy_min_rows = 2000
+
+# reference tables already loaded in this process {path: table}
+loaded_tables = {}
+
+
+def load_stats(path=stats_file):
+    """{(residue type, atom): (mean, sd)} of the reference statistics."""
+    table = loaded_tables.get(path)
+    if table is None:
+        with open(path, 'r', newline='') as f:
+            rows = csv.DictReader(line for line in f if not line.startswith('#'))
+            table = {(row['Residue'].upper(), row['Atom'].upper()): (float(row['Mean']), float(row['SD']))
+                     for row in rows}
+        loaded_tables[path] = table
+    return table
+
+
+def reference_names(atom):
+    """Names under which the statistics of a CCPN atom can be found, the most specific first.
+
+    HB2 -> HB2, HB; HD1% -> HD1%, HD1, HD; HD21 -> HD21, HD2, HD
+    """
+    names = [atom]
+    name = atom.rstrip('%*#')
+    while name:
+        if name != names[-1]:
+            names.append(name)
+        if not name[-1].isdigit():
+            break
+        name = name[:-1]
+    return names
+
+
+def reference_of(residue, atom, table):
+    """(mean, sd) of an atom of a residue type, None when unknown."""
+    if residue is None or atom is None:
+        return None
+    residue = str(residue).upper()
+    for name in reference_names(str(atom).upper()):
+        found = table.get((residue, name))
+        if found is not None:
+            return found
+    return None
+
+
+def flag_shifts(values, means, sds, spreads, spread_max, z_max=z_limit):
+    """z-scores of the shifts and the indices of the outliers and of the too wide groups, in plain floats.
+
+    spread_max: largest spread allowed for every shift (NaN: not checked)
+    """
+    z = [(value - mean) / sd if sd == sd and sd else float('nan') for value, mean, sd in zip(values, means, sds)]
+    outliers = [i for i, score in enumerate(z) if abs(score) > z_max]
+    wide = [i for i, (spread, limit) in enumerate(zip(spreads, spread_max)) if spread > limit]
+    return z, outliers, wide
+
+
+def screen_shifts(codes, atoms, values, spreads, residue_map, table=None, z_max=z_limit, limits=None,
+                  stats=None):
+    """Outlier shifts and spread groups of a shift list, as report rows (see report_columns).
+
+    codes, atoms, values, spreads: one entry per (SequenceCode, AtomName)
+    group (spread: max - min of the merged values, 0.0 for a single one)
+    residue_map: {SequenceCode: residue type} of prot.seq
+    """
+    if len(values) >= numpy_min_rows:
+        residue, residue_names = model.encode(map(str, codes))
+        atom, atom_names = model.encode(atoms)
+        return screen_table(residue, residue_names, atom, atom_names, values, spreads, residue_map, table,
+                            z_max, limits, stats)
+    table = load_stats() if table is None else table
+    limits = {**spread_limits, **(limits or {})}
+    residues = list(map(residue_map.get, map(str, codes)))
+    keys = list(zip(residues, atoms))
+    # one look-up per residue type and atom, not per shift
+    nan = (float('nan'), float('nan'))
+    references = {key: reference_of(*key, table) or nan for key in set(keys)}
+    means, sds = zip(*map(references.__getitem__, keys)) if keys else ((), ())
+    nucleus_limits = {atom: limits.get(str(atom)[:1].upper(), float('nan')) for atom in set(atoms)}
+    spread_max = list(map(nucleus_limits.__getitem__, atoms))
+    z, outliers, wide = flag_shifts(values, means, sds, spreads, spread_max, z_max)
+    metrics.add_warnings(stats, 'shift outliers', len(outliers))
+    metrics.add_warnings(stats, 'shift spreads', len(wide))
+
+    reasons = {}
+    for i in outliers:
+        reasons[i] = ['z-score']
+    for i in wide:
+        reasons.setdefault(i, []).append('spread')
+    return [(codes[i], residues[i], atoms[i], values[i], means[i], sds[i], z[i], spreads[i], ' '.join(reasons[i]))
+            for i in sorted(reasons)]
+
+
+def screen_table(residue, residue_names, atom, atom_names, values, spreads, residue_map, table=None,
+                 z_max=z_limit, limits=None, stats=None):
+    """screen_shifts of a coded shift list, with NumPy.
+
+    residue, atom: integer codes of the SequenceCode and AtomName of every
+    shift in residue_names and atom_names (see model.ShiftTable)
+    """
+    import numpy as np
+    table = load_stats() if table is None else table
+    limits = {**spread_limits, **(limits or {})}
+    residue = np.asarray(residue, dtype=np.int64)
+    atom = np.asarray(atom, dtype=np.int64)
+    values = np.asarray(values, dtype=np.float64)
+    spreads = np.asarray(spreads, dtype=np.float64)
+
+    # residue type of every SequenceCode, then one reference per distinct (type, atom) pair
+    type_of, type_names = model.encode(residue_map.get(str(code)) for code in residue_names)
+    type_of = np.asarray(type_of, dtype=np.int64)
+    pairs = type_of[residue] * len(atom_names) + atom
+    references = np.full((len(type_names) * len(atom_names), 2), np.nan)
+    present = np.zeros(len(references), dtype=bool)
+    present[pairs] = True
+    for pair in np.flatnonzero(present).tolist():
+        found = reference_of(type_names[pair // len(atom_names)], atom_names[pair % len(atom_names)], table)
+        if found is not None:
+            references[pair] = found
+    means, sds = references[pairs, 0], references[pairs, 1]
+    spread_max = np.array([limits.get(str(name)[:1].upper(), np.nan) for name in atom_names] or [np.nan])[atom]
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        z = (values - means) / sds
+    z[~np.isfinite(z)] = np.nan
+    with np.errstate(invalid='ignore'):
+        outlier = np.abs(z) > z_max
+        wide = spreads > spread_max
+    metrics.add_warnings(stats, 'shift outliers', int(outlier.sum()))
+    metrics.add_warnings(stats, 'shift spreads', int(wide.sum()))
+
+    # report rows of the flagged shifts only, from plain lists
+    flagged = np.flatnonzero(outlier | wide)
+    reasons = ['', 'z-score', 'spread', 'z-score spread']
+    rows = zip(residue[flagged].tolist(), atom[flagged].tolist(), values[flagged].tolist(), means[flagged].tolist(),
+               sds[flagged].tolist(), z[flagged].tolist(), spreads[flagged].tolist(),
+               (outlier[flagged] + 2 * wide[flagged]).tolist())
+    return [(residue_names[code], type_names[type_of[code]], atom_names[name], value, mean, sd, score, spread,
+             reasons[reason]) for code, name, value, mean, sd, score, spread, reason in rows]
+
+
+def write_report(rows, output_file):
+    """Flagged shifts as CSV (header only when everything looks fine)."""
+    with replace_file(output_file, newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(report_columns)
+        for row in rows:
+            writer.writerow(['' if value is None or (isinstance(value, float) and math.isnan(value))
+                             else round(value, 4) if isinstance(value, float) else value for value in row])
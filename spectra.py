@@ -0,0 +1,154 @@
+#! /usr/bin/python3
+import json
+import os
+
+from fileutils import compression_of, compression_suffixes, existing
+
+'''
+Description of the peak lists to convert for cyana.
+
+Every spectrum declares its CCPN export, its xeasy output, its dimensions
+(cyana INAME and nucleus, in xeasy order), the CCPN position column of every
+dimension and the spectrum name for the cyana 2 and cyana 3 headers. The
+13C and 15N NOESY are built in; other spectra (aromatic 13C, 4D, HNCA ...)
+are described in a spectra.json in the working directory:
+
+[
+  {"name": "aro", "csv": "aro.csv", "peaks": "aro.peaks",
+   "inames": ["HC", "H", "C"], "nuclei": ["H", "H", "C"],
+   "positions": ["Pos F1", "Pos F3", "Pos F2"],
+   "spectrum_type": "C13NOESY", "cyana_format": "HhC",
+   "bonded": [[0, 2]], "diagonal": [0, 1]},
+  {"name": "HNCA", "csv": "HNCA.csv", "peaks": "HNCA.peaks",
+   "inames": ["HN", "N", "C"], "nuclei": ["H", "N", "C"],
+   "positions": ["Pos F1", "Pos F2", "Pos F3"],
+   "spectrum_type": "HNCA", "cyana_format": "HNC", "bonded": [[0, 1]]}
+]
+
+bonded: (proton dimension, heavy atom dimension) pairs of bound atoms,
+diagonal: the two proton dimensions of the diagonal (NOESY only).
+'''
+
+spectra_file = 'spectra.json'
+
+
+class Spectrum:
+    """One peak list: CCPN export in, xeasy peak file out."""
+
+    def __init__(self, name, csv, peaks, inames, nuclei, positions, spectrum_type, cyana_format,
+                 bonded=(), diagonal=None):
+        if not len(inames) == len(nuclei) == len(positions):
+            raise ValueError(f"{name}: inames, nuclei and positions need one entry per dimension")
+        self.name = name
+        self.csv = csv
+        self.peaks = peaks
+        self.inames = list(inames)
+        self.nuclei = list(nuclei)
+        self.positions = list(positions)
+        self.spectrum_type = spectrum_type
+        self.cyana_format = cyana_format
+        self.bonded = [tuple(pair) for pair in bonded]
+        self.diagonal = tuple(diagonal) if diagonal else None
+
+    def __repr__(self):
+        return f"Spectrum({self.name!r}, {' '.join(self.inames)})"
+
+    @property
+    def n_dims(self):
+        return len(self.inames)
+
+    @property
+    def proton_pair(self):
+        """(bound proton, free proton) dimensions of a NOESY, None without a bound proton on its diagonal."""
+        bound = [d for d, _ in self.bonded if self.diagonal and d in self.diagonal]
+        if not bound:
+            return None
+        return bound[0], next(d for d in self.diagonal if d != bound[0])
+
+    @property
+    def columns(self):
+        """CCPN columns read, in xeasy order."""
+        return self.positions + ['Volume']
+
+    @property
+    def stem(self):
+        """Peak file without its extensions (13C.peaks.gz -> 13C), for the files written next to it."""
+        root, extension = os.path.splitext(self.peaks)
+        if extension.lower() in compression_suffixes:
+            root = os.path.splitext(root)[0]
+        return root
+
+    @property
+    def cleanup_report(self):
+        return self.stem + '_cleanup.csv'
+
+    @property
+    def symmetry_report(self):
+        """Symmetry partners of the peaks in the other NOESY (see symmetry)."""
+        return self.stem + '_symmetry.csv'
+
+    @property
+    def upl(self):
+        """cyana upper limits of the calibrated volumes (see calibration)."""
+        return self.stem + '.upl'
+
+    def header(self, version):
+        """Header of the xeasy peak file for cyana 2 or 3."""
+        n = self.n_dims
+        text = f"# Number of dimensions {n}\n#FORMAT xeasy{n}D\n"
+        text += ''.join(f"#INAME {i} {iname}\n" for i, iname in enumerate(self.inames, 1))
+        if version == 3:
+            text += f"#SPECTRUM {self.spectrum_type}  {' '.join(self.inames)}\n"
+        elif version == 2:
+            text += f"#CYANAFORMAT {self.cyana_format}\n"
+        else:
+            raise ValueError(f"Unknown cyana version {version}, must be 2 or 3")
+        return text
+
+    def in_dir(self, path, compress=None):
+        """Same spectrum with its files in the directory path (the export can be compressed: 13C.csv.gz).
+
+        compress: '.gz' or '.zst' added to a .peaks not compressed yet.
+        """
+        spectrum = Spectrum(**self.to_dict())
+        spectrum.csv = existing(os.path.join(path, self.csv))
+        spectrum.peaks = os.path.join(path, self.peaks)
+        if compress and compression_of(spectrum.peaks, 'w') is None:
+            spectrum.peaks += compress
+        return spectrum
+
+    def to_dict(self):
+        return {'name': self.name, 'csv': self.csv, 'peaks': self.peaks, 'inames': self.inames,
+                'nuclei': self.nuclei, 'positions': self.positions, 'spectrum_type': self.spectrum_type,
+                'cyana_format': self.cyana_format, 'bonded': self.bonded, 'diagonal': self.diagonal}
+
+
+# HC H C: the 13C export has the carbon in Pos F2
+carbon_noesy = Spectrum('13C', '13C.csv', '13C.peaks', ['HC', 'H', 'C'], ['H', 'H', 'C'],
+                        ['Pos F1', 'Pos F3', 'Pos F2'], 'C13NOESY', 'HhC',
+                        bonded=[(0, 2)], diagonal=(0, 1))
+nitrogen_noesy = Spectrum('15N', '15N.csv', '15N.peaks', ['HN', 'H', 'N'], ['H', 'H', 'N'],
+                          ['Pos F1', 'Pos F2', 'Pos F3'], 'N15NOESY', 'HhN',
+                          bonded=[(0, 2)], diagonal=(0, 1))
+default_spectra = [carbon_noesy, nitrogen_noesy]
+
+
+def noesy_spectra(spectrum_list):
+    """The spectra with a diagonal (two proton dimensions): the NOESY."""
+    return [spectrum for spectrum in spectrum_list if spectrum.diagonal]
+
+
+def read_spectra(json_file):
+    """Spectrum descriptions of a spectra.json."""
+    with open(json_file, 'r') as f:
+        return [Spectrum(**description) for description in json.load(f)]
+
+
+def project_spectra(save_path, compress=None):
+    """Spectra of a working directory: its spectra.json, or the 13C and 15N NOESY.
+
+    compress: '.gz' or '.zst', the .peaks are written compressed.
+    """
+    json_file = os.path.join(save_path, spectra_file)
+    spectra = read_spectra(json_file) if os.path.exists(json_file) else default_spectra
+    return [spectrum.in_dir(save_path, compress) for spectrum in spectra]
@@ -0,0 +1,190 @@
+#! /usr/bin/python3
+import argparse
+import csv
+import os
+
+import numpy as np
+
+import metrics
+import peak_cleanup
+import peak_index
+import spectra
+from fileutils import compression_of, open_file, read_bytes, replace_file
+
+'''
+Cross-spectrum symmetry check of the NOESY peak lists.
+
+An NOE between an amide proton and an aliphatic proton is seen twice: in
+the 15N NOESY on the amide (HN 8.21, H 4.35) and in the 13C NOESY on the
+aliphatic proton (HC 4.35, H 8.21), the two proton shifts swapped. Every
+peak of a NOESY is looked up in the other NOESY with its bound and free
+proton shifts swapped; a peak with a partner within the tolerance on both
+proton dimensions is confirmed, the others are unconfirmed (mostly noise
+and artefacts, or the partner was not picked). Diagonal peaks and proton
+shifts outside -5 to 20 ppm are never confirmed.
+
+The partners are found on a grid of one tolerance per proton shift: the
+cells of the other peak list are sorted int64 keys, every peak looks at
+the 9 cells around its own with binary searches, so the check stays about
+linear in the number of peaks (no pairwise comparison).
+
+The check runs on the written .peaks files (after cleanup, with the peak
+numbers cyana sees). The colour code of every peak line (the field after
+the positions) is set in place to 2 for a confirmed peak and to 1 for an
+unconfirmed one (a compressed .peaks is written again), and the pairs
+are listed in 13C_symmetry.csv and 15N_symmetry.csv.
+
+python symmetry.py WORKDIR [--tolerance 0.03]
+'''
+
+default_tolerance = 0.03
+# proton shifts outside this range (ppm) are picking artefacts, never confirmed
+proton_range = (-5.0, 20.0)
+confirmed_color = ord('2')
+unconfirmed_color = ord('1')
+# colour codes set by the check, the others were set by hand
+check_colors = bytes([confirmed_color, unconfirmed_color])
+
+report_columns = ['Number', 'Partner Spectrum', 'Partner Number', 'Delta (ppm)']
+
+
+def partner_pairs(first, second, tolerance):
+    """(i, j) pairs of first[i] and second[j] (n x 2 points) within tolerance on both coordinates."""
+    empty = np.empty(0, np.int64)
+    if not len(first) or not len(second):
+        return empty, empty
+    cells = np.floor(np.vstack([first, second]) / tolerance).astype(np.int64)
+    keys, sizes = peak_cleanup.grid_keys(cells)
+    first_keys, second_keys = keys[:len(first)], keys[len(first):]
+    order = np.argsort(second_keys, kind='stable')
+    second_keys = second_keys[order]
+
+    firsts, seconds = [], []
+    # the same cell and the 8 around it
+    for delta in (dx * sizes[1] + dy for dx in (-1, 0, 1) for dy in (-1, 0, 1)):
+        low = np.searchsorted(second_keys, first_keys + delta, side='left')
+        high = np.searchsorted(second_keys, first_keys + delta, side='right')
+        counts = high - low
+        i = np.repeat(np.arange(len(first)), counts)
+        j = order[np.repeat(low - (np.cumsum(counts) - counts), counts) + np.arange(counts.sum())]
+        close = (np.abs(first[i] - second[j]) <= tolerance).all(axis=1)
+        firsts.append(i[close])
+        seconds.append(j[close])
+    return np.concatenate(firsts), np.concatenate(seconds)
+
+
+def proton_points(records, dims):
+    """(bound, free) proton shifts of every record and the rows that can have a partner."""
+    bound, free = (records['positions'][d] for d in dims)
+    points = np.column_stack([bound, free])
+    with np.errstate(invalid='ignore'):
+        inside = ((points >= proton_range[0]) & (points <= proton_range[1])).all(axis=1)
+    usable = inside & ~peak_cleanup.diagonal_peaks([bound, free], (0, 1))
+    return points, np.flatnonzero(usable)
+
+
+def symmetric_pairs(first, second, first_dims, second_dims, tolerance=default_tolerance):
+    """(i, j, delta) of the records of two NOESY seeing the same NOE, their proton shifts swapped."""
+    first_points, first_rows = proton_points(first, first_dims)
+    second_points, second_rows = proton_points(second, second_dims)
+    # bound proton of one spectrum against the free proton of the other
+    i, j = partner_pairs(first_points[first_rows], second_points[second_rows][:, ::-1], tolerance)
+    i, j = first_rows[i], second_rows[j]
+    delta = np.abs(first_points[i] - second_points[j][:, ::-1]).max(axis=1) if len(i) else np.empty(0)
+    return i, j, delta
+
+
+def mark_colors(peaks_file, color_at, confirmed):
+    """Colour codes of the .peaks set in place, return the number of records changed.
+
+    An up-to-date peak index (see peak_index) is kept up to date: the
+    records keep their place and length.
+    """
+    colors = np.where(confirmed, confirmed_color, unconfirmed_color).astype(np.uint8)
+    colors, color_at = colors[color_at >= 0], color_at[color_at >= 0]
+    if not len(color_at):
+        return 0
+    compression = compression_of(peaks_file)
+    if compression:
+        # a compressed .peaks cannot be patched, it is written again
+        data = np.frombuffer(read_bytes(peaks_file), dtype=np.uint8).copy()
+        changed = data[color_at] != colors
+        if changed.any():
+            data[color_at[changed]] = colors[changed]
+            with open_file(peaks_file + '.tmp', 'wb', compression=compression) as f:
+                f.write(data.tobytes())
+            os.replace(peaks_file + '.tmp', peaks_file)
+        return int(changed.sum())
+    data = np.memmap(peaks_file, dtype=np.uint8, mode='r+')
+    changed = data[color_at] != colors
+    if changed.any():
+        index = peak_index.read_index(peaks_file, arrays=False)
+        indexed = index is not None and index['meta'].get('peaks') == peak_index.file_stat(peaks_file)
+        at = color_at[changed]
+        old = data[at].copy()
+        try:
+            data[at] = colors[changed]
+            data.flush()
+        except BaseException:
+            # never half marked: the old codes go back
+            data[at] = old
+            data.flush()
+            raise
+        del data
+        # mtime of a file written through a memory map is not updated on every system
+        os.utime(peaks_file)
+        if indexed:
+            peak_index.write_meta(peaks_file, index['meta'])
+    return int(changed.sum())
+
+
+def write_report(rows, output_file):
+    with replace_file(output_file, newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(report_columns)
+        writer.writerows(rows)
+
+
+def check_spectra(spectrum_list, tolerance=default_tolerance, stats=None, progress=None):
+    """Mark the peaks of every NOESY of spectrum_list confirmed or not, return {spectrum name: confirmed mask}.
+
+    progress: metrics.Progress, gets the spectra marked.
+    """
+    noesys = [(spectrum, spectrum.proton_pair) for spectrum in spectrum_list if spectrum.proton_pair]
+    records = [peak_index.read_records(spectrum.peaks, spectrum.n_dims, dims, colors=check_colors)
+               for spectrum, dims in noesys]
+    confirmed = [np.zeros(len(r['number']), dtype=bool) for r in records]
+    reports = [[] for _ in noesys]
+    for a in range(len(noesys)):
+        for b in range(a + 1, len(noesys)):
+            i, j, delta = symmetric_pairs(records[a], records[b], noesys[a][1], noesys[b][1], tolerance)
+            confirmed[a][i] = True
+            confirmed[b][j] = True
+            for first, second, rows, partners in ((a, b, i, j), (b, a, j, i)):
+                numbers, partner_numbers = records[first]['number'].tolist(), records[second]['number'].tolist()
+                name = noesys[second][0].name
+                reports[first] += [(numbers[row], name, partner_numbers[partner], round(float(d), 4))
+                                   for row, partner, d in zip(rows.tolist(), partners.tolist(), delta.tolist())]
+
+    for done, (spectrum, _) in enumerate(noesys):
+        metrics.report(progress, 'symmetry', done, len(noesys))
+        mark_colors(spectrum.peaks, records[done]['color_at'], confirmed[done])
+        write_report(sorted(reports[done]), spectrum.symmetry_report)
+        metrics.add_warnings(stats, 'unconfirmed peaks', int((~confirmed[done]).sum()))
+    metrics.report(progress, 'symmetry', len(noesys), len(noesys))
+    return {spectrum.name: mask for (spectrum, _), mask in zip(noesys, confirmed)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mark the NOESY peaks with a symmetry partner in the other NOESY")
+    parser.add_argument('save_path')
+    parser.add_argument('--tolerance', type=float, default=default_tolerance, help="proton tolerance (ppm)")
+    args = parser.parse_args()
+    stats = metrics.new_stats()
+    confirmed = check_spectra(spectra.project_spectra(args.save_path), args.tolerance, stats)
+    for name, mask in confirmed.items():
+        print(f"{name}: {int(mask.sum())} of {len(mask)} peaks confirmed")
+
+
+if __name__ == "__main__":
+    main()
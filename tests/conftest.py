@@ -0,0 +1,18 @@
+import os
+import shutil
+import sys
+
+import pytest
+
+# the modules sit at the root of the repository
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+demo = os.path.join(root, 'demo')
+
+
+@pytest.fixture
+def project(tmp_path):
+    """Working directory with a copy of the demo exports."""
+    for name in os.listdir(demo):
+        shutil.copy(os.path.join(demo, name), tmp_path)
+    return str(tmp_path)
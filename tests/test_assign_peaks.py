@@ -0,0 +1,123 @@
+import numpy as np
+
+import assign_peaks
+import model
+
+# powers of two: the shifts, the windows and their edges are exact floats
+tolerances = {'H': 1 / 16, 'C': 1 / 2, 'N': 1 / 2}
+step = 1 / 64
+atoms = {'H': (7.5, 9.0), 'N': (115.0, 125.0), 'HA': (3.5, 5.0), 'CA': (50.0, 60.0),
+         'QB': (1.0, 3.0), 'CB': (20.0, 40.0)}
+
+
+def shift_table(rng, n_residues=30):
+    index, values, codes, names = [], [], [], []
+    for residue in range(1, n_residues + 1):
+        for atom, (low, high) in atoms.items():
+            index.append(len(index) + 1)
+            values.append(round(rng.uniform(low, high) / step) * step)
+            codes.append(str(residue))
+            names.append(atom)
+    return model.ShiftTable(index, values, [0.0] * len(values), codes, names)
+
+
+def linear_scan(table, positions, dims, bonded):
+    """{peak: {(atom numbers): score}}, every shift of every dimension compared one by one."""
+    numbers, values = list(table.index), list(table.value)
+    residues, names = table.residues(), table.atoms()
+    position = {(residue, atom): row for row, (residue, atom) in enumerate(zip(residues, names))}
+    # the heavy atom of every proton: the first of bonded_heavy_names in its residue
+    heavy_of = {}
+    for row, atom in enumerate(names):
+        if assign_peaks.nucleus(atom) == 'H':
+            for heavy in assign_peaks.bonded_heavy_names(atom):
+                if (residues[row], heavy) in position:
+                    heavy_of[row] = position[residues[row], heavy]
+                    break
+
+    found = {}
+    for peak in range(len(positions[0])):
+        choices = []
+        for d, nuc in enumerate(dims):
+            tolerance = tolerances[nuc]
+            choices.append([row for row, atom in enumerate(names) if assign_peaks.nucleus(atom) == nuc
+                            and positions[d][peak] - tolerance <= values[row] <= positions[d][peak] + tolerance])
+        combos = [[]]
+        for rows in choices:
+            combos = [combo + [row] for combo in combos for row in rows]
+        for combo in combos:
+            if all(heavy_of.get(combo[p]) == combo[h] for p, h in bonded):
+                score = sum(((values[row] - positions[d][peak]) / tolerances[dims[d]]) ** 2
+                            for d, row in enumerate(combo))
+                found.setdefault(peak, {})[tuple(numbers[row] for row in combo)] = score
+    return found
+
+
+def candidates(result, n_dims):
+    found = {}
+    for row in result.itertuples(index=False):
+        found.setdefault(row.peak, {})[tuple(getattr(row, f'a{d + 1}') for d in range(n_dims))] = row.score
+    return found
+
+
+def nitrogen_peaks(rng, table, n=150):
+    """HN, H, N of random peaks near the shifts, and peaks on the edges of the windows."""
+    values, names = np.array(table.value), table.atoms()
+    amide = [row for row, name in enumerate(names) if name == 'H']
+    protons = [row for row, name in enumerate(names) if assign_peaks.nucleus(name) == 'H']
+    hn = values[rng.choice(amide, n)] + rng.integers(-6, 7, n) * step
+    h = values[rng.choice(protons, n)] + rng.integers(-6, 7, n) * step
+    # the N of the amide proton one row after it
+    n_shift = values[rng.choice(amide, n) + 1] + rng.integers(-40, 41, n) * step
+    edges_hn, edges_h, edges_n = [], [], []
+    for row in amide[:5]:
+        free = protons[row % len(protons)]
+        for sign in (-1, 1):
+            # exactly on the edge of every window, then just outside one of them
+            edges_hn += [values[row] + sign * tolerances['H'], values[row] + sign * (tolerances['H'] + step)]
+            edges_h += [values[free] - sign * tolerances['H'], values[free]]
+            edges_n += [values[row + 1] + sign * tolerances['N'], values[row + 1] - sign * tolerances['N']]
+    return [np.r_[hn, edges_hn], np.r_[h, edges_h], np.r_[n_shift, edges_n]]
+
+
+def test_candidates_same_as_linear_scan():
+    rng = np.random.default_rng(11)
+    table = shift_table(rng)
+    positions = nitrogen_peaks(rng, table)
+    dims, bonded = ['H', 'H', 'N'], [(0, 2)]
+    index = assign_peaks.ShiftIndex(table)
+    result = assign_peaks.find_candidates(index, positions, dims, bonded, tolerances, limit=10 ** 6)
+    expected = linear_scan(table, positions, dims, bonded)
+    assert sum(len(found) for found in expected.values()) > 200
+    found = candidates(result, 3)
+    assert found.keys() == expected.keys()
+    for peak, scores in expected.items():
+        assert found[peak].keys() == scores.keys()
+        assert np.allclose([found[peak][key] for key in scores], list(scores.values()))
+
+
+def test_window_edges():
+    rng = np.random.default_rng(5)
+    table = shift_table(rng)
+    positions = nitrogen_peaks(rng, table, n=0)
+    index = assign_peaks.ShiftIndex(table)
+    found = candidates(assign_peaks.find_candidates(index, positions, ['H', 'H', 'N'], [(0, 2)], tolerances,
+                                                    limit=10 ** 6), 3)
+    amide = [row for row, name in enumerate(table.atoms()) if name == 'H']
+    for k, row in enumerate(amide[:5]):
+        # peaks 4k and 4k + 2 are on the edges of the windows of the amide, 4k + 1 and 4k + 3 just outside
+        for peak in (4 * k, 4 * k + 2):
+            assert any(key[0] == table.index[row] and key[2] == table.index[row + 1] for key in found[peak])
+        for peak in (4 * k + 1, 4 * k + 3):
+            assert not any(key[0] == table.index[row] for key in found.get(peak, {}))
+
+
+def test_limit_keeps_the_best():
+    rng = np.random.default_rng(2)
+    table = shift_table(rng, 60)
+    positions = nitrogen_peaks(rng, table)
+    index = assign_peaks.ShiftIndex(table)
+    result = assign_peaks.find_candidates(index, positions, ['H', 'H', 'N'], [(0, 2)], tolerances, limit=3)
+    expected = linear_scan(table, positions, ['H', 'H', 'N'], [(0, 2)])
+    for peak, scores in candidates(result, 3).items():
+        assert np.allclose(sorted(scores.values()), sorted(expected[peak].values())[:3])
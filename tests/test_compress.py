@@ -0,0 +1,60 @@
+import gzip
+import os
+import shutil
+
+import engine
+from fileutils import compression_of, existing
+
+sequence = 'APEKKVLFWYDPMKPDTKFDKPGKSPFMDMDLVPKYADESG'
+outputs = ['13C.peaks', '15N.peaks', 'attib_cyana.prot']
+
+
+def convert(save_path, compress=None):
+    result = engine.run_conversion(save_path, 43, sequence, version=3, compress=compress)
+    assert result['ok'], result['error']
+
+
+def copy_project(project, name):
+    save_path = os.path.join(project, name)
+    os.makedirs(save_path)
+    for file_name in ('13C.csv', '15N.csv', 'attrib.csv'):
+        shutil.copy(os.path.join(project, file_name), save_path)
+    return save_path
+
+
+def read_outputs(save_path, compress=''):
+    found = {}
+    for name in outputs:
+        path = os.path.join(save_path, name + compress)
+        found[name] = gzip.open(path).read() if compress else open(path, 'rb').read()
+    return found
+
+
+def test_gz_outputs_same_as_plain(project):
+    plain = copy_project(project, 'plain')
+    compressed = copy_project(project, 'gz')
+    convert(plain)
+    convert(compressed, '.gz')
+    assert all(compression_of(os.path.join(compressed, name + '.gz')) == 'gzip' for name in outputs)
+    assert not any(os.path.exists(os.path.join(compressed, name)) for name in outputs)
+    assert read_outputs(compressed, '.gz') == read_outputs(plain)
+
+
+def test_gzip_exports_read_from_their_first_bytes(project):
+    plain = copy_project(project, 'plain')
+    convert(plain)
+    save_path = copy_project(project, 'gzip')
+    # a gzip stream named .csv, and a .csv.gz with no plain .csv next to it
+    file_13, file_15 = os.path.join(save_path, '13C.csv'), os.path.join(save_path, '15N.csv')
+    data = open(file_13, 'rb').read()
+    with gzip.open(file_13, 'wb') as f:
+        f.write(data)
+    with open(file_15, 'rb') as f, gzip.open(file_15 + '.gz', 'wb') as out:
+        shutil.copyfileobj(f, out)
+    os.remove(file_15)
+
+    assert existing(file_13) == file_13 and compression_of(file_13) == 'gzip'
+    assert existing(file_15) == file_15 + '.gz' and compression_of(file_15 + '.gz') == 'gzip'
+    assert compression_of(os.path.join(save_path, 'attrib.csv')) is None
+    convert(save_path)
+    assert read_outputs(save_path) == read_outputs(plain)
@@ -0,0 +1,65 @@
+import os
+
+import pytest
+
+import fasta_to_seq
+
+records = """>a start=10 first record
+ACD
+EF*
+
+>empty
+>a second record, same name
+; comment line
+GH/KL
+"""
+
+
+def write_fasta(tmp_path, text):
+    path = os.path.join(str(tmp_path), 'records.fasta')
+    with open(path, 'w') as f:
+        f.write(text)
+    return path
+
+
+def contents(paths):
+    return {os.path.basename(path): open(path).read() for path in paths}
+
+
+def test_multi_record_offset(tmp_path):
+    fasta_file = write_fasta(tmp_path, records)
+    paths = fasta_to_seq.convert_fasta(fasta_file, os.path.join(str(tmp_path), 'seq'), start_number=1)
+    # wrapped lines numbered on, the header-only record written empty, the chains 1000 apart
+    assert contents(paths) == {
+        'a.seq': 'Ala\t10\nCys\t11\nAsp\t12\nGlu\t13\nPhe\t14\n',
+        'empty.seq': '',
+        'a_2.seq': 'Gly\t1\nHis\t2\nLys\t1001\nLeu\t1002\n',
+    }
+
+
+def test_multi_record_split(tmp_path):
+    fasta_file = write_fasta(tmp_path, records)
+    paths = fasta_to_seq.convert_fasta(fasta_file, os.path.join(str(tmp_path), 'seq'), start_number=1,
+                                       starts={'a_2': 5}, chains='split')
+    assert contents(paths) == {
+        'a.seq': 'Ala\t10\nCys\t11\nAsp\t12\nGlu\t13\nPhe\t14\n',
+        'empty.seq': '',
+        'a_2_A.seq': 'Gly\t5\nHis\t6\n',
+        'a_2_B.seq': 'Lys\t5\nLeu\t6\n',
+    }
+
+
+def test_unknown_letter_leaves_no_file(tmp_path):
+    fasta_file = write_fasta(tmp_path, '>a\nACD\n>b\nAXB\n')
+    output_dir = os.path.join(str(tmp_path), 'seq')
+    with pytest.raises(ValueError, match='line 4'):
+        fasta_to_seq.convert_fasta(fasta_file, output_dir)
+    assert sorted(os.listdir(output_dir)) == ['a.seq']
+
+
+def test_first_record(tmp_path):
+    assert fasta_to_seq.first_record(write_fasta(tmp_path, records)) == 'ACDEF'
+    # a record with a header only is passed over
+    assert fasta_to_seq.first_record(write_fasta(tmp_path, '>empty\n>b\nGH/KL\n>c\nMM\n')) == 'GHKL'
+    assert fasta_to_seq.first_record(write_fasta(tmp_path, 'ACD\nEF\n')) == 'ACDEF'
+    assert fasta_to_seq.first_record(write_fasta(tmp_path, '>only a header\n')) == ''
@@ -0,0 +1,25 @@
+import os
+
+import fasta_to_seq
+import file_to_prot
+
+sequence = 'APEKKVLFWYDPMKPDTKFDKPGKSPFMDMDLVPKYADESG'
+
+
+def prot_files(project, name, light):
+    """Result, .prot and shift outliers of the demo attrib.csv, written in a directory of their own."""
+    output = os.path.join(project, name)
+    os.makedirs(output)
+    seq_file = os.path.join(output, 'prot.seq')
+    fasta_to_seq.write_to_file(fasta_to_seq.convert_sequence(sequence), seq_file, 43)
+    result = file_to_prot.lunch_all(os.path.join(project, 'attrib.csv'), seq_file, output, light=light)
+    return result, [open(os.path.join(output, file_name), 'rb').read()
+            for file_name in ('attib_cyana.prot', 'shift_outliers.csv')]
+
+
+def test_csv_path_same_as_pandas(project):
+    rows, light = prot_files(project, 'light', light=True)
+    frame, pandas = prot_files(project, 'pandas', light=False)
+    # the csv path did not fall back to pandas
+    assert isinstance(rows, list) and len(rows) == len(frame) > 100
+    assert light == pandas
@@ -0,0 +1,138 @@
+import os
+
+import nef_reader
+
+project_text = """data_test
+
+save_nef_nmr_meta_data
+   _nef_nmr_meta_data.sf_category      nef_nmr_meta_data
+   _nef_nmr_meta_data.format_name 'nmr_exchange_format'
+   _nef_nmr_meta_data.comment
+;
+free text with loop_ and stop_ inside
+save_nef_nmr_spectrum_not_a_spectrum
+;
+save_
+
+save_nef_molecular_system
+  _nef_molecular_system.sf_category nef_molecular_system
+  loop_
+    _nef_sequence.index
+    _nef_sequence.chain_code
+    _nef_sequence.sequence_code
+    _nef_sequence.residue_name
+    _nef_sequence.linking
+
+    1 A 43 ALA start
+    2 A 44 'GLU' middle   # quoted residue name
+    3 A 45 LYS end
+    4 B 1 GLY .
+  stop_
+save_
+
+save_nef_chemical_shift_list_default
+  _nef_chemical_shift_list.sf_category nef_chemical_shift_list
+  loop_
+   _nef_chemical_shift.chain_code
+   _nef_chemical_shift.sequence_code
+   _nef_chemical_shift.residue_name
+   _nef_chemical_shift.atom_name
+   _nef_chemical_shift.value
+   _nef_chemical_shift.value_uncertainty
+   A 43 ALA "CA" 52.5 0.1
+   A 43 ALA 'HB%' 1.39 .
+   A 44 GLU H 8.41 0.02
+   A 44 GLU N 121.3 ?
+  stop_
+save_
+
+save_nef_nmr_spectrum_C13
+  _nef_nmr_spectrum.sf_category nef_nmr_spectrum
+  loop_
+   _nef_spectrum_dimension.dimension_id
+   _nef_spectrum_dimension.axis_code
+   1 1H
+   2 13C
+   3 1H
+  stop_
+  loop_
+   _nef_spectrum_dimension_transfer.dimension_1
+   _nef_spectrum_dimension_transfer.dimension_2
+   _nef_spectrum_dimension_transfer.transfer_type
+   1 2 onebond
+  stop_
+  loop_
+   _nef_peak.index _nef_peak.peak_id _nef_peak.volume _nef_peak.height
+   _nef_peak.position_1
+   _nef_peak.position_2
+   _nef_peak.position_3
+
+   1 1 2.5e10 . 4.38 65.03 4.39
+   2 1 2.5e10 . 4.38 65.03 4.39
+   3 2 1.9e9 . 4.39 65.05
+ 3.15
+   4 3 . . 1.39 19.0 8.41
+  stop_
+save_
+
+save_nef_nmr_spectrum_N15
+  _nef_nmr_spectrum.sf_category nef_nmr_spectrum
+  loop_
+   _nef_spectrum_dimension.dimension_id
+   _nef_spectrum_dimension.axis_code
+   1 1H
+   2 1H
+   3 15N
+  stop_
+  loop_
+   _nef_spectrum_dimension_transfer.dimension_1
+   _nef_spectrum_dimension_transfer.dimension_2
+   _nef_spectrum_dimension_transfer.transfer_type
+   1 3 onebond
+  stop_
+  loop_
+   _nef_peak.index _nef_peak.peak_id _nef_peak.volume _nef_peak.height
+   _nef_peak.position_1 _nef_peak.position_2 _nef_peak.position_3
+   1 1 1.7e11 . 8.41 4.38 121.3
+   2 2 5.4e10 . 8.41 1.39 121.3
+  stop_
+save_
+"""
+
+
+def peak_lines(peaks_file):
+    """Number and positions of every peak line of a .peaks."""
+    with open(peaks_file) as f:
+        return [line.split('\t')[:4] for line in f if not line.startswith(('#', '\t'))]
+
+
+def test_tokenize():
+    lines = ["a 'b c' \"d e\" f # comment\n", ";\n", "text with stop_\n", "save_x\n", ";\n",
+             "x 'it's' y\n", "# only a comment\n"]
+    assert list(nef_reader.tokenize(lines)) == [
+        ['a', 'b c', 'd e', 'f'], ['\ntext with stop_\nsave_x'], ['x', "it's", 'y']]
+
+
+def test_convert_nef(tmp_path):
+    save_path = str(tmp_path)
+    nef_file = os.path.join(save_path, 'test.nef')
+    with open(nef_file, 'w') as f:
+        f.write(project_text)
+
+    # the save_ line in the text field is not a spectrum
+    assert nef_reader.spectrum_names(nef_file) == ['C13', 'N15']
+    shifts, written = nef_reader.convert_nef(nef_file, save_path, 3)
+    assert [spectrum.peaks for spectrum in written] == nef_reader.output_files(nef_file, save_path)
+    assert all(os.path.exists(path) for path in nef_reader.output_files(nef_file, save_path))
+
+    # chain A only, the quoted name unquoted
+    assert open(os.path.join(save_path, 'prot.seq')).read() == 'Ala\t43\nGlu\t44\nLys\t45\n'
+    assert shifts['AtomName'].tolist() == ['CA', 'HB%', 'H', 'N']
+    assert shifts['Value\n(ppm)'].tolist() == [52.5, 1.39, 8.41, 121.3]
+    assert shifts['Value Error\n(ppm)'].isna().tolist() == [False, True, False, True]
+
+    carbon, nitrogen = written
+    # one line per peak_id, a row wrapped over two lines read whole; HC H C
+    assert peak_lines(carbon.peaks) == [['1', '4.38', '4.39', '65.03'], ['2', '4.39', '3.15', '65.05'],
+                                        ['3', '1.39', '8.41', '19.0']]
+    assert peak_lines(nitrogen.peaks) == [['1', '8.41', '4.38', '121.3'], ['2', '8.41', '1.39', '121.3']]
@@ -0,0 +1,65 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import peak_cache
+
+
+def later(path, seconds=1):
+    """Modification time of path moved seconds later (the stat is what the cache looks at)."""
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_mtime_ns + seconds * 10 ** 9,) * 2)
+
+
+def no_build(csv_file, digest=None):
+    raise AssertionError(f"{csv_file} parsed again")
+
+
+def test_cache_round_trip(project):
+    csv_file = os.path.join(project, '13C.csv')
+    frame = pd.read_csv(csv_file, float_precision='round_trip')
+    table, names = peak_cache.load_peaks(csv_file)
+    assert os.path.exists(peak_cache.cache_file(csv_file))
+    assert isinstance(table['Pos F1'], np.memmap)
+    for name in ('Pos F1', 'Pos F2', 'Pos F3', 'Volume'):
+        assert np.array_equal(table[name], frame[name].to_numpy(), equal_nan=True)
+    assert names == ['noesy_HSQC_SilB41_1ag_ref']
+    assert (table['spectrum'] == 0).all() and (table['peak_list'] == 1).all()
+    serials = frame['_object'].str.extract(r'\.(\d+):')[0].astype(np.int64).to_numpy()
+    assert np.array_equal(table['serial'], serials)
+
+
+def test_unchanged_csv_not_parsed_again(project, monkeypatch):
+    csv_file = os.path.join(project, '15N.csv')
+    first, _ = peak_cache.load_peaks(csv_file)
+    monkeypatch.setattr(peak_cache, 'build_cache', no_build)
+    second, _ = peak_cache.load_peaks(csv_file)
+    assert np.array_equal(first['Volume'], second['Volume'], equal_nan=True)
+    # touched, same content: the digest is checked, the new mtime kept
+    later(csv_file)
+    peak_cache.load_peaks(csv_file)
+    assert peak_cache.read_header(peak_cache.cache_file(csv_file))['mtime_ns'] == os.stat(csv_file).st_mtime_ns
+
+
+@pytest.mark.parametrize('change', ['same size', 'new size'])
+def test_changed_csv_parsed_again(project, change):
+    csv_file = os.path.join(project, '15N.csv')
+    table, _ = peak_cache.load_peaks(csv_file)
+    rows = len(table['Volume'])
+    lines = open(csv_file).read().splitlines(keepends=True)
+    # volume of the first peak, last digit changed
+    volume = lines[1].rstrip('\n').rsplit(',', 1)[1]
+    new_volume = volume[:-1] + ('1' if volume[-1] != '1' else '2')
+    lines[1] = lines[1].replace(volume, new_volume)
+    if change == 'new size':
+        lines.append(lines[-1])
+    with open(csv_file, 'w') as f:
+        f.writelines(lines)
+    if change == 'same size':
+        later(csv_file)
+
+    table, _ = peak_cache.load_peaks(csv_file)
+    assert table['Volume'][0] == float(new_volume)
+    assert len(table['Volume']) == rows + (change == 'new size')
@@ -0,0 +1,60 @@
+import numpy as np
+
+import peak_cleanup
+
+
+def brute_force(positions, tolerances):
+    """Every pair (i < j) within the tolerance on every dimension, compared one by one."""
+    points = np.column_stack(positions)
+    found = set()
+    for i in range(len(points)):
+        for j in range(i + 1, len(points)):
+            if (np.abs(points[i] - points[j]) <= tolerances).all():
+                found.add((i, j))
+    return found
+
+
+def pairs(positions, tolerances):
+    first, second = peak_cleanup.close_pairs(positions, np.asarray(tolerances))
+    found = {(min(i, j), max(i, j)) for i, j in zip(first.tolist(), second.tolist())}
+    # every pair once
+    assert len(found) == len(first)
+    return found
+
+
+def test_close_pairs_same_as_brute_force():
+    rng = np.random.default_rng(7)
+    tolerances = [0.005, 0.005, 0.05]
+    n = 600
+    # a small shift range: many peaks share a cell or sit in the next one
+    points = [rng.uniform(4.0, 4.1, n), rng.uniform(8.0, 8.1, n), rng.uniform(120.0, 121.0, n)]
+    source = rng.integers(0, n, n // 3)
+    for d, tolerance in enumerate(tolerances):
+        points[d][:n // 3] = points[d][source] + rng.uniform(-tolerance, tolerance, n // 3)
+    expected = brute_force(points, tolerances)
+    assert len(expected) > 100
+    assert pairs(points, tolerances) == expected
+
+
+def test_close_pairs_across_cell_boundaries():
+    tolerances = [0.01, 0.1]
+    # cells of 0.01 ppm: 0.0999 and 0.1001 fall in cells 9 and 10
+    first = [0.0999, 0.1001, 0.2001, 0.3001, 0.3101, 0.4001]
+    second = [5.001, 5.001, 4.999, 5.001, 5.202, 4.999]
+    # neighbours on both dimensions at once, the diagonal cells (+1, -1) and (-1, +1)
+    first += [0.5099, 0.5101, 0.6101, 0.6099]
+    second += [5.099, 5.101, 5.099, 5.101]
+    positions = [np.array(first), np.array(second)]
+    expected = brute_force(positions, tolerances)
+    assert expected == {(0, 1), (6, 7), (8, 9)}
+    assert pairs(positions, tolerances) == expected
+
+
+def test_close_pairs_diagonal_peaks():
+    rng = np.random.default_rng(3)
+    n = 300
+    proton = rng.uniform(4.0, 4.05, n)
+    # the two proton dimensions equal: the points sit on the diagonal of the grid
+    positions = [proton, proton + rng.normal(0, 0.001, n), rng.uniform(60.0, 60.2, n)]
+    tolerances = [0.005, 0.005, 0.05]
+    assert pairs(positions, tolerances) == brute_force(positions, tolerances)
@@ -0,0 +1,154 @@
+import csv
+import os
+
+import peak_index
+import spectra
+import to_xeasy
+
+# the 15N NOESY: its export columns Pos F1, Pos F2, Pos F3 are the xeasy
+# dimensions in order, row n of the export (after the header) is peak n
+
+
+def convert(spectrum, version=3):
+    return to_xeasy.convert_spectrum(spectrum, version, incremental=True)
+
+
+def read_rows(spectrum):
+    with open(spectrum.csv, newline='') as f:
+        return list(csv.reader(f))
+
+
+def write_rows(spectrum, rows):
+    """New export, its modification time one second later (the stat is what the caches look at)."""
+    stat = os.stat(spectrum.csv)
+    with open(spectrum.csv, 'w', newline='') as f:
+        csv.writer(f).writerows(rows)
+    os.utime(spectrum.csv, ns=(stat.st_mtime_ns + 10 ** 9,) * 2)
+
+
+def records(peaks_file):
+    """{peak number: record text} of a .peaks (peak line and continuation lines)."""
+    found = {}
+    number = None
+    with open(peaks_file) as f:
+        for line in f:
+            if line.startswith('#'):
+                continue
+            if not line.startswith('\t'):
+                number = int(line.split('\t', 1)[0])
+                found[number] = ''
+            found[number] += line
+    return found
+
+
+def nudged(text):
+    """Same number, last digit changed: same length."""
+    return text[:-1] + ('1' if text[-1] != '1' else '2')
+
+
+def test_first_conversion_is_plain_and_indexed(project):
+    spectrum = spectra.nitrogen_noesy.in_dir(project)
+    convert(spectrum)
+    text = open(spectrum.peaks).read()
+    assert peak_index.read_index(spectrum.peaks) is not None
+    to_xeasy.convert_spectrum(spectrum, 3)
+    assert open(spectrum.peaks).read() == text
+
+
+def test_same_length_change_patched_in_place(project):
+    spectrum = spectra.nitrogen_noesy.in_dir(project)
+    convert(spectrum)
+    before = records(spectrum.peaks)
+    inode = os.stat(spectrum.peaks).st_ino
+    rows = read_rows(spectrum)
+    rows[5][1] = nudged(rows[5][1])
+    write_rows(spectrum, rows)
+
+    stats = convert(spectrum)
+    after = records(spectrum.peaks)
+    assert stats['rows_written'] == 1
+    assert os.stat(spectrum.peaks).st_ino == inode
+    assert after[5].split('\t')[1] == rows[5][1]
+    assert {n: t for n, t in after.items() if n != 5} == {n: t for n, t in before.items() if n != 5}
+    # the index follows the patched file: next run has nothing to do
+    assert convert(spectrum)['rows_written'] == 0
+
+
+def test_moved_removed_added_rewritten_with_same_numbers(project):
+    spectrum = spectra.nitrogen_noesy.in_dir(project)
+    convert(spectrum)
+    before = records(spectrum.peaks)
+    inode = os.stat(spectrum.peaks).st_ino
+    rows = read_rows(spectrum)
+    rows[5][1] = '4.1'
+    added = list(rows[3])
+    added[0] = added[0].replace('.1.', '.1.99999', 1)
+    rows = rows[:10] + rows[12:] + [added]
+    write_rows(spectrum, rows)
+
+    convert(spectrum)
+    after = records(spectrum.peaks)
+    assert os.stat(spectrum.peaks).st_ino != inode
+    assert after[5].split('\t')[1] == '4.1'
+    assert 10 not in after and 11 not in after
+    assert after[max(before) + 1].split('\t')[1:4] == added[1:4]
+    assert all(after[n] == before[n] for n in before if n not in (5, 10, 11))
+    assert convert(spectrum)['rows_written'] == 0
+
+
+def test_hand_edit_kept_after_rescan(project):
+    spectrum = spectra.nitrogen_noesy.in_dir(project)
+    convert(spectrum)
+    before = records(spectrum.peaks)
+    # an assignment added by hand to peak 20
+    text = open(spectrum.peaks).read()
+    edit = before[20] + '\t\t\t\t\t\t\t\t\t\t1\t2\t3\n'
+    with open(spectrum.peaks, 'w') as f:
+        f.write(text.replace(before[20], edit))
+    rows = read_rows(spectrum)
+    rows[30][3] = '60.5'
+    write_rows(spectrum, rows)
+
+    convert(spectrum)
+    after = records(spectrum.peaks)
+    assert after[20] == edit
+    assert after[30].split('\t')[3] == '60.5'
+    assert all(after[n] == before[n] for n in before if n not in (20, 30))
+    assert convert(spectrum)['rows_written'] == 0
+
+
+def test_full_conversion_fallback(project):
+    spectrum = spectra.nitrogen_noesy.in_dir(project)
+    convert(spectrum)
+    # another cyana version: every line is written again
+    convert(spectrum, version=2)
+    text = open(spectrum.peaks).read()
+    to_xeasy.convert_spectrum(spectrum, 2)
+    assert open(spectrum.peaks).read() == text
+
+    # without its index the numbers start again from 1, the removed peak is not skipped
+    convert(spectrum, version=2)
+    os.remove(peak_index.index_file(spectrum.peaks))
+    rows = read_rows(spectrum)
+    write_rows(spectrum, rows[:10] + rows[11:])
+    convert(spectrum, version=2)
+    assert sorted(records(spectrum.peaks)) == list(range(1, len(rows) - 1))
+    assert peak_index.read_index(spectrum.peaks) is not None
+
+
+def test_failed_patch_puts_the_old_bytes_back(tmp_path):
+    path = tmp_path / 'file'
+    path.write_bytes(b'0123456789')
+
+    class Failing(dict):
+        def items(self):
+            yield 2, b'ab'
+            raise OSError("disk full")
+
+    try:
+        peak_index.patch_file(str(path), Failing())
+    except OSError:
+        pass
+    assert path.read_bytes() == b'0123456789'
+    peak_index.patch_file(str(path), {2: b'ab', 8: b'cd'})
+    assert path.read_bytes() == b'01ab4567cd'
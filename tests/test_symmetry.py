@@ -0,0 +1,93 @@
+import csv
+import os
+
+import spectra
+import symmetry
+import to_xeasy
+
+# (HC, C, H) in the order of the 13C export columns Pos F1, Pos F2, Pos F3
+carbon_peaks = [
+    (4.35, 55.0, 8.21),   # 1: the NOE of 15N peak 1, proton shifts swapped
+    (1.02, 20.0, 3.05),   # 2: no partner
+    (4.37, 55.1, 8.23),   # 3: the same NOE picked again, 0.02 ppm off
+    (3.90, 60.0, 3.90),   # 4: diagonal
+]
+# (HN, H, N)
+nitrogen_peaks = [
+    (8.21, 4.35, 120.0),  # 1: partner of 13C peaks 1 and 3
+    (8.50, 8.50, 118.0),  # 2: diagonal
+    (7.90, 2.00, 125.0),  # 3: no partner
+    (8.10, 3.92, 121.0),  # 4: no partner
+]
+
+
+def write_export(path, name, peaks):
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['_object', 'Pos F1', 'Pos F2', 'Pos F3', 'Volume'])
+        for serial, (a, b, c) in enumerate(peaks, 1):
+            writer.writerow([f'<PK:{name}.1.{serial}: @({a}, {b}, {c})>', a, b, c, 1.0e9 * serial])
+
+
+def colors(peaks_file):
+    """{peak number: colour code} of the peak lines of a .peaks (the field after the positions)."""
+    found = {}
+    with open(peaks_file) as f:
+        for line in f:
+            if line.startswith(('#', '\t')):
+                continue
+            fields = line.split('\t')
+            found[int(fields[0])] = fields[4]
+    return found
+
+
+def test_check_spectra_marks_partners(tmp_path):
+    save_path = str(tmp_path)
+    write_export(os.path.join(save_path, '13C.csv'), 'noesy_13C', carbon_peaks)
+    write_export(os.path.join(save_path, '15N.csv'), 'noesy_15N', nitrogen_peaks)
+    spectrum_list = spectra.project_spectra(save_path)
+    for spectrum in spectrum_list:
+        to_xeasy.convert_spectrum(spectrum, 3)
+
+    confirmed = symmetry.check_spectra(spectrum_list)
+    assert confirmed['13C'].tolist() == [True, False, True, False]
+    assert confirmed['15N'].tolist() == [True, False, False, False]
+
+    carbon, nitrogen = spectrum_list
+    assert colors(carbon.peaks) == {1: '2', 2: '1', 3: '2', 4: '1'}
+    assert colors(nitrogen.peaks) == {1: '2', 2: '1', 3: '1', 4: '1'}
+
+    with open(carbon.symmetry_report, newline='') as f:
+        rows = list(csv.reader(f))
+    assert rows[0] == symmetry.report_columns
+    assert [row[:3] for row in rows[1:]] == [['1', '15N', '1'], ['3', '15N', '1']]
+    assert [float(row[3]) for row in rows[1:]] == [0.0, 0.02]
+    with open(nitrogen.symmetry_report, newline='') as f:
+        rows = list(csv.reader(f))
+    assert [row[:3] for row in rows[1:]] == [['1', '13C', '1'], ['1', '13C', '3']]
+
+
+def test_hand_set_colors_left_alone(tmp_path):
+    save_path = str(tmp_path)
+    write_export(os.path.join(save_path, '13C.csv'), 'noesy_13C', carbon_peaks)
+    write_export(os.path.join(save_path, '15N.csv'), 'noesy_15N', nitrogen_peaks)
+    spectrum_list = spectra.project_spectra(save_path)
+    for spectrum in spectrum_list:
+        to_xeasy.convert_spectrum(spectrum, 3)
+    carbon = spectrum_list[0]
+    with open(carbon.peaks) as f:
+        lines = f.readlines()
+    # colour 5 on 13C peak 2, set by hand
+    at = next(k for k, line in enumerate(lines) if line.startswith('2\t'))
+    fields = lines[at].split('\t')
+    fields[4] = '5'
+    lines[at] = '\t'.join(fields)
+    with open(carbon.peaks, 'w') as f:
+        f.writelines(lines)
+
+    symmetry.check_spectra(spectrum_list)
+    assert colors(carbon.peaks) == {1: '2', 2: '5', 3: '2', 4: '1'}
+    # a second run changes nothing
+    text = open(carbon.peaks).read()
+    symmetry.check_spectra(spectrum_list)
+    assert open(carbon.peaks).read() == text
@@ -0,0 +1,36 @@
+import metrics
+import spectra
+import to_xeasy
+
+
+def last_reports(run):
+    """{stage: last (done, total)} of the reports of run(progress)."""
+    reports = {}
+    run(metrics.Progress(lambda stage, done, total: reports.__setitem__(stage, (done, total))))
+    return reports
+
+
+def peak_count(spectrum):
+    with open(spectrum.csv) as f:
+        return sum(1 for line in f if line.strip()) - 1
+
+
+def test_spectrum_reports_all_its_rows(project):
+    spectrum = spectra.carbon_noesy.in_dir(project)
+    rows = peak_count(spectrum)
+    # csv module path (fewer lines than a block), then the chunked pandas writer
+    reports = last_reports(lambda progress: to_xeasy.convert_spectrum(spectrum, 3, progress=progress))
+    assert reports[spectrum.name][0] == rows
+    reports = last_reports(lambda progress: to_xeasy.write_peaks(
+        to_xeasy.read_peaks(spectrum.csv, spectrum.columns, 100), spectrum.peaks, spectrum.header(3),
+        report=lambda done: progress.report(spectrum.name, done)))
+    assert reports[spectrum.name][0] == rows
+
+
+def test_stage_progress_reaches_the_total(project):
+    spectrum_list = spectra.project_spectra(project)
+    rows = sum(peak_count(spectrum) for spectrum in spectrum_list)
+    for workers in (1, 2):
+        reports = last_reports(lambda progress: to_xeasy.convert_spectra(spectrum_list, 3, workers=workers,
+                                                                         progress=progress))
+        assert reports['to_xeasy'] == (rows, rows)
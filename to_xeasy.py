@@ -1,66 +1,426 @@
 #! /usr/bin/python3
+import csv
+import os
 import sys 
-import pandas as pd
+import metrics
+import spectra
+from fileutils import parse_float, format_float, count_lines, compression_of, open_file, replace_file
+# pandas, numpy and the modules using them (assign_peaks, peak_cleanup,
+# peak_cache) are imported by the functions needing them: a plain
+# conversion of a small project only uses the csv module
 '''
 file_15 = '/home/biosys/Bureau/python_cy/for_cyana_ccpnm/Bform/15NNOE.csv'
 file_13 = '/home/biosys/Bureau/python_cy/for_cyana_ccpnm/Bform/C13NOE.csv'
 path_save = '/home/biosys/Bureau/python_cy/python_clean/'
 version= '3' #input('cyana 2 vs cyana 3.98 (2/3)')
 '''
-def process_files(file_13, file_15, version, path_save):
-    def change_format(file, path_save=path_save, variable='N'):
-        file = file.drop(columns=['_object']) # remove the first colomn _object
-        file.insert(0, 'Index', range(1, len(file) + 1)) # add number increasing
-        file.insert(4,'1',1)
-        file.insert(5,'U','U')
-        file = file.replace('None', 0)
-        file['Column_0.00e+00'] = '0.00e+00'
-        for i in range(1, 6):
-            file[f'Column_0_{i}'] = 0
-        file = file.to_csv(index=False, header=False, sep='\t')
-        
-        if version == 3:
-            text_n = "# Number of dimensions 3\n#FORMAT xeasy3D\n#INAME 1 HN\n#INAME 2 H\n#INAME 3 N\n#SPECTRUM N15NOESY  HN H N\n"
-            text_c = "# Number of dimensions 3\n#FORMAT xeasy3D\n#INAME 1 HC\n#INAME 2 H\n#INAME 3 C\n#SPECTRUM C13NOESY  HC H C\n"
-        elif version == 2:
-            text_n = "# Number of dimensions 3\n#FORMAT xeasy3D\n#INAME 1 HN\n#INAME 2 H\n#INAME 3 N\n#CYANAFORMAT HhN\n"
-            text_c = "# Number of dimensions 3\n#FORMAT xeasy3D\n#INAME 1 HC\n#INAME 2 H\n#INAME 3 C\n#CYANAFORMAT HhC\n"
-            
-        if variable == 'N':
-                with open(path_save +'/15N.peaks', 'w') as text:
-                    text.write(text_n)
-                    text.write(file)
-            
-        else:
-            with open(path_save +'/13C.peaks', 'w') as text:
-                text.write(text_c)
-                text.write(file)
-                    
-    
-    if version == 3 or 2:
-        data_13 = pd.read_csv(file_13)
-        data_15 = pd.read_csv(file_15)
-        
-        #change columns for 13C
-        new_order = [ '_object', 'Pos F1', 'Pos F3', 'Pos F2', 'Volume'] # new order for data in carbon
-        data_13 = data_13[new_order] #change the order
-        
-        #formatation
-        change_format(file=data_13, variable='C')
-        change_format(file=data_15)
-    
+
+# number of peaks read and written at once, memory stays flat whatever the size of the peak list
+chunksize = 100000
+# below this total size of the CCPN exports, a worker process costs more than it saves
+parallel_min_bytes = 20 * 2**20
+# smaller CCPN exports are parsed as text, bigger ones go through the peak cache
+cache_min_bytes = 4 * 2**20
+# index of the peak numbers next to the .peaks of an incremental update (see peak_index)
+peak_index_suffix = '.peakindex'
+# worker processes are started fresh: the conversion runs in a thread of a
+# multithreaded process (stage pool, Qt), a fork could copy a lock held by
+# another thread and hang the child
+start_method = 'spawn'
+
+def pool_context():
+    """multiprocessing context of the worker processes and of their manager."""
+    import multiprocessing
+    return multiprocessing.get_context(start_method)
+
+def xeasy_header(version, variable='N'):
+    """Header of the 15N (variable 'N') or 13C NOESY peak file for cyana 2 or 3."""
+    spectrum = spectra.nitrogen_noesy if variable == 'N' else spectra.carbon_noesy
+    return spectrum.header(version)
+
+def change_format(file, first_index=1, n_dims=3):
+    """Turn CCPN peaks (_object, n_dims positions, Volume) into xeasy columns."""
+    file = file.drop(columns=['_object'], errors='ignore') # remove the first colomn _object
+    file.insert(0, 'Index', range(first_index, first_index + len(file))) # add number increasing
+    file.insert(n_dims + 1,'1',1)
+    file.insert(n_dims + 2,'U','U')
+    file = file.replace('None', 0)
+    file['Column_0.00e+00'] = '0.00e+00'
+    for i in range(1, n_dims + 3):
+        file[f'Column_0_{i}'] = 0
+    return file
+
+def assignment_columns_of(n_dims):
+    """xeasy columns holding the atom numbers of the assignment (one per dimension)."""
+    return [f'Column_0_{i}' for i in range(3, n_dims + 3)]
+
+assignment_columns = assignment_columns_of(3)
+
+def add_assignments(file, candidates, n_dims=3):
+    """Best candidate in the assignment columns, the others on continuation lines."""
+    import pandas as pd
+    if candidates.empty:
+        return file
+    columns = list(zip(assignment_columns_of(n_dims), [f'a{d + 1}' for d in range(n_dims)]))
+    first = ~candidates['peak'].duplicated()
+    best = candidates[first]
+    rows = best['peak'].to_numpy()
+    for column, atoms in columns:
+        values = file[column].to_numpy().copy()
+        values[rows] = best[atoms].to_numpy()
+        file[column] = values
+    others = candidates[~first]
+    if others.empty:
+        return file
+    # continuation lines: blank fields then the atom numbers of the alternative
+    alternatives = pd.DataFrame('', index=range(len(others)), columns=file.columns)
+    for column, atoms in columns:
+        alternatives[column] = others[atoms].to_numpy()
+    order = list(range(len(file))) + list(others['peak'].to_numpy())
+    merged = pd.concat([file.astype(object), alternatives], ignore_index=True)
+    return merged.iloc[pd.Series(order).sort_values(kind='stable').index]
+
+def peak_assigner(shifts, dims, bonded, tolerances=None):
+    """Function giving the candidate assignments of a chunk of peaks."""
+    import assign_peaks
+    index = shifts if isinstance(shifts, assign_peaks.ShiftIndex) else assign_peaks.ShiftIndex(shifts)
+    def assign(chunk):
+        positions = [chunk.iloc[:, d].to_numpy() for d in range(len(dims))]
+        return assign_peaks.find_candidates(index, positions, dims, bonded, tolerances)
+    return assign
+
+def read_peaks(file, columns, chunksize=chunksize, cache=True):
+    """Read the CCPN peak list by chunks (or all at once if chunksize is None).
+
+    With cache, the columns come from the memory-mapped binary cache next to
+    the CSV (see peak_cache), the text is only parsed when the CSV changed.
+    """
+    import pandas as pd
+    if cache:
+        table = None
+        try:
+            import peak_cache
+            table, _ = peak_cache.load_peaks(file)
+        except OSError:
+            # read-only directory, parse the text as before
+            pass
+        # only a cache that cannot be opened falls back to the text: an error
+        # while reading it is raised, the peaks already given are not read again
+        if table is not None:
+            yield from peak_cache.table_chunks(table, columns, chunksize)
+            return
+    # gzip or Zstandard exports are decompressed by pandas while it parses them
+    compression = compression_of(file)
+    if chunksize is None:
+        yield pd.read_csv(file, float_precision='round_trip', compression=compression)[columns]
+        return
+    # only the needed columns are kept, the long _object strings are not stored
+    for chunk in pd.read_csv(file, usecols=columns, chunksize=chunksize, float_precision='round_trip',
+                             compression=compression):
+        yield chunk[columns]
+
+def write_peaks(chunks, output_file, header, stats=None, assigner=None, n_dims=3, report=None):
+    """Write the header then the xeasy lines chunk by chunk (report(peaks written) after every chunk and at the end)."""
+    n_peaks = 0
+    with replace_file(output_file) as text:
+        text.write(header)
+        for chunk in chunks:
+            candidates = assigner(chunk) if assigner else None
+            n_chunk = len(chunk)
+            chunk = change_format(chunk, first_index=n_peaks + 1, n_dims=n_dims)
+            if candidates is not None:
+                chunk = add_assignments(chunk, candidates, n_dims)
+            chunk.to_csv(text, index=False, header=False, sep='\t')
+            n_peaks += n_chunk
+            if report is not None:
+                report(n_peaks)
+        if report is not None:
+            # end of the spectrum, also when no chunk came
+            report(n_peaks)
+    if stats is not None:
+        stats['rows_read'] += n_peaks
+        stats['rows_written'] += n_peaks
+    return n_peaks
+
+def read_peak_rows(file, columns, cache=True):
+    """Rows of floats of the requested CCPN columns, without pandas.
+
+    Big exports come from the peak cache (see peak_cache), the others are
+    parsed with the csv module.
+    """
+    if cache and os.path.getsize(file) >= cache_min_bytes:
+        try:
+            import peak_cache
+            table, _ = peak_cache.load_peaks(file)
+        except OSError:
+            table = None
+        if table is not None:
+            if table:
+                rows = len(table[columns[0]])
+                for start in range(0, rows, chunksize):
+                    yield from zip(*[table[name][start:start + chunksize].tolist() for name in columns])
+            return
+    with open_file(file, 'r', newline='') as f:
+        reader = csv.reader(f)
+        header = next(reader, None)
+        if header is None:
+            return
+        indices = [header.index(name) for name in columns]
+        for row in reader:
+            if row:
+                yield [parse_float(row[i]) if i < len(row) else float('nan') for i in indices]
+
+def peak_line(number, row, n_dims=3):
+    """xeasy line of one peak (n_dims positions then the volume), without assignment."""
+    return (f"{number}\t" + '\t'.join(map(format_float, row[:n_dims]))
+            + f"\t1\tU\t{format_float(row[n_dims])}\t0.00e+00" + '\t0' * (n_dims + 2) + '\n')
+
+def write_peak_rows(rows, output_file, header, stats=None, n_dims=3, report=None):
+    """Write the xeasy lines of the rows (n_dims positions then the volume) without pandas."""
+    n_peaks = 0
+    with replace_file(output_file, buffering=1 << 20) as text:
+        text.write(header)
+        lines = []
+        for n_peaks, row in enumerate(rows, 1):
+            lines.append(peak_line(n_peaks, row, n_dims))
+            if len(lines) == 10000:
+                text.write(''.join(lines))
+                lines = []
+                if report is not None:
+                    report(n_peaks)
+        text.write(''.join(lines))
+        if report is not None:
+            # the last block, the whole spectrum when it has fewer lines
+            report(n_peaks)
+    if stats is not None:
+        stats['rows_read'] += n_peaks
+        stats['rows_written'] += n_peaks
+    return n_peaks
+
+def forget_peak_index(peaks_file):
+    """Remove the peak number index of a peak file written again from scratch."""
+    try:
+        os.remove(peaks_file + peak_index_suffix)
+    except FileNotFoundError:
+        pass
+
+def cleaned_peaks(chunks, dims, report_file, chunksize=chunksize, tolerances=None, stats=None, diagonal=(0, 1)):
+    """Peaks without the diagonal and the near-duplicates, by chunks; the removed ones go to report_file."""
+    import pandas as pd
+    import peak_cleanup
+    peaks = pd.concat(list(chunks), ignore_index=True)
+    kept, report = peak_cleanup.clean_peaks(peaks, dims, diagonal=diagonal, tolerances=tolerances, stats=stats)
+    peak_cleanup.write_report(report, report_file)
+    if stats is not None:
+        # the kept ones are counted by write_peaks
+        stats['rows_read'] += len(report)
+    step = chunksize or max(len(kept), 1)
+    for start in range(0, max(len(kept), 1), step):
+        yield kept.iloc[start:start + step]
+
+def convert_spectrum(spectrum, version, chunksize=chunksize, cache=True, shifts=None, tolerances=None,
+                     clean=False, clean_tolerances=None, progress=None, incremental=False):
+    """Write the xeasy peak file of one spectrum, return its stats (see metrics.new_stats).
+
+    With shifts (final .prot file, its table or a ShiftIndex), the candidate
+    assignments of every peak are written in the assignment columns (see
+    assign_peaks). With clean, the diagonal and near-duplicate peaks are left
+    out and listed in the cleanup report of the spectrum (see peak_cleanup).
+    With incremental (and without clean), only the peaks changed since the
+    last export are written again and the peak numbers are kept (see
+    peak_index); a compressed .peaks (.gz, .zst) is always written whole.
+    The export and the .peaks can be gzip or Zstandard compressed (see
+    fileutils.open_file).
+    The peaks written are reported to progress (metrics.Progress) under the
+    name of the spectrum.
+    """
+    if incremental and not clean and compression_of(spectrum.peaks, 'w') is None:
+        import peak_index
+        return peak_index.update_spectrum(spectrum, version, shifts, tolerances, progress)
+    forget_peak_index(spectrum.peaks)
+    if shifts is None and not clean:
+        # plain conversion: csv module (or peak cache) and string formatting only
+        stats = metrics.new_stats()
+        try:
+            write_peak_rows(read_peak_rows(spectrum.csv, spectrum.columns, cache), spectrum.peaks,
+                            spectrum.header(version), stats, spectrum.n_dims,
+                            rows_reporter(progress, spectrum.name))
+            return stats
+        except ValueError:
+            # text that is not a number in a position or volume column, let pandas handle it
+            pass
+    chunks = read_peaks(spectrum.csv, spectrum.columns, chunksize, cache)
+    return convert_chunks(spectrum, chunks, version, chunksize, shifts, tolerances, clean, clean_tolerances,
+                          progress)
+
+def convert_chunks(spectrum, chunks, version, chunksize=chunksize, shifts=None, tolerances=None,
+                   clean=False, clean_tolerances=None, progress=None):
+    """Same as convert_spectrum for peaks coming from another reader (spectrum.columns DataFrames)."""
+    stats = metrics.new_stats()
+    forget_peak_index(spectrum.peaks)
+    assigner = None
+    if shifts is not None:
+        import assign_peaks
+        if isinstance(shifts, str):
+            shifts = assign_peaks.read_prot(shifts)
+        assigner = peak_assigner(shifts, spectrum.nuclei, spectrum.bonded, tolerances)
+
+    if clean:
+        chunks = cleaned_peaks(chunks, spectrum.nuclei, spectrum.cleanup_report, chunksize,
+                               clean_tolerances, stats, spectrum.diagonal)
+    write_peaks(chunks, spectrum.peaks, spectrum.header(version), stats, assigner, spectrum.n_dims,
+                rows_reporter(progress, spectrum.name))
+    return stats
+
+def rows_reporter(progress, name):
+    """report(peaks written) of one spectrum, None without progress."""
+    if progress is None:
+        return None
+    def report(done):
+        progress.report(name, done)
+    return report
+
+def spectra_progress(progress, spectrum_list, stage='to_xeasy'):
+    """Progress of the single spectra, reported to progress as the total of the stage.
+
+    The number of peaks of every spectrum is counted first (lines of the
+    export) so the total is known from the start; with a compressed export
+    the total stays unknown, it is not decompressed twice.
+    """
+    present = [s for s in spectrum_list if os.path.exists(s.csv)]
+    known = not any(compression_of(s.csv) for s in present)
+    totals = {s.name: max(count_lines(s.csv) - 1, 0) if known else 0 for s in present}
+    done = dict.fromkeys(totals, 0)
+    def callback(name, rows, total=None):
+        done[name] = rows
+        progress.report(stage, sum(done.values()), sum(totals.values()) if known else None)
+    callback(None, 0)
+    return callback
+
+class QueueReport:
+    """Progress callback of a worker process, the reports go through a queue to the parent."""
+
+    def __init__(self, queue):
+        self.queue = queue
+
+    def __call__(self, stage, done, total=None):
+        self.queue.put((stage, done, total))
+
+def pool_results(futures, queue, callback, progress, shared):
+    """Results of the futures, forwarding the progress reports of the workers meanwhile.
+
+    shared: metrics.Progress of the workers, cancelled with progress.
+    """
+    import queue as queues
+    from concurrent.futures import wait
+    pending = set(futures)
+    try:
+        while pending:
+            _, pending = wait(pending, timeout=0.2)
+            while True:
+                try:
+                    callback(*queue.get_nowait())
+                except queues.Empty:
+                    break
+            if progress.cancelled:
+                raise metrics.Cancelled("to_xeasy cancelled")
+    except metrics.Cancelled:
+        # the workers stop at their next report, the waiting spectra are not started
+        shared.cancel()
+        for future in futures:
+            future.cancel()
+        raise
+    return [future.result() for future in futures]
+
+def convert_spectra(spectrum_list, version, chunksize=chunksize, stats=None, cache=True, shifts=None,
+                    tolerances=None, clean=False, clean_tolerances=None, workers=None, progress=None,
+                    incremental=False):
+    """Write the xeasy peak file of every spectrum.
+
+    Large datasets are converted in a pool of worker processes, one spectrum
+    per worker, so the time is set by the largest spectrum and not by the
+    sum of them (default: one worker per CPU). workers=1 converts them one
+    after the other in this process.
+    progress: metrics.Progress, gets the peaks written by all the spectra.
+    incremental: keep the peak numbers of the last conversion (see peak_index).
+    """
+    options = {'chunksize': chunksize, 'cache': cache, 'tolerances': tolerances,
+               'clean': clean, 'clean_tolerances': clean_tolerances, 'incremental': incremental}
+    size = sum(os.path.getsize(s.csv) for s in spectrum_list if os.path.exists(s.csv))
+    workers = min(workers or os.cpu_count() or 1, len(spectrum_list))
+    if workers < 2 or size < parallel_min_bytes:
+        if shifts is not None and not incremental:
+            # one index for all the spectra (the incremental update checks the .prot file itself)
+            import assign_peaks
+            if isinstance(shifts, str):
+                shifts = assign_peaks.read_prot(shifts)
+            shifts = assign_peaks.ShiftIndex(shifts)
+        if progress is not None:
+            progress = metrics.Progress(spectra_progress(progress, spectrum_list), progress.event)
+        results = [convert_spectrum(spectrum, version, shifts=shifts, progress=progress, **options)
+                   for spectrum in spectrum_list]
+    elif progress is not None:
+        # the workers report through the queue of a manager and share its cancel flag
+        from concurrent.futures import ProcessPoolExecutor
+        callback = spectra_progress(progress, spectrum_list)
+        context = pool_context()
+        with context.Manager() as manager, ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+            queue = manager.Queue()
+            shared = metrics.Progress(QueueReport(queue), manager.Event())
+            futures = [pool.submit(convert_spectrum, spectrum, version, shifts=shifts, progress=shared,
+                                   **options) for spectrum in spectrum_list]
+            results = pool_results(futures, queue, callback, progress, shared)
     else:
-        print('out')
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=workers, mp_context=pool_context()) as pool:
+            futures = [pool.submit(convert_spectrum, spectrum, version, shifts=shifts, **options)
+                       for spectrum in spectrum_list]
+            results = [future.result() for future in futures]
+    if stats is not None:
+        for result in results:
+            metrics.add_stats(stats, result)
+    return results
+
+def process_files(file_13, file_15, version, path_save, chunksize=chunksize, stats=None, cache=True,
+                  shifts=None, tolerances=None, clean=False, clean_tolerances=None, workers=None,
+                  symmetry=False):
+    """Write 13C.peaks and 15N.peaks in path_save (see convert_spectra).
+
+    With symmetry, the peaks with a symmetry partner in the other NOESY are
+    marked confirmed (see symmetry).
+    """
+    carbon = spectra.carbon_noesy.in_dir(path_save)
+    carbon.csv = file_13
+    nitrogen = spectra.nitrogen_noesy.in_dir(path_save)
+    nitrogen.csv = file_15
+    convert_spectra([carbon, nitrogen], version, chunksize, stats, cache, shifts, tolerances,
+                    clean, clean_tolerances, workers)
+    if symmetry:
+        import symmetry as symmetry_check
+        symmetry_check.check_spectra([carbon, nitrogen], stats=stats)
 
 def main():
+    # optional flag: leave out the diagonal and near-duplicate peaks
+    clean = '--clean' in sys.argv
+    if clean:
+        sys.argv.remove('--clean')
+    # optional flag: mark the peaks confirmed by the other NOESY (colour code 2)
+    symmetry = '--symmetry' in sys.argv
+    if symmetry:
+        sys.argv.remove('--symmetry')
     file_13C = sys.argv[1]
     File_15N = sys.argv[2]
     version = sys.argv[3]
     save_path = sys.argv[4]
+    # optional: number of peaks per chunk, 0 to read the whole file at once
+    size = int(sys.argv[5]) if len(sys.argv) > 5 else chunksize
+    # optional: final .prot to write candidate assignments
+    prot_file = sys.argv[6] if len(sys.argv) > 6 else None
 
     
     version = int(version)
-    process_files(file_13C,File_15N,version,save_path)
+    process_files(file_13C,File_15N,version,save_path, size or None, shifts=prot_file, clean=clean,
+                  symmetry=symmetry)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
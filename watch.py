@@ -0,0 +1,190 @@
+#! /usr/bin/python3
+import argparse
+import hashlib
+import json
+import os
+import sys
+import time
+
+import engine
+import metrics
+from fileutils import file_hash
+from scheduler import run_stages, stage_dependencies
+
+'''
+Watch a working directory and reconvert only what changed.
+
+A content-hash manifest (.cycy_manifest.json) keeps, for every stage, the
+SHA-1 of the inputs it was last run with (CSV exports, prot.seq, the
+nomenclature library) and of the parameters it uses (the cyana version
+only changes the .peaks). When a file changes, only the stages reading it
+are run again; a stage reading the output of a stage run again follows
+only when that output really changed (same prot.seq written again: the
+.prot is left alone).
+
+python watch.py /path/to/work 43 APEKKVLFWYDPMKPDTKFDKPGKSPFMDMDLVPKYADESG --version 3
+python watch.py /path/to/work 43 APEKKVLF... --once   # one incremental pass
+python watch.py /path/to/work 43 APEKKVLF... --incremental   # .peaks updated peak by peak
+python watch.py /path/to/work 43 APEKKVLF... --compress .gz   # 13C.peaks.gz, attib_cyana.prot.gz
+'''
+
+manifest_name = '.cycy_manifest.json'
+
+
+def read_manifest(save_path):
+    try:
+        with open(os.path.join(save_path, manifest_name), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_manifest(save_path, manifest):
+    path = os.path.join(save_path, manifest_name)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+
+class HashCache:
+    """Hash files again only when their size or modification time changed."""
+
+    def __init__(self):
+        self.known = {}
+
+    def __call__(self, path):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        key = (stat.st_mtime_ns, stat.st_size)
+        if self.known.get(path, (None,))[0] != key:
+            self.known[path] = (key, file_hash(path))
+        return self.known[path][1]
+
+
+def manifest_key(path, save_path):
+    """Paths of the working directory are kept relative to it."""
+    path = os.path.abspath(path)
+    relative = os.path.relpath(path, os.path.abspath(save_path))
+    return path if relative.startswith(os.pardir) else relative
+
+
+def params_hash(*values):
+    text = '|'.join(str(value) for value in values)
+    return hashlib.sha1(text.encode()).hexdigest()
+
+
+def stage_params(start_number, fasta_sequence, version):
+    """Parameter hash of every stage, from the parameters it uses only (the others: no parameter)."""
+    return {'fasta_to_seq': params_hash(int(start_number), fasta_sequence.upper()),
+            'to_xeasy': params_hash(int(version))}
+
+
+def stage_changed(stage, manifest, hashes, params, save_path):
+    """Whether the inputs or the parameters of a stage changed since its last run, or an output is missing."""
+    record = manifest.get(stage.name)
+    return (not record or record.get('params') != params.get(stage.name, params_hash())
+            or any(record['inputs'].get(manifest_key(path, save_path)) != hashes(path)
+                   for path in stage.inputs)
+            or not all(os.path.exists(path) for path in stage.outputs))
+
+
+def stages_to_run(stages, manifest, hashes, params, save_path, done=()):
+    """Changed stages (not in done) that can run now: none of their inputs is written by another changed stage.
+
+    The stages after them are looked at again once they ran, from the
+    hashes of the outputs they wrote.
+    """
+    deps = stage_dependencies(stages)
+    changed = {stage.name for stage in stages
+               if stage.name not in done and stage_changed(stage, manifest, hashes, params, save_path)}
+    return [stage for stage in stages if stage.name in changed and not deps[stage.name] & changed]
+
+
+def convert_changes(save_path, start_number, fasta_sequence, version, hashes=None, incremental=False,
+                    compress=None):
+    """One incremental pass: rerun the changed stages and update the manifest.
+
+    With incremental, a changed peak list only rewrites its changed peaks
+    (see peak_index). compress: '.gz' or '.zst', the .peaks and the .prot are
+    written compressed.
+    """
+    hashes = hashes or HashCache()
+    stages = engine.conversion_stages(save_path, int(start_number), fasta_sequence, int(version),
+                                      incremental=incremental, compress=compress)
+    params = stage_params(start_number, fasta_sequence, version)
+    manifest = read_manifest(save_path)
+
+    results = []
+    done = set()
+    # by waves: the stages reading the outputs of a wave are checked once it is over
+    while True:
+        todo = stages_to_run(stages, manifest, hashes, params, save_path, done)
+        if not todo:
+            break
+        # inputs are hashed before the run, a file changing meanwhile is picked up next pass
+        before = {stage.name: {path: hashes(path) for path in stage.inputs} for stage in todo}
+        for stage, result in zip(todo, run_stages(todo)):
+            done.add(stage.name)
+            results.append(result)
+            if result['ok']:
+                manifest[stage.name] = {'params': params.get(stage.name, params_hash()),
+                                        'inputs': {manifest_key(path, save_path): digest
+                                                   for path, digest in before[stage.name].items()}}
+            else:
+                manifest.pop(stage.name, None)
+        write_manifest(save_path, manifest)
+    return results
+
+
+def watch(save_path, start_number, fasta_sequence, version, interval=2.0, incremental=False, compress=None):
+    """Poll the working directory and convert every change."""
+    message = engine.check_inputs(save_path, start_number, fasta_sequence, version, compress)
+    if message:
+        raise ValueError(message)
+    hashes = HashCache()
+    print(f"Watching {save_path} (Ctrl+C to stop)", flush=True)
+    while True:
+        for result in convert_changes(save_path, start_number, fasta_sequence, version, hashes, incremental,
+                                      compress):
+            status = 'ok' if result['ok'] else f"error: {result['error']}"
+            print(f"{time.strftime('%H:%M:%S')} {result['name']} {status} ({result['time']:.2f} s)", flush=True)
+        time.sleep(interval)
+
+
+def main():
+    metrics.setup_logging()
+    parser = argparse.ArgumentParser(description="Reconvert a working directory when its CCPN exports change.")
+    parser.add_argument('save_path', help="working directory with 13C.csv, 15N.csv and attrib.csv")
+    parser.add_argument('start', help="number of the first amino acid")
+    parser.add_argument('sequence', help="protein sequence, one-letter codes")
+    parser.add_argument('--version', default='2', choices=['2', '3'], help="cyana version")
+    parser.add_argument('--interval', type=float, default=2.0, help="seconds between two checks")
+    parser.add_argument('--once', action='store_true', help="convert what changed and exit")
+    parser.add_argument('--incremental', action='store_true',
+                        help="update the .peaks files with the changed peaks only")
+    parser.add_argument('--compress', choices=['.gz', '.zst'], help="write the .peaks and the .prot compressed")
+    args = parser.parse_args()
+
+    if args.once:
+        message = engine.check_inputs(args.save_path, args.start, args.sequence, args.version, args.compress)
+        if message:
+            print(message)
+            return 1
+        results = convert_changes(args.save_path, args.start, args.sequence, args.version,
+                                  incremental=args.incremental, compress=args.compress)
+        for result in results:
+            print(f"{result['name']} {'ok' if result['ok'] else 'error: ' + result['error']}")
+        return 0 if all(result['ok'] for result in results) else 1
+
+    try:
+        watch(args.save_path, args.start, args.sequence, args.version, args.interval, args.incremental,
+              args.compress)
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())